@@ -0,0 +1,9 @@
+# width / height ranges of the aspect ratio types images are sorted into. Kept apart from layouts_generator so
+# tools that only need the ranges, such as test_image_generator, do not import the whole pipeline
+ASPECT_RATIO_RANGES = {
+    "square-ish": (0.751, 1.250),
+    "portrait-ish": (1.251, 1.800),
+    "landscape-ish": (0.561, 0.750),
+    "ultra-wide": (1.801, 3.000),  # anything beyond is too wide to handle, anything beyond will be disregarded
+    "ultra-narrow": (0.333, 0.560),  # anything beyond is too narrow to handle, anything beyond will be disregarded
+}
@@ -0,0 +1,116 @@
+import json
+import os
+
+# record types written to the journal, one JSON object per line
+RECORD_BATCH = "batch"
+RECORD_DONE = "done"
+RECORD_CHECKPOINT = "checkpoint"
+
+
+class BatchJournal:
+    """
+    Append-only progress log of a batch run, so a batch that died can be resumed where it stopped.
+
+    The first line describes the batch (seed, number of collages, image directory and a digest of the image pool).
+    Every finished collage appends a "done" line with its output path and size, and every checkpoint_interval
+    collages a "checkpoint" line is appended and the file is synced to disk.
+
+    Collages are seeded from (batch seed, collage id), so the random state and the image picks of any collage
+    can be recreated from the batch line alone. Resuming reruns exactly the collages that are missing.
+    """
+
+    def __init__(self, path: str, checkpoint_interval: int = 10):
+        self._path = path
+        self._checkpoint_interval = max(int(checkpoint_interval), 1)
+        self._batch = None
+        # collage id -> done record
+        self._completed = {}
+        self._done_since_checkpoint = 0
+        self._file = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self._path)
+
+    def load(self):
+        """
+        Reads an existing journal. A truncated last line (e.g. the process was killed mid write) is ignored.
+        """
+        self._batch = None
+        self._completed = {}
+        with open(self._path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record["type"] == RECORD_BATCH:
+                    self._batch = record
+                elif record["type"] == RECORD_DONE:
+                    self._completed[record["collage_id"]] = record
+
+    def start(self, seed, num_to_generate: int, image_directory: str, image_pool_digest: str, **extra_fields):
+        """
+        Starts a new journal, replacing any existing one
+        """
+        self._batch = {"type": RECORD_BATCH, "seed": seed, "num_to_generate": num_to_generate,
+                       "image_directory": image_directory, "image_pool_digest": image_pool_digest}
+        self._batch.update(extra_fields)
+        self._completed = {}
+        self._close()
+        self._file = open(self._path, "w")
+        self._write(self._batch)
+        self._sync()
+
+    def reopen(self):
+        """
+        Continues appending to a journal that was loaded with load()
+        """
+        self._close()
+        self._file = open(self._path, "a")
+
+    def get_batch(self) -> dict:
+        return self._batch
+
+    def is_completed(self, collage_id: int) -> bool:
+        """
+        A collage counts as completed only if its output still exists with the size that was recorded,
+        so partially written or deleted outputs are redone on resume.
+        """
+        record = self._completed.get(collage_id)
+        if record is None:
+            return False
+        output_path = record["output_path"]
+        return os.path.exists(output_path) and os.path.getsize(output_path) == record["size"]
+
+    def get_completed_ids(self) -> list:
+        return sorted(collage_id for collage_id in self._completed.keys() if self.is_completed(collage_id))
+
+    def mark_done(self, collage_id: int, output_path: str):
+        record = {"type": RECORD_DONE, "collage_id": collage_id, "output_path": output_path,
+                  "size": os.path.getsize(output_path)}
+        self._completed[collage_id] = record
+        self._write(record)
+        self._done_since_checkpoint += 1
+        if self._done_since_checkpoint >= self._checkpoint_interval:
+            self.checkpoint(collage_id + 1)
+
+    def checkpoint(self, next_collage_id: int):
+        self._write({"type": RECORD_CHECKPOINT, "next_collage_id": next_collage_id,
+                     "completed": len(self._completed)})
+        self._sync()
+        self._done_since_checkpoint = 0
+
+    def close(self):
+        self._close()
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,335 @@
+import argparse
+import copy
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import layout_containers_factory
+import layouts_generator
+import test_image_generator
+from src import photo_mosaic
+from src.layout.image import Image
+
+# layouts to benchmark. The single level layouts put images straight into one container of that type,
+# "nested" uses generate_random_layouts() like run() does
+BENCHMARK_LAYOUTS = ["horizontal", "vertical", "grid", "nested"]
+BENCHMARK_RESOLUTIONS = ["1080p", "1440p", "4k"]
+
+DEFAULT_NUM_OF_IMAGES = 60
+DEFAULT_REPEAT = 5
+DEFAULT_SEED = 1234
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+# shortest side of the generated images. Longer sides are derived from the aspect ratio
+DEFAULT_IMAGE_SHORT_SIDE_RANGE = (600, 1600)
+# the large tree benchmark is a grid of image frames with cells of LARGE_TREE_CELL_SIZE pixels after the layout pass,
+# the smallest size containers accept (ContainerItem.DEFAULT_MINIMUM_CONTENT_WIDTH)
+DEFAULT_LARGE_TREE_LEAVES = 50000
+LARGE_TREE_CELL_SIZE = 50
+LARGE_TREE_IMAGE_SIZE = 48
+# the mosaic benchmark matches the cells of a MOSAIC_COLUMNS x MOSAIC_ROWS mosaic against a synthetic library
+DEFAULT_MOSAIC_LIBRARY_SIZE = 50000
+MOSAIC_COLUMNS = 100
+MOSAIC_ROWS = 60
+
+
+def create_benchmark_corpus(directory: str, num_of_images: int = DEFAULT_NUM_OF_IMAGES, seed: int = DEFAULT_SEED,
+                            short_side_range: tuple = DEFAULT_IMAGE_SHORT_SIDE_RANGE):
+    """
+    Creates a deterministic corpus of solid color JPEGs covering every range in ASPECT_RATIO_RANGES.
+    The same seed always gives the same files so results can be compared across runs and machines.
+
+    :param directory: where to save the images, created if it does not exist
+    :param num_of_images: number of images to create
+    :param seed: seed for the sizes and colors
+    :param short_side_range: (min, max) size of the shorter side of each image
+    :return: the directory
+    """
+    test_image_generator.create_corpus(num_of_images, directory, seed, short_side_range, formats={"jpg": 1})
+    return directory
+
+
+def create_single_level_layout(layout_name: str, resolution: str):
+    """
+    Creates a main container of the given layout type filling the whole screen
+    :return: the container and the list of bottom level containers to populate
+    """
+    width, height = layouts_generator.SCREEN_RESOLUTIONS[resolution]
+    container = layouts_generator.create_layout_from_type(layouts_generator.LAYOUT_HEURISTICS[layout_name],
+                                                          width, height)
+    return container, [container]
+
+
+def create_layout(layout_name: str, resolution: str):
+    if layout_name == "nested":
+        return layouts_generator.generate_random_layouts(resolution)
+    return create_single_level_layout(layout_name, resolution)
+
+
+def benchmark_scan(corpus_directory: str, repeat: int) -> dict:
+    timings = []
+    num_of_images = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        dict_of_images = layouts_generator.create_aspect_ratio_sorted_list_of_images_from_directory(corpus_directory)
+        timings.append(time.perf_counter() - start)
+        num_of_images = sum(len(paths) for paths in dict_of_images.values())
+    scan_seconds = statistics.median(timings)
+    return {
+        "scan_seconds": scan_seconds,
+        "images_per_second": num_of_images / scan_seconds if scan_seconds > 0 else 0.0,
+        "num_of_images": num_of_images,
+    }
+
+
+def benchmark_layout(layout_name: str, resolution: str, dict_of_images: dict, repeat: int, seed: int) -> dict:
+    """
+    Times each stage of generating a collage: layout generation, populating (decode + resize),
+    rendering (compositing) and encoding to JPEG in memory. Each repetition uses its own seed so the
+    median is taken over a few different layouts.
+
+    :return: dictionary of median seconds per stage and throughput
+    """
+    stage_timings = {"layout_seconds": [], "populate_seconds": [], "render_seconds": [], "encode_seconds": []}
+    encoded_bytes = []
+    width, height = layouts_generator.SCREEN_RESOLUTIONS[resolution]
+    for i in range(repeat):
+        random.seed(seed + i)
+        copy_of_dict_of_images = copy.deepcopy(dict_of_images)
+
+        start = time.perf_counter()
+        main_container, bottom_level_containers = create_layout(layout_name, resolution)
+        layout_done = time.perf_counter()
+        layouts_generator.populate_bottom_level_containers(bottom_level_containers, copy_of_dict_of_images)
+        populate_done = time.perf_counter()
+        collage = layouts_generator.render_collage(main_container)
+        render_done = time.perf_counter()
+        success, encoded = cv2.imencode(".jpg", collage)
+        encode_done = time.perf_counter()
+
+        stage_timings["layout_seconds"].append(layout_done - start)
+        stage_timings["populate_seconds"].append(populate_done - layout_done)
+        stage_timings["render_seconds"].append(render_done - populate_done)
+        stage_timings["encode_seconds"].append(encode_done - render_done)
+        encoded_bytes.append(len(encoded) if success else 0)
+
+    result = {name: statistics.median(timings) for name, timings in stage_timings.items()}
+    total_seconds = sum(result.values())
+    result["total_seconds"] = total_seconds
+    result["collages_per_second"] = 1 / total_seconds if total_seconds > 0 else 0.0
+    result["output_megapixels_per_second"] = width * height / 1000000 / total_seconds if total_seconds > 0 else 0.0
+    result["encoded_bytes"] = int(statistics.median(encoded_bytes))
+    return result
+
+
+def create_large_tree(num_of_leaves: int, cell_size: int):
+    """
+    Creates a grid container holding num_of_leaves ImageFrameContainer + Image pairs. The images share one small
+    array so the benchmark measures the tree itself and not the pixels.
+    :return: the grid container
+    """
+    columns = math.ceil(math.sqrt(num_of_leaves * 16 / 9))
+    rows = math.ceil(num_of_leaves / columns)
+    grid = layout_containers_factory.create_grid_container(columns * cell_size, rows * cell_size, rows, columns)
+    pixels = np.zeros((LARGE_TREE_IMAGE_SIZE, LARGE_TREE_IMAGE_SIZE, 3), dtype=np.uint8)
+    for i in range(num_of_leaves):
+        grid.add_item(layout_containers_factory.create_image_frame_container(Image(pixels)))
+    return grid
+
+
+def benchmark_large_tree(num_of_leaves: int = DEFAULT_LARGE_TREE_LEAVES, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    Times building, laying out and walking a tree with num_of_leaves leaves, and measures the memory the tree
+    objects take. The layout pass halves the size of the grid, which resizes every frame and image. The walk
+    computes the fingerprint, which visits the geometry of every node. The tree is too large to draw in memory.
+
+    :return: dictionary of median seconds per step and the memory of the tree in bytes
+    """
+    step_timings = {"build_seconds": [], "layout_seconds": [], "walk_seconds": []}
+    for i in range(repeat):
+        start = time.perf_counter()
+        grid = create_large_tree(num_of_leaves, LARGE_TREE_CELL_SIZE * 2)
+        build_done = time.perf_counter()
+        grid.resize_by_width(grid.get_width() // 2)
+        layout_done = time.perf_counter()
+        grid.get_fingerprint()
+        walk_done = time.perf_counter()
+        step_timings["build_seconds"].append(build_done - start)
+        step_timings["layout_seconds"].append(layout_done - build_done)
+        step_timings["walk_seconds"].append(walk_done - layout_done)
+        del grid
+
+    # measured on a separate build since tracing slows everything down
+    tracemalloc.start()
+    grid = create_large_tree(num_of_leaves, LARGE_TREE_CELL_SIZE * 2)
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del grid
+
+    result = {name: statistics.median(timings) for name, timings in step_timings.items()}
+    result["num_of_leaves"] = num_of_leaves
+    result["tree_bytes"] = tree_bytes
+    result["tree_bytes_per_leaf"] = tree_bytes / num_of_leaves
+    return result
+
+
+def benchmark_mosaic_matching(library_size: int = DEFAULT_MOSAIC_LIBRARY_SIZE, repeat: int = DEFAULT_REPEAT,
+                              seed: int = DEFAULT_SEED) -> dict:
+    """
+    Times matching every mosaic cell to a library image: the bulk nearest neighbour search plus the assignment
+    with the reuse limit, on random color features. Computing the features of a real library is a one off cost.
+
+    :return: dictionary of the median seconds
+    """
+    random_generator = np.random.default_rng(seed)
+    feature_index = photo_mosaic.ColorFeatureIndex(
+        [f"image_{i}.jpg" for i in range(library_size)],
+        random_generator.uniform(0, 255, (library_size, photo_mosaic.FEATURE_LENGTH)))
+    cell_features = random_generator.uniform(0, 255, (MOSAIC_COLUMNS * MOSAIC_ROWS, photo_mosaic.FEATURE_LENGTH))
+    cell_features = cell_features.astype(np.float32)
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        photo_mosaic.assign_images(cell_features, feature_index, photo_mosaic.DEFAULT_MAX_USES_PER_IMAGE, seed)
+        timings.append(time.perf_counter() - start)
+
+    result = {"match_seconds": statistics.median(timings)}
+    result["library_size"] = library_size
+    result["num_of_cells"] = len(cell_features)
+    return result
+
+
+def run_benchmarks(corpus_directory: str = None, num_of_images: int = DEFAULT_NUM_OF_IMAGES,
+                   repeat: int = DEFAULT_REPEAT, seed: int = DEFAULT_SEED,
+                   layouts: list = None, resolutions: list = None, large_tree_leaves: int = 0,
+                   mosaic_library_size: int = 0) -> dict:
+    """
+    Runs the whole suite. When no corpus directory is given, a synthetic corpus is generated in a temporary
+    directory first.
+
+    :return: dictionary with "metadata" and "results", where results are keyed by "scan" and "<resolution>/<layout>"
+    """
+    layouts = layouts or BENCHMARK_LAYOUTS
+    resolutions = resolutions or BENCHMARK_RESOLUTIONS
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        if corpus_directory is None:
+            corpus_directory = create_benchmark_corpus(temporary_directory, num_of_images, seed)
+
+        results = {"scan": benchmark_scan(corpus_directory, repeat)}
+        dict_of_images = layouts_generator.create_aspect_ratio_sorted_list_of_images_from_directory(corpus_directory)
+        for resolution in resolutions:
+            for layout_name in layouts:
+                results[f"{resolution}/{layout_name}"] = benchmark_layout(layout_name, resolution, dict_of_images,
+                                                                          repeat, seed)
+                print(f"{resolution}/{layout_name}: {results[f'{resolution}/{layout_name}']['total_seconds']:.4f}s")
+        if large_tree_leaves > 0:
+            results["large_tree"] = benchmark_large_tree(large_tree_leaves, repeat)
+            print(f"large_tree: {results['large_tree']}")
+        if mosaic_library_size > 0:
+            results["mosaic_matching"] = benchmark_mosaic_matching(mosaic_library_size, repeat, seed)
+            print(f"mosaic_matching: {results['mosaic_matching']}")
+
+    return {
+        "metadata": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "num_of_images": num_of_images,
+            "repeat": repeat,
+            "seed": seed,
+            "render_threads": layouts_generator.GENERAL_SETTINGS["render_threads"],
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> list:
+    """
+    Compares every timing ("*_seconds") in current against the baseline.
+
+    :param threshold: relative slowdown allowed before a timing is flagged, e.g. 0.1 for 10%
+    :return: list of (benchmark, metric, baseline seconds, current seconds, relative change) for each regression
+    """
+    regressions = []
+    for benchmark_name, baseline_metrics in baseline["results"].items():
+        current_metrics = current["results"].get(benchmark_name)
+        if current_metrics is None:
+            continue
+        for metric, baseline_value in baseline_metrics.items():
+            if not metric.endswith("_seconds") or metric not in current_metrics or baseline_value <= 0:
+                continue
+            change = (current_metrics[metric] - baseline_value) / baseline_value
+            if change > threshold:
+                regressions.append((benchmark_name, metric, baseline_value, current_metrics[metric], change))
+    return regressions
+
+
+def save_results(results: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for scanning, layout, render and encode throughput")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark suite and save the results as JSON")
+    run_parser.add_argument("--output", default="benchmark_baseline.json")
+    run_parser.add_argument("--corpus", default=None, help="use an existing image directory instead of a synthetic one")
+    run_parser.add_argument("--images", type=int, default=DEFAULT_NUM_OF_IMAGES)
+    run_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    run_parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    run_parser.add_argument("--layouts", nargs="+", choices=BENCHMARK_LAYOUTS, default=None)
+    run_parser.add_argument("--resolutions", nargs="+", choices=BENCHMARK_RESOLUTIONS, default=None)
+    run_parser.add_argument("--render-threads", type=int, default=1,
+                            help="threads drawing independent subtrees of each collage, see render_collage()")
+
+    run_parser.add_argument("--large-tree", type=int, nargs="?", const=DEFAULT_LARGE_TREE_LEAVES, default=0,
+                            metavar="LEAVES", help="also time and measure a tree with this many image frames")
+    run_parser.add_argument("--mosaic", type=int, nargs="?", const=DEFAULT_MOSAIC_LIBRARY_SIZE, default=0,
+                            metavar="LIBRARY_SIZE",
+                            help="also time matching a 100x60 photo mosaic against a library of this many images")
+
+    compare_parser = subparsers.add_parser("compare", help="flag timings in current that regressed from baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+
+    args = parser.parse_args(arguments)
+    if args.command == "run":
+        layouts_generator.GENERAL_SETTINGS["render_threads"] = args.render_threads
+        results = run_benchmarks(args.corpus, args.images, args.repeat, args.seed, args.layouts, args.resolutions,
+                                 args.large_tree, args.mosaic)
+        save_results(results, args.output)
+        print(f"saved results to {args.output}")
+        return 0
+
+    regressions = compare_results(load_results(args.baseline), load_results(args.current), args.threshold)
+    for benchmark_name, metric, baseline_value, current_value, change in regressions:
+        print(f"REGRESSION {benchmark_name} {metric}: {baseline_value:.4f}s -> {current_value:.4f}s ({change:+.1%})")
+    if len(regressions) == 0:
+        print(f"no regressions beyond {args.threshold:.0%}")
+        return 0
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import functools
+
+import cv2
+import numpy as np
+
+from src import image_decoder
+
+# longer side of the image the estimate is computed on. Only the rough position matters, so a proxy is plenty
+ESTIMATE_IMAGE_SIZE = 64
+# spread of the preference for the middle of the image, as a fraction of its size. Keeps a busy background at the
+# edge from pulling the crop away from a subject in the middle
+CENTER_BIAS_SIGMA = 0.35
+DEFAULT_CENTER = (0.5, 0.5)
+# estimates of image files kept, so a file drawn in many collages is estimated once
+ESTIMATE_CACHE_SIZE = 4096
+
+
+def estimate_center_of_interest(image: np.ndarray) -> tuple:
+    """
+    Estimates where the subject of an image is from the detail in it: edges and texture draw the eye, flat areas
+    such as sky and walls do not. The estimate is the centroid of the gradient energy of a small grayscale version,
+    weighted towards the middle of the image.
+
+    :param image: BGR pixels, any size. The smallest proxy of the image works as well as the image itself
+    :return: (x, y) as fractions of the width and height, DEFAULT_CENTER for an image without any detail
+    """
+    height, width = image.shape[:2]
+    scale = ESTIMATE_IMAGE_SIZE / max(width, height)
+    small_size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    gray_image = cv2.resize(gray_image, small_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    energy = cv2.magnitude(cv2.Sobel(gray_image, cv2.CV_32F, 1, 0), cv2.Sobel(gray_image, cv2.CV_32F, 0, 1))
+    x_positions = (np.arange(small_size[0], dtype=np.float32) + 0.5) / small_size[0]
+    y_positions = (np.arange(small_size[1], dtype=np.float32) + 0.5) / small_size[1]
+    energy *= np.exp(-((y_positions[:, None] - 0.5) ** 2 + (x_positions[None, :] - 0.5) ** 2) /
+                     (2 * CENTER_BIAS_SIGMA ** 2))
+    total_energy = float(energy.sum())
+    if total_energy <= 0:
+        return DEFAULT_CENTER
+    return (float(energy.sum(axis=0) @ x_positions) / total_energy,
+            float(energy.sum(axis=1) @ y_positions) / total_energy)
+
+
+@functools.lru_cache(maxsize=ESTIMATE_CACHE_SIZE)
+def estimate_image_file_center_of_interest(image_path: str, modified_time: float = None):
+    """
+    Estimates the center of interest of an image file from its smallest proxy, see estimate_center_of_interest()
+    :param modified_time: modification time of the file, so an estimate is not reused once the file changes
+    :return: (x, y) as fractions of the width and height, or None if the image could not be read
+    """
+    image = image_decoder.decode_smallest_proxy(image_path)
+    if image is None:
+        return None
+    return estimate_center_of_interest(image)
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import layouts_generator
+from src.layout.container_item import ContainerItem
+from src.layout.image import Image
+from src.layout.layout_container import LayoutContainer
+
+# output_format for collages returned as pixels instead of encoded bytes
+FORMAT_ARRAY = "array"
+DEFAULT_ASYNC_CONCURRENCY = 2
+
+
+class GeneratedCollage:
+    """
+    A finished collage and where it came from. Exactly one of image and encoded is set, depending on the
+    output format that was asked for.
+    """
+
+    def __init__(self, collage_id: int, batch_seed, resolution: str, fingerprint: str, image_paths: list,
+                 render_seconds: float, image=None, encoded: bytes = None, output_format: str = FORMAT_ARRAY):
+        self.collage_id = collage_id
+        self.batch_seed = batch_seed
+        self.resolution = resolution
+        self.fingerprint = fingerprint
+        # source images in the order they are drawn
+        self.image_paths = image_paths
+        self.render_seconds = render_seconds
+        # BGR ndarray when output_format is FORMAT_ARRAY
+        self.image = image
+        # encoded file contents otherwise, e.g. JPEG bytes for ".jpg"
+        self.encoded = encoded
+        self.output_format = output_format
+
+    def get_metadata(self) -> dict:
+        return {"collage_id": self.collage_id, "batch_seed": self.batch_seed, "resolution": self.resolution,
+                "fingerprint": self.fingerprint, "image_paths": self.image_paths,
+                "render_seconds": self.render_seconds, "output_format": self.output_format}
+
+
+def generate_collages(image_directory: str = None, count: int = None, seed=None, resolution: str = "1080p",
+                      output_format: str = ".jpg", first_collage_id: int = 0, dict_of_images: dict = None,
+                      encode_parameters: list = None):
+    """
+    Lazily generates collages. Nothing is planned or drawn until the next collage is asked for, and nothing is
+    written to disk.
+
+    Usage:
+        for collage in collage_api.generate_collages("photos/", count=10, seed=1):
+            display(collage.encoded)
+
+    :param image_directory: directory of source images, scanned once when the first collage is asked for
+    :param count: number of collages, None to keep generating
+    :param seed: batch seed. Collage i of a seed is always the same collage for the same images. None picks one
+    :param resolution: one of layouts_generator.SCREEN_RESOLUTIONS
+    :param output_format: a file extension understood by cv2.imencode (".jpg", ".png", ...) or FORMAT_ARRAY
+    :param first_collage_id: id of the first collage, to continue a sequence that was stopped
+    :param dict_of_images: an already scanned image pool, see create_aspect_ratio_sorted_list_of_images_from_directory
+    :param encode_parameters: passed to cv2.imencode, e.g. [cv2.IMWRITE_JPEG_QUALITY, 90]
+    :return: generator of GeneratedCollage
+    """
+    if seed is None:
+        seed = layouts_generator.new_batch_seed()
+    if dict_of_images is None:
+        dict_of_images = layouts_generator.create_aspect_ratio_sorted_list_of_images_from_directory(image_directory)
+    for collage_id in _get_collage_ids(first_collage_id, count):
+        yield create_collage(collage_id, seed, dict_of_images, resolution, output_format, encode_parameters)
+
+
+async def generate_collages_async(image_directory: str = None, count: int = None, seed=None,
+                                  resolution: str = "1080p", output_format: str = ".jpg", first_collage_id: int = 0,
+                                  dict_of_images: dict = None, encode_parameters: list = None,
+                                  concurrency: int = DEFAULT_ASYNC_CONCURRENCY, executor=None):
+    """
+    Async counterpart of generate_collages(). Scanning, decoding, rendering and encoding run on executor, so the
+    event loop is never blocked.
+
+    At most concurrency collages are in progress at once. Work only starts when the caller asks for collages, so a
+    slow consumer holds back production instead of letting finished collages pile up in memory. Collages are
+    yielded in id order.
+
+    Usage:
+        async for collage in collage_api.generate_collages_async("photos/", seed=1, concurrency=2):
+            await show(collage.encoded)
+
+    :param concurrency: maximum number of collages being generated at once
+    :param executor: where the work runs, defaults to a thread pool of concurrency threads that is shut down
+    when the generator is closed
+    :return: async generator of GeneratedCollage
+    """
+    if seed is None:
+        seed = layouts_generator.new_batch_seed()
+    concurrency = max(int(concurrency), 1)
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="collage")
+    in_flight = collections.deque()
+    try:
+        if dict_of_images is None:
+            dict_of_images = await loop.run_in_executor(
+                executor, layouts_generator.create_aspect_ratio_sorted_list_of_images_from_directory, image_directory)
+        collage_ids = _get_collage_ids(first_collage_id, count)
+        while True:
+            # keep the pipeline filled up to the concurrency limit, then hand out the oldest collage
+            for collage_id in itertools.islice(collage_ids, concurrency - len(in_flight)):
+                in_flight.append(loop.run_in_executor(executor, create_collage, collage_id, seed, dict_of_images,
+                                                      resolution, output_format, encode_parameters))
+            if len(in_flight) == 0:
+                return
+            yield await in_flight.popleft()
+    finally:
+        for future in in_flight:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_collage(collage_id: int, batch_seed, dict_of_images: dict, resolution: str = "1080p",
+                   output_format: str = ".jpg", encode_parameters: list = None) -> GeneratedCollage:
+    """
+    Plans, draws and optionally encodes one collage in memory. Can be called from several threads at once.
+    """
+    start_time = time.perf_counter()
+    main_container = layouts_generator.plan_seeded_collage(batch_seed, collage_id, dict_of_images, resolution)
+    image = layouts_generator.render_collage(main_container)
+    encoded = None
+    if output_format != FORMAT_ARRAY:
+        success, encoded_image = cv2.imencode(output_format, image, encode_parameters or [])
+        if not success:
+            raise Exception(f"Could not encode collage {collage_id} as {output_format}")
+        encoded = encoded_image.tobytes()
+        image = None
+    return GeneratedCollage(collage_id, batch_seed, resolution, main_container.get_fingerprint(),
+                            get_image_paths(main_container), time.perf_counter() - start_time, image, encoded,
+                            output_format)
+
+
+def get_image_paths(item: ContainerItem) -> list:
+    """
+    :return: source paths of the images in item, in drawing order. Images created from pixels are left out
+    """
+    if isinstance(item, Image):
+        return [item.get_source_path()] if item.get_source_path() is not None else []
+    image_paths = []
+    if isinstance(item, LayoutContainer):
+        for child in item.get_items_copy():
+            image_paths.extend(get_image_paths(child))
+    return image_paths
+
+
+def _get_collage_ids(first_collage_id: int, count: int):
+    if count is None:
+        return itertools.count(first_collage_id)
+    return iter(range(first_collage_id, first_collage_id + count))
@@ -0,0 +1,109 @@
+import collections
+import threading
+
+from src import memory_governor
+
+
+class ImageCache:
+    """
+    Least recently used cache of decoded images, shared by every render in a long running process.
+
+    Entries are keyed by (image path, modification time, decode scale), so an image that changes on disk is never
+    served stale and the same file can be cached at several decode scales. A render that needs a 1/4 scale proxy
+    can be served by any cached decode at 1/4 scale or larger.
+
+    Cached arrays are registered with the memory governor as CATEGORY_CACHE. Evicted arrays are released as soon
+    as the renders still using them are done.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self._capacity_bytes = max(int(capacity_bytes), 0)
+        self._lock = threading.Lock()
+        # (image_path, modified_time, scale) -> ndarray, least recently used first
+        self._entries = collections.OrderedDict()
+        self._usage_bytes = 0
+        self._hit_count = 0
+        self._miss_count = 0
+        self._eviction_count = 0
+
+    def get(self, image_path: str, modified_time: float, maximum_scale: int = 1):
+        """
+        Finds the smallest cached decode that is at least as large as a decode at maximum_scale
+        :param maximum_scale: one of memory_governor.DECODE_SCALES, the largest reduction the caller accepts
+        :return: (scale, image), or None on a miss
+        """
+        with self._lock:
+            for scale in reversed(memory_governor.DECODE_SCALES):
+                if scale > maximum_scale:
+                    continue
+                key = (image_path, modified_time, scale)
+                image = self._entries.get(key)
+                if image is not None:
+                    self._entries.move_to_end(key)
+                    self._hit_count += 1
+                    return scale, image
+            self._miss_count += 1
+            return None
+
+    def get_smallest(self, image_path: str, modified_time: float):
+        """
+        Finds the smallest cached decode of an image at any scale, without counting a hit or a miss
+        :return: (scale, image), or None if the image is not cached
+        """
+        with self._lock:
+            for scale in reversed(memory_governor.DECODE_SCALES):
+                image = self._entries.get((image_path, modified_time, scale))
+                if image is not None:
+                    return scale, image
+            return None
+
+    def put(self, image_path: str, modified_time: float, scale: int, image):
+        """
+        Adds a decoded image and evicts the least recently used entries until the cache fits its capacity.
+        Images larger than the whole capacity are not cached.
+        """
+        if image is None or image.nbytes > self._capacity_bytes:
+            return
+        # cached pixels are shared between renders, so nothing may draw on them
+        image.flags.writeable = False
+        key = (image_path, modified_time, scale)
+        with self._lock:
+            old_image = self._entries.pop(key, None)
+            if old_image is not None:
+                self._usage_bytes -= old_image.nbytes
+            self._entries[key] = image
+            self._usage_bytes += image.nbytes
+            while self._usage_bytes > self._capacity_bytes:
+                evicted_key, evicted_image = self._entries.popitem(last=False)
+                self._usage_bytes -= evicted_image.nbytes
+                self._eviction_count += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usage_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity_bytes": self._capacity_bytes,
+                "usage_bytes": self._usage_bytes,
+                "entries": len(self._entries),
+                "hit_count": self._hit_count,
+                "miss_count": self._miss_count,
+                "eviction_count": self._eviction_count,
+            }
+
+
+# cache used by image_decoder.decode_image(). None (the default) disables caching, which suits batch runs where
+# every image is used once
+_active_cache = None
+
+
+def get_active_cache():
+    return _active_cache
+
+
+def set_active_cache(cache: ImageCache):
+    global _active_cache
+    _active_cache = cache
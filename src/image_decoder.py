@@ -0,0 +1,179 @@
+import os
+
+import cv2
+import numpy as ns
+
+from src import image_cache, image_header, instrumentation, memory_governor
+
+# cv2.imread flags for each decode scale in memory_governor.DECODE_SCALES
+DECODE_SCALE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# EXIF orientation -> cv2 operations that turn the stored pixels upright, in order. Rotations are by 90 degrees
+# and flips use the cv2.flip codes (0 vertical, 1 horizontal, -1 both)
+ORIENTATION_OPERATIONS = {
+    2: (("flip", 1),),
+    3: (("flip", -1),),
+    4: (("flip", 0),),
+    5: (("transpose", None),),
+    6: (("transpose", None), ("flip", 1)),
+    7: (("transpose", None), ("flip", -1)),
+    8: (("transpose", None), ("flip", 0)),
+}
+
+
+def decode_image(image_path: str, minimum_scale: int = 1, source_size: tuple = None, orientation: int = None):
+    """
+    Decodes an image file into a BGR ndarray registered with the memory governor.
+
+    When the caller only needs a smaller image, minimum_scale lets cv2 decode at 1/2, 1/4 or 1/8 of the size
+    which for JPEG skips most of the decoding work. When the governor has a ceiling, the scale can be lowered further
+    to stay under it.
+    When an image cache is active, decodes are looked up in and added to it.
+    The returned pixels are always upright. When the EXIF orientation is known from the header, it is applied here
+    after the reduced decode, so rotating costs a fraction of rotating the full size image.
+
+    :param image_path: path to the image file
+    :param minimum_scale: one of memory_governor.DECODE_SCALES, the smallest reduction that is acceptable
+    :param source_size: (width, height) of the file when already known, saves reading the header again
+    :param orientation: EXIF orientation from image_header.read_image_header(), None to leave it to cv2
+    :return: ndarray, or None if the file could not be decoded
+    """
+    cache = image_cache.get_active_cache()
+    modified_time = None
+    if cache is not None:
+        # any cached decode at minimum_scale or larger will do, the caller resizes it to the final size anyway
+        try:
+            modified_time = os.path.getmtime(image_path)
+        except OSError:
+            return None
+        cached_image = cache.get(image_path, modified_time, minimum_scale)
+        if cached_image is not None:
+            return cached_image[1]
+
+    governor = memory_governor.get_default_governor()
+    decode_scale = minimum_scale
+    # bytes the governor holds for this decode until the decoded image is tracked
+    reserved_bytes = 0
+    if governor.get_ceiling() > 0:
+        # spill to a reduced decode when decoding at full size would go over the memory ceiling.
+        # the header is read first so the decision is made without decoding anything
+        if source_size is None:
+            source_size = image_header.read_image_dimensions(image_path)
+        if source_size is not None:
+            decode_scale = governor.choose_decode_scale(source_size[0], source_size[1], minimum_scale=minimum_scale)
+            reserved_bytes = memory_governor.get_decoded_size(source_size[0], source_size[1], decode_scale)
+    try:
+        with instrumentation.stage(instrumentation.STAGE_DECODE):
+            if orientation is None:
+                image = cv2.imread(image_path, DECODE_SCALE_FLAGS[decode_scale])
+            else:
+                # skip cv2 parsing the EXIF data a second time
+                image = apply_orientation(cv2.imread(image_path, DECODE_SCALE_FLAGS[decode_scale] |
+                                                     cv2.IMREAD_IGNORE_ORIENTATION), orientation)
+        if image is not None and instrumentation.is_enabled():
+            instrumentation.add_counter(instrumentation.COUNTER_IMAGES_DECODED)
+            instrumentation.add_counter(instrumentation.COUNTER_BYTES_READ, get_file_size(image_path))
+    except BaseException:
+        governor.release_reservation(reserved_bytes)
+        raise
+    if cache is None:
+        return governor.track(image, memory_governor.CATEGORY_IMAGE, reserved_bytes)
+    # stored under the scale it was actually decoded at, which can be smaller than asked for after a spill
+    cache.put(image_path, modified_time, decode_scale, image)
+    return governor.track(image, memory_governor.CATEGORY_CACHE, reserved_bytes)
+
+
+def get_file_size(image_path: str) -> int:
+    """
+    :return: size of the file in bytes, 0 if it is gone, e.g. removed since it was decoded
+    """
+    try:
+        return os.path.getsize(image_path)
+    except OSError:
+        return 0
+
+
+def decode_smallest_proxy(image_path: str):
+    """
+    Decodes the cheapest version of an image that still shows its content: the EXIF thumbnail when there is one,
+    otherwise a 1/8 scale decode. Meant for looking at every image of a library, e.g. to hash or describe it
+    :return: upright ndarray, or None if the image could not be read
+    """
+    header = image_header.read_image_header(image_path)
+    image = None
+    if header is not None and header.thumbnail is not None:
+        image = decode_exif_thumbnail(image_path, header.thumbnail, header.orientation)
+    if image is None:
+        image = decode_image(image_path, memory_governor.DECODE_SCALES[-1], None,
+                             header.orientation if header is not None else None)
+    return image
+
+
+def decode_exif_thumbnail(image_path: str, thumbnail, orientation: int = None):
+    """
+    Decodes the JPEG thumbnail embedded in the EXIF data of an image, which only reads a few kilobytes of the file.
+    The thumbnail is turned upright and cropped to the aspect ratio of the image, so it can stand in for the image
+    wherever it is drawn at thumbnail size or smaller.
+
+    :param thumbnail: image_header.ExifThumbnail from the header of the image
+    :param orientation: EXIF orientation of the image, which the thumbnail shares
+    :return: ndarray of thumbnail.width x thumbnail.height, or None if the thumbnail could not be decoded
+    """
+    try:
+        with open(image_path, "rb") as file:
+            file.seek(thumbnail.offset)
+            thumbnail_data = file.read(thumbnail.length)
+    except OSError:
+        return None
+    if len(thumbnail_data) != thumbnail.length:
+        # the file was truncated since its header was read
+        return None
+    with instrumentation.stage(instrumentation.STAGE_DECODE):
+        try:
+            image = cv2.imdecode(ns.frombuffer(thumbnail_data, ns.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            return None
+        image = apply_orientation(image, orientation)
+    if image is None:
+        return None
+    x, y, width, height = image_header.get_thumbnail_crop(image.shape[1], image.shape[0], thumbnail.width,
+                                                          thumbnail.height)
+    if (width, height) != (thumbnail.width, thumbnail.height):
+        # the header does not describe this thumbnail, e.g. the file was rewritten since
+        return None
+    if instrumentation.is_enabled():
+        instrumentation.add_counter(instrumentation.COUNTER_IMAGES_DECODED)
+        instrumentation.add_counter(instrumentation.COUNTER_BYTES_READ, len(thumbnail_data))
+    image = ns.ascontiguousarray(image[y:y + height, x:x + width])
+    return memory_governor.get_default_governor().track(image, memory_governor.CATEGORY_IMAGE)
+
+
+def apply_orientation(image, orientation: int):
+    """
+    Turns pixels stored with the given EXIF orientation upright
+    :return: the upright pixels, image itself for orientation 1 or None
+    """
+    if image is None:
+        return None
+    for operation, flip_code in ORIENTATION_OPERATIONS.get(orientation, ()):
+        image = cv2.transpose(image) if operation == "transpose" else cv2.flip(image, flip_code)
+    return image
+
+
+def get_decode_scale_for_target(source_width: int, source_height: int, target_width: int, target_height: int) -> int:
+    """
+    Finds the largest reduction that still decodes to at least the target size, so the image is only ever
+    scaled down afterwards and no detail is lost.
+
+    :return: one of memory_governor.DECODE_SCALES
+    """
+    chosen_scale = 1
+    for scale in memory_governor.DECODE_SCALES:
+        if source_width // scale >= target_width and source_height // scale >= target_height:
+            chosen_scale = scale
+    return chosen_scale
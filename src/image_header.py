@@ -0,0 +1,253 @@
+import io
+import struct
+from collections import namedtuple
+
+# reading the first few kilobytes of a file is enough to find the dimensions for the supported formats.
+# this lets us learn the size of an image without paying for a full decode
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOI_MARKER = b"\xff\xd8"
+
+# JPEG start of frame markers that carry the image dimensions. 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the
+# range but are not frame headers
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# markers that are not followed by a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+# APP1 segments starting with this carry EXIF data in TIFF layout
+JPEG_APP1_MARKER = 0xE1
+EXIF_SIGNATURE = b"Exif\x00\x00"
+
+# EXIF orientation values. 1 is stored upright, 5 to 8 are stored with width and height swapped
+ORIENTATION_NORMAL = 1
+ORIENTATIONS_SWAPPING_DIMENSIONS = {5, 6, 7, 8}
+
+# TIFF tags read from the EXIF data
+EXIF_TAG_MAKE = 0x010F
+EXIF_TAG_MODEL = 0x0110
+EXIF_TAG_ORIENTATION = 0x0112
+EXIF_TAG_DATE_TIME = 0x0132
+EXIF_TAG_EXIF_IFD = 0x8769
+EXIF_TAG_DATE_TIME_ORIGINAL = 0x9003
+# in IFD1, where the embedded thumbnail is described
+EXIF_TAG_THUMBNAIL_OFFSET = 0x0201
+EXIF_TAG_THUMBNAIL_LENGTH = 0x0202
+
+# TIFF field types: byte size of one value of each type that is read
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 7: 1}
+TIFF_TYPE_ASCII = 2
+TIFF_TYPE_SHORT = 3
+TIFF_TYPE_LONG = 4
+
+# what the header tells about an image. width and height are the size the image is displayed at, i.e. with the
+# EXIF orientation applied, so they match what cv2.imread returns. orientation is the EXIF value (1 to 8), or None
+# when it is unknown. capture_time is the EXIF date time ("YYYY:MM:DD HH:MM:SS"), camera_make and camera_model are
+# as written by the camera, thumbnail is an ExifThumbnail. Fields that are not in the file are None
+ImageHeader = namedtuple("ImageHeader", ["width", "height", "orientation", "capture_time", "camera_make",
+                                         "camera_model", "thumbnail"], defaults=(ORIENTATION_NORMAL, None, None, None,
+                                                                                 None))
+
+# JPEG thumbnail embedded in the EXIF data, usually 160x120. offset and length locate its bytes in the image file.
+# width and height are the upright size of the thumbnail once cropped to the aspect ratio of the image, since
+# cameras letterbox thumbnails of images that are not 4:3
+ExifThumbnail = namedtuple("ExifThumbnail", ["offset", "length", "width", "height"])
+
+
+def read_image_dimensions(image_path: str):
+    """
+    Reads the width and height of an image from its file header without decoding the pixel data.
+    Supports PNG and JPEG (baseline and progressive). The EXIF orientation is taken into account, so a portrait
+    photo stored sideways is reported as portrait.
+
+    :param image_path: path to the image file
+    :return: a tuple of (width, height), or None if the file is not a supported format or is malformed
+    """
+    header = read_image_header(image_path)
+    if header is None:
+        return None
+    return header.width, header.height
+
+
+def read_image_header(image_path: str):
+    """
+    Reads the size, EXIF orientation, capture time and camera of an image without decoding the pixel data.
+    For JPEG the EXIF segment sits in front of the frame header, so this reads no further into the file than
+    read_image_dimensions() did.
+
+    :param image_path: path to the image file
+    :return: ImageHeader, or None if the file is not a supported format or is malformed
+    """
+    try:
+        with open(image_path, "rb") as file:
+            signature = file.read(8)
+            if signature == PNG_SIGNATURE:
+                dimensions = _read_png_dimensions(file)
+                return ImageHeader(*dimensions) if dimensions is not None else None
+            elif signature[:2] == JPEG_SOI_MARKER:
+                file.seek(2)
+                return _read_jpeg_header(file)
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def get_oriented_dimensions(width: int, height: int, orientation) -> tuple:
+    """
+    Converts the size an image is stored at in the file to the size it is displayed at with the given EXIF
+    orientation. The same swap converts back
+    """
+    if orientation in ORIENTATIONS_SWAPPING_DIMENSIONS:
+        return height, width
+    return width, height
+
+
+def _read_png_dimensions(file):
+    # the IHDR chunk is always the first chunk: 4 bytes length, 4 bytes type, then width and height
+    chunk_header = file.read(16)
+    if len(chunk_header) < 16 or chunk_header[4:8] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", chunk_header[8:16])
+    return int(width), int(height)
+
+
+def _read_jpeg_header(file):
+    # walk the marker segments until a start of frame segment is found, picking up the EXIF segment on the way
+    exif_tags = {}
+    # (file offset, TIFF data) of the EXIF segment, kept until the image size is known to place the thumbnail
+    exif_thumbnail_data = None
+    while True:
+        marker_prefix = file.read(1)
+        if len(marker_prefix) == 0:
+            return None
+        if marker_prefix != b"\xff":
+            continue
+        marker = file.read(1)
+        # skip fill bytes
+        while marker == b"\xff":
+            marker = file.read(1)
+        if len(marker) == 0:
+            return None
+        marker_value = marker[0]
+        if marker_value in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker_value == 0xD9 or marker_value == 0xDA:
+            # end of image or start of scan reached before any frame header
+            return None
+        segment_length = struct.unpack(">H", file.read(2))[0]
+        if marker_value in JPEG_SOF_MARKERS:
+            # segment: precision (1 byte), height (2 bytes), width (2 bytes)
+            precision_height_width = file.read(5)
+            height, width = struct.unpack(">HH", precision_height_width[1:5])
+            orientation = exif_tags.get(EXIF_TAG_ORIENTATION, ORIENTATION_NORMAL)
+            if orientation not in range(1, 9):
+                orientation = ORIENTATION_NORMAL
+            width, height = get_oriented_dimensions(int(width), int(height), orientation)
+            thumbnail = None
+            if exif_thumbnail_data is not None:
+                thumbnail = _read_exif_thumbnail(exif_thumbnail_data, exif_tags, orientation, width, height)
+            return ImageHeader(width, height, orientation,
+                               exif_tags.get(EXIF_TAG_DATE_TIME_ORIGINAL, exif_tags.get(EXIF_TAG_DATE_TIME)),
+                               exif_tags.get(EXIF_TAG_MAKE), exif_tags.get(EXIF_TAG_MODEL), thumbnail)
+        if marker_value == JPEG_APP1_MARKER and len(exif_tags) == 0:
+            segment_offset = file.tell()
+            segment = file.read(segment_length - 2)
+            if segment[:6] == EXIF_SIGNATURE:
+                exif_tags = _read_exif_tags(segment[6:])
+                # offsets in the EXIF data count from the start of the TIFF data, right after the signature
+                exif_thumbnail_data = (segment_offset + 6, segment[6:])
+            continue
+        file.seek(segment_length - 2, 1)
+
+
+def _read_exif_tags(tiff_data: bytes) -> dict:
+    """
+    Reads the tags of IFD0 and of the EXIF IFD, and where the thumbnail is from IFD1, from EXIF data in TIFF layout.
+    Malformed EXIF data is ignored, the image is still usable without it.
+    :return: tag -> value, ASCII values as str and numbers as int
+    """
+    try:
+        byte_order = {b"II": "<", b"MM": ">"}[tiff_data[:2]]
+        ifd0_offset = struct.unpack(byte_order + "I", tiff_data[4:8])[0]
+        tags, ifd1_offset = _read_ifd(tiff_data, byte_order, ifd0_offset)
+        exif_ifd_offset = tags.pop(EXIF_TAG_EXIF_IFD, None)
+        if exif_ifd_offset is not None:
+            tags.update(_read_ifd(tiff_data, byte_order, exif_ifd_offset)[0])
+        if ifd1_offset != 0:
+            # IFD1 repeats tags such as the resolution for the thumbnail, only its location is of interest
+            ifd1_tags = _read_ifd(tiff_data, byte_order, ifd1_offset)[0]
+            for tag in (EXIF_TAG_THUMBNAIL_OFFSET, EXIF_TAG_THUMBNAIL_LENGTH):
+                if tag in ifd1_tags:
+                    tags[tag] = ifd1_tags[tag]
+        return tags
+    except (KeyError, struct.error):
+        return {}
+
+
+def _read_exif_thumbnail(exif_thumbnail_data: tuple, exif_tags: dict, orientation: int, image_width: int,
+                         image_height: int):
+    """
+    Locates the embedded thumbnail and reads its size from its own frame header, which is already in memory
+    :return: ExifThumbnail, or None if there is no usable thumbnail
+    """
+    tiff_offset, tiff_data = exif_thumbnail_data
+    thumbnail_offset = exif_tags.get(EXIF_TAG_THUMBNAIL_OFFSET)
+    thumbnail_length = exif_tags.get(EXIF_TAG_THUMBNAIL_LENGTH)
+    if thumbnail_offset is None or thumbnail_length is None:
+        return None
+    thumbnail_data = tiff_data[thumbnail_offset:thumbnail_offset + thumbnail_length]
+    if len(thumbnail_data) != thumbnail_length or thumbnail_data[:2] != JPEG_SOI_MARKER:
+        return None
+    try:
+        thumbnail_header = _read_jpeg_header(io.BytesIO(thumbnail_data[2:]))
+    except struct.error:
+        return None
+    if thumbnail_header is None:
+        return None
+    # the thumbnail is stored the same way round as the image
+    width, height = get_oriented_dimensions(thumbnail_header.width, thumbnail_header.height, orientation)
+    width, height = get_thumbnail_crop(width, height, image_width, image_height)[2:]
+    if width == 0 or height == 0:
+        return None
+    return ExifThumbnail(tiff_offset + thumbnail_offset, thumbnail_length, width, height)
+
+
+def get_thumbnail_crop(thumbnail_width: int, thumbnail_height: int, image_width: int, image_height: int) -> tuple:
+    """
+    Finds the centered part of an upright thumbnail with the aspect ratio of its image, which leaves out the bars
+    of letterboxed thumbnails
+    :return: (x, y, width, height) of the part to keep
+    """
+    aspect_ratio = image_width / image_height
+    if thumbnail_width / thumbnail_height > aspect_ratio:
+        width, height = min(round(thumbnail_height * aspect_ratio), thumbnail_width), thumbnail_height
+    else:
+        width, height = thumbnail_width, min(round(thumbnail_width / aspect_ratio), thumbnail_height)
+    return (thumbnail_width - width) // 2, (thumbnail_height - height) // 2, width, height
+
+
+def _read_ifd(tiff_data: bytes, byte_order: str, offset: int) -> tuple:
+    """
+    :return: (tag -> value, offset of the next IFD or 0)
+    """
+    tags = {}
+    entry_count = struct.unpack(byte_order + "H", tiff_data[offset:offset + 2])[0]
+    for entry_offset in range(offset + 2, offset + 2 + 12 * entry_count, 12):
+        tag, field_type, count = struct.unpack(byte_order + "HHI", tiff_data[entry_offset:entry_offset + 8])
+        if field_type not in TIFF_TYPE_SIZES:
+            continue
+        value_size = TIFF_TYPE_SIZES[field_type] * count
+        value_offset = entry_offset + 8
+        if value_size > 4:
+            # values that do not fit the entry are stored elsewhere, the entry holds their offset
+            value_offset = struct.unpack(byte_order + "I", tiff_data[value_offset:value_offset + 4])[0]
+        value = tiff_data[value_offset:value_offset + value_size]
+        if field_type == TIFF_TYPE_ASCII:
+            tags[tag] = value.split(b"\x00")[0].decode("ascii", "replace").strip() or None
+        elif field_type == TIFF_TYPE_SHORT:
+            tags[tag] = struct.unpack(byte_order + "H", value[:2])[0]
+        elif field_type == TIFF_TYPE_LONG:
+            tags[tag] = struct.unpack(byte_order + "I", value[:4])[0]
+    next_ifd_offset_position = offset + 2 + 12 * entry_count
+    next_ifd_offset = tiff_data[next_ifd_offset_position:next_ifd_offset_position + 4]
+    # some writers end the last IFD without the offset
+    return tags, struct.unpack(byte_order + "I", next_ifd_offset)[0] if len(next_ifd_offset) == 4 else 0
@@ -0,0 +1,211 @@
+import bisect
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src import image_ingestor, perceptual_hash
+
+# directories modified this recently are listed again on the next refresh, since a change made within the same
+# timestamp tick as the listing would not move the modification time
+RACY_DIRECTORY_SECONDS = 2.0
+
+# image paths that changed in one refresh
+IndexChanges = namedtuple("IndexChanges", ["added", "removed", "modified"])
+
+
+class AspectRatioIndex:
+    """
+    In memory index of the images under a directory, grouped by aspect ratio key and kept sorted by path.
+    The header of every image (upright size, EXIF orientation, capture time and camera) is kept as well.
+
+    refresh() brings the index up to date by comparing a snapshot of directory modification times with the last one.
+    Only directories whose modification time moved are listed again, and only files that are new or whose
+    modification time or size changed in those directories have their header read. A refresh therefore costs one
+    stat per directory plus work proportional to the change, instead of a full rescan of the library.
+
+    Adding, removing or renaming a file always moves the modification time of its directory. Files rewritten in
+    place (without a rename) are picked up the next time their directory is listed.
+    """
+
+    def __init__(self, directory: str, supported_extensions: set, aspect_ratio_keys, get_aspect_ratio_key,
+                 probe_threads: int = image_ingestor.DEFAULT_PROBE_THREADS,
+                 hash_index: perceptual_hash.PerceptualHashIndex = None):
+        """
+        :param directory: root directory of the library
+        :param supported_extensions: lower case file extensions without the dot
+        :param aspect_ratio_keys: keys of the index, images are grouped under these
+        :param get_aspect_ratio_key: function (width, height) -> one of aspect_ratio_keys, or None to leave the
+        image out of the index
+        :param probe_threads: number of image headers read at once
+        :param hash_index: when given, the perceptual hashes of the indexed images are kept up to date in it
+        """
+        self._directory = directory
+        self._supported_extensions = supported_extensions
+        self._get_aspect_ratio_key = get_aspect_ratio_key
+        self._probe_threads = probe_threads
+        self._hash_index = hash_index
+        # directory path -> modification time in ns when it was last listed, None to list it again next refresh
+        self._directory_modified_times = {}
+        # directory path -> {file name: (modification time in ns, size, aspect ratio key, image header)} of the
+        # images in it. unreadable images are kept with a None key so they are not probed again until they change
+        self._files_by_directory = {}
+        # aspect ratio key -> sorted list of image paths
+        self._image_paths_by_aspect_ratio = {key: [] for key in aspect_ratio_keys}
+
+    def get_directory(self) -> str:
+        return self._directory
+
+    def get_hash_index(self):
+        """
+        :return: the perceptual_hash.PerceptualHashIndex kept up to date with this index, or None
+        """
+        return self._hash_index
+
+    def get_image_count(self) -> int:
+        return sum(len(image_paths) for image_paths in self._image_paths_by_aspect_ratio.values())
+
+    def get_image_paths_by_aspect_ratio(self) -> dict:
+        """
+        :return: a copy of the index in the format of create_aspect_ratio_sorted_list_of_images_from_directory()
+        """
+        return {key: list(image_paths) for key, image_paths in self._image_paths_by_aspect_ratio.items()}
+
+    def get_image_header(self, image_path: str):
+        """
+        :return: image_header.ImageHeader of an indexed image, or None if the image is not in the index or could
+        not be read
+        """
+        directory, file_name = os.path.split(image_path)
+        files = self._files_by_directory.get(directory)
+        if files is None:
+            # the root directory is kept as it was given, which can end with a separator
+            files = self._files_by_directory.get(directory + os.sep, {})
+        indexed_file = files.get(file_name)
+        return indexed_file[3] if indexed_file is not None else None
+
+    def refresh(self) -> IndexChanges:
+        """
+        Applies the files that were added, removed or modified since the last refresh. The first refresh builds the
+        index from scratch.
+        :return: the changed image paths
+        """
+        changes = IndexChanges([], [], [])
+        scan_time = time.time()
+        if len(self._directory_modified_times) == 0:
+            directories_to_list = [self._directory]
+        else:
+            directories_to_list = self._find_changed_directories(changes)
+
+        # (directory, file name, image path) of the new and modified images
+        files_to_probe = []
+        while len(directories_to_list) > 0:
+            directory = directories_to_list.pop()
+            directories_to_list.extend(self._list_directory(directory, scan_time, changes, files_to_probe))
+
+        # read the headers of the new and modified files concurrently
+        with ThreadPoolExecutor(max_workers=self._probe_threads) as executor:
+            probed_images = executor.map(image_ingestor.probe_image_header,
+                                         (image_path for _, _, image_path in files_to_probe))
+            for (directory, file_name, _), (image_path, header) in zip(files_to_probe, probed_images):
+                modified_time, size, aspect_ratio_key, _ = self._files_by_directory[directory][file_name]
+                if header is not None:
+                    aspect_ratio_key = self._get_aspect_ratio_key(header.width, header.height)
+                self._files_by_directory[directory][file_name] = (modified_time, size, aspect_ratio_key, header)
+                self._add_image_path(image_path, aspect_ratio_key)
+            if self._hash_index is not None:
+                self._update_hashes(executor, changes)
+        return changes
+
+    def _update_hashes(self, executor: ThreadPoolExecutor, changes: IndexChanges):
+        for image_path in changes.removed + changes.modified:
+            self._hash_index.remove(image_path)
+        # unreadable images have no header and are not hashed
+        image_paths = [image_path for image_path in changes.added + changes.modified
+                       if self.get_image_header(image_path) is not None]
+        for image_path, image_hash in zip(image_paths, executor.map(perceptual_hash.hash_image_file, image_paths)):
+            if image_hash is not None:
+                self._hash_index.add(image_path, image_hash)
+
+    def _find_changed_directories(self, changes: IndexChanges) -> list:
+        # one stat per known directory. Directories that are gone are dropped with all their images,
+        # their subdirectories fail the stat as well and are dropped in the same pass
+        changed_directories = []
+        for directory, last_modified_time in list(self._directory_modified_times.items()):
+            try:
+                modified_time = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._remove_directory(directory, changes)
+                continue
+            if modified_time != last_modified_time:
+                changed_directories.append(directory)
+        return changed_directories
+
+    def _list_directory(self, directory: str, scan_time: float, changes: IndexChanges, files_to_probe: list) -> list:
+        """
+        Compares the images in a directory with the index and queues new and modified ones for probing.
+        :return: subdirectories that are not in the index yet
+        """
+        try:
+            modified_time = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            self._remove_directory(directory, changes)
+            return []
+        # a directory changed right before it was listed may change again within the same timestamp tick
+        is_racy = scan_time - modified_time / 1e9 < RACY_DIRECTORY_SECONDS
+        self._directory_modified_times[directory] = None if is_racy else modified_time
+
+        new_directories = []
+        old_files = self._files_by_directory.get(directory, {})
+        current_files = {}
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in self._directory_modified_times:
+                        new_directories.append(entry.path)
+                    continue
+                if entry.name.rpartition(".")[2].lower() not in self._supported_extensions or not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # removed between the listing and the stat
+                continue
+            old_file = old_files.get(entry.name)
+            if old_file is not None and old_file[0] == stat.st_mtime_ns and old_file[1] == stat.st_size:
+                current_files[entry.name] = old_file
+                continue
+            if old_file is None:
+                changes.added.append(entry.path)
+            else:
+                changes.modified.append(entry.path)
+                self._remove_image_path(entry.path, old_file[2])
+            current_files[entry.name] = (stat.st_mtime_ns, stat.st_size, None, None)
+            files_to_probe.append((directory, entry.name, entry.path))
+
+        for file_name, old_file in old_files.items():
+            if file_name not in current_files:
+                image_path = os.path.join(directory, file_name)
+                changes.removed.append(image_path)
+                self._remove_image_path(image_path, old_file[2])
+        self._files_by_directory[directory] = current_files
+        return new_directories
+
+    def _remove_directory(self, directory: str, changes: IndexChanges):
+        for file_name, old_file in self._files_by_directory.pop(directory, {}).items():
+            image_path = os.path.join(directory, file_name)
+            changes.removed.append(image_path)
+            self._remove_image_path(image_path, old_file[2])
+        self._directory_modified_times.pop(directory, None)
+
+    def _add_image_path(self, image_path: str, aspect_ratio_key):
+        if aspect_ratio_key is not None:
+            bisect.insort(self._image_paths_by_aspect_ratio[aspect_ratio_key], image_path)
+
+    def _remove_image_path(self, image_path: str, aspect_ratio_key):
+        if aspect_ratio_key is None:
+            return
+        image_paths = self._image_paths_by_aspect_ratio[aspect_ratio_key]
+        position = bisect.bisect_left(image_paths, image_path)
+        if position < len(image_paths) and image_paths[position] == image_path:
+            del image_paths[position]
@@ -0,0 +1,136 @@
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from src import image_decoder, image_header
+
+DEFAULT_WALKER_THREADS = 4
+DEFAULT_PROBE_THREADS = 8
+# upper bound of paths found but not yet consumed, keeps memory flat no matter how large the library is
+DEFAULT_MAX_PENDING_FILES = 1024
+
+# marks the end of the walk in the file queue
+_WALK_DONE = object()
+# how often blocked walker threads check whether the consumer has stopped
+_STOP_POLL_SECONDS = 0.1
+
+
+def iter_image_files(directory: str, supported_extensions: set, walker_threads: int = DEFAULT_WALKER_THREADS,
+                     max_pending_files: int = DEFAULT_MAX_PENDING_FILES):
+    """
+    Lazily yields the path of every image file under directory, recursing into subdirectories.
+
+    Directories are listed with os.scandir by several walker threads at once, which hides the latency of
+    network mounts where every listing is a round trip. Paths are handed over through a bounded queue, so walkers
+    pause when the consumer falls behind. The order of the paths is not defined.
+
+    :param directory: root directory of the library
+    :param supported_extensions: lower case file extensions without the dot
+    :param walker_threads: number of directories listed concurrently
+    :param max_pending_files: maximum number of paths waiting to be consumed
+    """
+    directories = queue.Queue()
+    files = queue.Queue(maxsize=max_pending_files)
+    directories.put(directory)
+    # number of directories queued or being listed. The walk is over when it drops to 0
+    pending_directories = [1]
+    lock = threading.Lock()
+
+    # set when the consumer stops early (break, exception, garbage collection), so walkers blocked on a full
+    # queue exit instead of waiting forever
+    stopped = threading.Event()
+
+    def put_file(path) -> bool:
+        while not stopped.is_set():
+            try:
+                files.put(path, timeout=_STOP_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def walk():
+        while not stopped.is_set():
+            try:
+                current_directory = directories.get(timeout=_STOP_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if current_directory is None:
+                return
+            try:
+                with os.scandir(current_directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            with lock:
+                                pending_directories[0] += 1
+                            directories.put(entry.path)
+                        elif entry.name.rpartition(".")[2].lower() in supported_extensions and entry.is_file():
+                            if not put_file(entry.path):
+                                return
+            except OSError:
+                # unreadable directories are skipped like os.walk does
+                pass
+            with lock:
+                pending_directories[0] -= 1
+                walk_done = pending_directories[0] == 0
+            if walk_done:
+                for i in range(walker_threads):
+                    directories.put(None)
+                put_file(_WALK_DONE)
+
+    for i in range(walker_threads):
+        threading.Thread(target=walk, daemon=True).start()
+
+    try:
+        while True:
+            path = files.get()
+            if path is _WALK_DONE:
+                return
+            yield path
+    finally:
+        stopped.set()
+
+
+def probe_image(image_path: str):
+    """
+    Finds the size of an image from its header. Files with a header that cannot be parsed are decoded at 1/8 scale,
+    which is enough to get the aspect ratio.
+    :return: (image_path, (width, height)), with None instead of the size if the file is not a readable image
+    """
+    header = probe_image_header(image_path)[1]
+    return image_path, (header.width, header.height) if header is not None else None
+
+
+def probe_image_header(image_path: str):
+    """
+    Like probe_image(), but also returns the EXIF orientation, capture time and camera found in the header.
+    Images whose size had to be found by decoding have an unknown (None) orientation.
+    :return: (image_path, image_header.ImageHeader), with None instead of the header if the file is not a
+    readable image
+    """
+    header = image_header.read_image_header(image_path)
+    if header is None:
+        image = image_decoder.decode_image(image_path, 8)
+        if image is not None:
+            header = image_header.ImageHeader(image.shape[1], image.shape[0], None)
+    return image_path, header
+
+
+def iter_probed_images(directory: str, supported_extensions: set, walker_threads: int = DEFAULT_WALKER_THREADS,
+                       probe_threads: int = DEFAULT_PROBE_THREADS):
+    """
+    Lazily yields (image_path, (width, height)) for every image under directory. Header probes run concurrently
+    with the directory walk, with at most a few probes per thread in flight.
+    Unreadable images are yielded with None as the size.
+    """
+    max_in_flight = probe_threads * 4
+    with ThreadPoolExecutor(max_workers=probe_threads) as executor:
+        in_flight = collections.deque()
+        for image_path in iter_image_files(directory, supported_extensions, walker_threads):
+            in_flight.append(executor.submit(probe_image, image_path))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while len(in_flight) > 0:
+            yield in_flight.popleft().result()
@@ -0,0 +1,260 @@
+import json
+import math
+import os
+import threading
+import time
+
+# stage names used across the pipeline
+STAGE_SCAN = "scan"
+STAGE_LAYOUT = "layout"
+STAGE_POPULATE = "populate"
+STAGE_DECODE = "decode"
+STAGE_RESIZE = "resize"
+STAGE_FILTER = "filter"
+STAGE_COMPOSITE = "composite"
+STAGE_ENCODE = "encode"
+
+# counter names used across the pipeline
+COUNTER_IMAGES_DECODED = "images_decoded"
+COUNTER_BYTES_READ = "bytes_read"
+COUNTER_BYTES_WRITTEN = "bytes_written"
+
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "frame_collage"
+
+
+class _NullStage:
+    """Context manager that does nothing. Returned by stage() while instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _StageTimer:
+    def __init__(self, instrumentation, name: str):
+        self._instrumentation = instrumentation
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._outermost = self._instrumentation._enter_stage(self._name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        self._instrumentation._exit_stage(self._name, elapsed, self._outermost)
+        return False
+
+
+class Instrumentation:
+    """
+    Collects wall time per pipeline stage and counters per collage.
+
+    Stages can nest (e.g. composite inside composite when drawing child containers), only the outermost
+    occurrence of a stage on each thread is timed so the time is never counted twice.
+
+    Each finished collage can be written as one JSON line, and a Prometheus text file summary with
+    p50 / p95 / p99 per stage and throughput can be written at any point.
+    """
+
+    def __init__(self, json_lines_path: str = None):
+        self._json_lines_path = json_lines_path
+        self._lock = threading.Lock()
+        self._thread_state = threading.local()
+        # stage totals / counters of the collage being generated. Top level stages outside of a collage
+        # (e.g. scan) are recorded as their own sample
+        self._collage_id = None
+        self._collage_stage_seconds = {}
+        self._collage_counters = {}
+        self._collage_start = 0.0
+        # samples of seconds per stage, one sample per collage
+        self._stage_samples = {}
+        self._counter_totals = {}
+        # counters summed over collages only, used for throughput so batch setup (e.g. scan) does not inflate it
+        self._collage_counter_totals = {}
+        self._collage_count = 0
+        self._first_collage_start = None
+        self._last_collage_end = None
+
+    def stage(self, name: str) -> _StageTimer:
+        return _StageTimer(self, name)
+
+    def add_counter(self, name: str, value: int = 1):
+        with self._lock:
+            self._counter_totals[name] = self._counter_totals.get(name, 0) + value
+            if self._collage_id is not None:
+                self._collage_counters[name] = self._collage_counters.get(name, 0) + value
+
+    def begin_collage(self, collage_id):
+        with self._lock:
+            self._collage_id = collage_id
+            self._collage_stage_seconds = {}
+            self._collage_counters = {}
+            self._collage_start = time.perf_counter()
+            if self._first_collage_start is None:
+                self._first_collage_start = self._collage_start
+
+    def end_collage(self, **extra_fields) -> dict:
+        """
+        Closes the current collage, records its stage totals as samples and appends a JSON line if a path was given
+        :param extra_fields: additional fields to put in the JSON record (e.g. output path)
+        :return: the record of the collage
+        """
+        with self._lock:
+            end = time.perf_counter()
+            record = {
+                "collage_id": self._collage_id,
+                "total_seconds": end - self._collage_start,
+                "stage_seconds": self._collage_stage_seconds,
+                "counters": self._collage_counters,
+            }
+            record.update(extra_fields)
+            for name, seconds in self._collage_stage_seconds.items():
+                self._stage_samples.setdefault(name, []).append(seconds)
+            for name, value in self._collage_counters.items():
+                self._collage_counter_totals[name] = self._collage_counter_totals.get(name, 0) + value
+            self._collage_count += 1
+            self._last_collage_end = end
+            self._collage_id = None
+            self._collage_stage_seconds = {}
+            self._collage_counters = {}
+
+        if self._json_lines_path is not None:
+            with open(self._json_lines_path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+        return record
+
+    def get_stage_quantiles(self, name: str) -> dict:
+        """
+        :param name: the stage name
+        :return: dictionary of quantile -> seconds, empty if the stage was never recorded
+        """
+        with self._lock:
+            samples = sorted(self._stage_samples.get(name, []))
+        if len(samples) == 0:
+            return {}
+        return {quantile: get_quantile(samples, quantile) for quantile in SUMMARY_QUANTILES}
+
+    def get_counter(self, name: str) -> int:
+        return self._counter_totals.get(name, 0)
+
+    def get_elapsed_seconds(self) -> float:
+        if self._first_collage_start is None or self._last_collage_end is None:
+            return 0.0
+        return self._last_collage_end - self._first_collage_start
+
+    def write_prometheus_summary(self, path: str):
+        """
+        Writes a Prometheus text file (for the node exporter textfile collector) with a summary per stage,
+        throughput and byte counters. The file is written to a temporary file first and then moved into place
+        so the collector never reads a partial file.
+        :param path: path of the .prom file
+        """
+        with self._lock:
+            stage_samples = {name: sorted(samples) for name, samples in self._stage_samples.items()}
+            counter_totals = dict(self._counter_totals)
+            images_decoded = self._collage_counter_totals.get(COUNTER_IMAGES_DECODED, 0)
+            collage_count = self._collage_count
+        elapsed_seconds = self.get_elapsed_seconds()
+
+        lines = [f"# HELP {METRIC_PREFIX}_stage_seconds Wall time spent in each pipeline stage per collage.",
+                 f"# TYPE {METRIC_PREFIX}_stage_seconds summary"]
+        for name, samples in sorted(stage_samples.items()):
+            for quantile in SUMMARY_QUANTILES:
+                lines.append(f'{METRIC_PREFIX}_stage_seconds{{stage="{name}",quantile="{quantile}"}} '
+                             f'{get_quantile(samples, quantile):.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{name}"}} {sum(samples):.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{name}"}} {len(samples)}')
+
+        lines.append(f"# HELP {METRIC_PREFIX}_collages_total Number of collages generated.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_collages_total counter")
+        lines.append(f"{METRIC_PREFIX}_collages_total {collage_count}")
+
+        lines.append(f"# HELP {METRIC_PREFIX}_images_per_second Source images decoded per second of batch time.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_images_per_second gauge")
+        images_per_second = images_decoded / elapsed_seconds if elapsed_seconds > 0 else 0.0
+        lines.append(f"{METRIC_PREFIX}_images_per_second {images_per_second:.6f}")
+
+        for name in sorted(counter_totals.keys()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{name}_total {counter_totals[name]}")
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+    def _enter_stage(self, name: str) -> bool:
+        depths = self._get_thread_stage_depths()
+        depth = depths.get(name, 0)
+        depths[name] = depth + 1
+        return depth == 0
+
+    def _exit_stage(self, name: str, elapsed: float, outermost: bool):
+        depths = self._get_thread_stage_depths()
+        depths[name] -= 1
+        if not outermost:
+            return
+        with self._lock:
+            if self._collage_id is not None:
+                self._collage_stage_seconds[name] = self._collage_stage_seconds.get(name, 0.0) + elapsed
+            elif not any(depths.values()):
+                # outside of a collage only top level stages are sampled, e.g. the decodes done while scanning
+                # are part of the scan sample and should not skew the per collage decode samples
+                self._stage_samples.setdefault(name, []).append(elapsed)
+
+    def _get_thread_stage_depths(self) -> dict:
+        depths = getattr(self._thread_state, "depths", None)
+        if depths is None:
+            depths = {}
+            self._thread_state.depths = depths
+        return depths
+
+
+def get_quantile(sorted_samples: list, quantile: float) -> float:
+    """Nearest rank quantile of an already sorted list"""
+    rank = max(math.ceil(quantile * len(sorted_samples)) - 1, 0)
+    return sorted_samples[rank]
+
+
+# instrumentation is disabled (None) unless enabled with set_active_instrumentation(). While disabled,
+# the module level helpers below return immediately so the hooks in the hot paths cost a global lookup
+_active_instrumentation = None
+
+
+def get_active_instrumentation():
+    return _active_instrumentation
+
+
+def set_active_instrumentation(instrumentation):
+    """
+    :param instrumentation: an Instrumentation to enable timing, or None to disable it
+    """
+    global _active_instrumentation
+    _active_instrumentation = instrumentation
+
+
+def is_enabled() -> bool:
+    return _active_instrumentation is not None
+
+
+def stage(name: str):
+    """
+    Times a block of code as the given stage. Usage: with instrumentation.stage(STAGE_DECODE): ...
+    """
+    if _active_instrumentation is None:
+        return _NULL_STAGE
+    return _active_instrumentation.stage(name)
+
+
+def add_counter(name: str, value: int = 1):
+    if _active_instrumentation is None:
+        return
+    _active_instrumentation.add_counter(name, value)
@@ -0,0 +1,194 @@
+import json
+import sqlite3
+import time
+
+# states a job goes through. Leased jobs whose lease expires go back to queued
+STATE_QUEUED = "queued"
+STATE_LEASED = "leased"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 120
+DEFAULT_MAX_ATTEMPTS = 3
+# window used for the recent throughput in get_stats()
+THROUGHPUT_WINDOW_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    collage_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    output_path TEXT,
+    error TEXT,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, collage_id);
+"""
+
+
+class JobQueue:
+    """
+    Work queue of collage jobs kept in a local SQLite file, shared by any number of worker processes.
+
+    Workers lease one collage id at a time. A lease expires after lease_seconds unless the worker sends a
+    heartbeat, after which the job is handed to another worker. Jobs that fail or expire max_attempts times are
+    marked failed. Because every collage is seeded from (batch seed, collage id), a job can be retried by any
+    worker and still produce the same output.
+
+    Each process (and each thread) needs its own JobQueue since SQLite connections cannot be shared.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self._path = path
+        self._lease_seconds = float(lease_seconds)
+        self._max_attempts = int(max_attempts)
+        # autocommit mode, transactions are started explicitly with BEGIN IMMEDIATE where needed
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def get_path(self) -> str:
+        return self._path
+
+    def get_lease_seconds(self) -> float:
+        return self._lease_seconds
+
+    def create_batch(self, num_to_generate: int, **batch_settings):
+        """
+        Stores the batch settings and enqueues one job per collage id. Ids that are already in the queue are kept
+        as they are, so calling this again on an existing queue only adds the missing jobs.
+
+        :param num_to_generate: number of collages, jobs get ids 0 to num_to_generate - 1
+        :param batch_settings: settings every worker needs (seed, image directory, output directory, ...)
+        """
+        now = time.time()
+        with self._transaction():
+            for key, value in batch_settings.items():
+                self._connection.execute("INSERT OR REPLACE INTO batch (key, value) VALUES (?, ?)",
+                                         (key, json.dumps(value)))
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO jobs (collage_id, state, enqueued_at) VALUES (?, ?, ?)",
+                ((collage_id, STATE_QUEUED, now) for collage_id in range(num_to_generate)))
+
+    def get_batch(self) -> dict:
+        rows = self._connection.execute("SELECT key, value FROM batch").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def lease(self, worker_id: str):
+        """
+        Leases the next queued job. Expired leases are put back in the queue first.
+        :return: the collage id, or None if nothing is queued
+        """
+        now = time.time()
+        with self._transaction():
+            self._requeue_expired_leases(now)
+            row = self._connection.execute(
+                "SELECT collage_id FROM jobs WHERE state = ? ORDER BY collage_id LIMIT 1", (STATE_QUEUED,)).fetchone()
+            if row is None:
+                return None
+            collage_id = row[0]
+            self._connection.execute(
+                "UPDATE jobs SET state = ?, worker_id = ?, lease_expires = ?, attempts = attempts + 1, "
+                "started_at = ?, error = NULL WHERE collage_id = ?",
+                (STATE_LEASED, worker_id, now + self._lease_seconds, now, collage_id))
+        return collage_id
+
+    def heartbeat(self, collage_id: int, worker_id: str) -> bool:
+        """
+        Extends the lease of a job
+        :return: False if the worker no longer holds the lease (it expired and the job was given to someone else)
+        """
+        now = time.time()
+        cursor = self._connection.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE collage_id = ? AND worker_id = ? AND state = ? "
+            "AND lease_expires >= ?", (now + self._lease_seconds, collage_id, worker_id, STATE_LEASED, now))
+        return cursor.rowcount == 1
+
+    def complete(self, collage_id: int, worker_id: str, output_path: str) -> bool:
+        cursor = self._connection.execute(
+            "UPDATE jobs SET state = ?, output_path = ?, finished_at = ?, lease_expires = NULL "
+            "WHERE collage_id = ? AND worker_id = ? AND state = ?",
+            (STATE_DONE, output_path, time.time(), collage_id, worker_id, STATE_LEASED))
+        return cursor.rowcount == 1
+
+    def fail(self, collage_id: int, worker_id: str, error: str) -> bool:
+        """
+        Gives a job back after an error. It is queued again unless it already used up max_attempts.
+        """
+        with self._transaction():
+            row = self._connection.execute("SELECT attempts FROM jobs WHERE collage_id = ? AND worker_id = ? "
+                                           "AND state = ?", (collage_id, worker_id, STATE_LEASED)).fetchone()
+            if row is None:
+                return False
+            new_state = STATE_FAILED if row[0] >= self._max_attempts else STATE_QUEUED
+            self._connection.execute(
+                "UPDATE jobs SET state = ?, worker_id = NULL, lease_expires = NULL, error = ?, finished_at = ? "
+                "WHERE collage_id = ?", (new_state, error, time.time(), collage_id))
+        return True
+
+    def has_unfinished_jobs(self) -> bool:
+        row = self._connection.execute("SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)",
+                                       (STATE_QUEUED, STATE_LEASED)).fetchone()
+        return row[0] > 0
+
+    def get_stats(self) -> dict:
+        """
+        Queue depth per state and throughput, overall and over the last THROUGHPUT_WINDOW_SECONDS
+        """
+        now = time.time()
+        counts = {STATE_QUEUED: 0, STATE_LEASED: 0, STATE_DONE: 0, STATE_FAILED: 0}
+        for state, count in self._connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = count
+        first_start, last_finish = self._connection.execute(
+            "SELECT MIN(started_at), MAX(finished_at) FROM jobs WHERE state = ?", (STATE_DONE,)).fetchone()
+        recent_done = self._connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ? AND finished_at >= ?",
+            (STATE_DONE, now - THROUGHPUT_WINDOW_SECONDS)).fetchone()[0]
+        workers = self._connection.execute(
+            "SELECT COUNT(DISTINCT worker_id) FROM jobs WHERE state = ?", (STATE_LEASED,)).fetchone()[0]
+        overall_seconds = (last_finish - first_start) if first_start is not None else 0
+        return {
+            "counts": counts,
+            "active_workers": workers,
+            "collages_per_second": counts[STATE_DONE] / overall_seconds if overall_seconds > 0 else 0.0,
+            "recent_collages_per_second": recent_done / THROUGHPUT_WINDOW_SECONDS,
+        }
+
+    def close(self):
+        self._connection.close()
+
+    def _requeue_expired_leases(self, now: float):
+        self._connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker_id = NULL, "
+            "lease_expires = NULL, error = 'lease expired' WHERE state = ? AND lease_expires < ?",
+            (self._max_attempts, STATE_FAILED, STATE_QUEUED, STATE_LEASED, now))
+
+    def _transaction(self):
+        return _ImmediateTransaction(self._connection)
+
+
+class _ImmediateTransaction:
+    """BEGIN IMMEDIATE takes the write lock up front so two workers can never lease the same job"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def __enter__(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._connection.execute("COMMIT")
+        else:
+            self._connection.execute("ROLLBACK")
+        return False
@@ -0,0 +1,87 @@
+import functools
+
+import numpy as ns
+import cv2
+
+DEFAULT_FONT_FACE = cv2.FONT_HERSHEY_SIMPLEX
+# part of the caption band the text may take up, the rest is left as margin
+CAPTION_TEXT_WIDTH_RATIO = 0.95
+CAPTION_TEXT_HEIGHT_RATIO = 0.6
+# bands lower than this are left empty, text would not be legible
+CAPTION_MINIMUM_HEIGHT = 8
+# rendered captions kept for reuse, e.g. the same date under many images of a batch
+CAPTION_RASTER_CACHE_SIZE = 512
+# measurements made after the closed form estimate, to correct for rounding of the glyph sizes
+FONT_SCALE_CORRECTION_STEPS = 4
+
+
+def fit_font_scale(text: str, max_width: float, max_height: float = None, font_face: int = DEFAULT_FONT_FACE,
+                   thickness: int = 1, max_scale: float = None) -> float:
+    """
+    Finds the largest font scale at which text fits in max_width x max_height.
+
+    The size of Hershey text grows linearly with the font scale, plus a constant for the stroke thickness, so the
+    scale follows in closed form from two measurements at small scales. The result is measured once more and only
+    shrunk in the rare cases where the rounding of the glyph sizes pushed it over the limits. That is three
+    cv2.getTextSize() calls instead of one per candidate scale, and none of them at a large scale, where
+    getTextSize() gets expensive.
+
+    :param max_height: limit for the height including the part below the baseline, None for no limit
+    :param max_scale: upper limit for the result, None for no limit
+    :return: the font scale, 0 for empty text
+    """
+    (unit_width, unit_height), unit_baseline = cv2.getTextSize(text, font_face, 1, thickness)
+    if unit_width == 0:
+        return 0
+    (double_width, double_height), double_baseline = cv2.getTextSize(text, font_face, 2, thickness)
+    width_slope = max(double_width - unit_width, 1)
+    scale = (max_width - (unit_width - width_slope)) / width_slope
+    if max_height is not None:
+        unit_height += unit_baseline
+        height_slope = max(double_height + double_baseline - unit_height, 1)
+        scale = min(scale, (max_height - (unit_height - height_slope)) / height_slope)
+    if max_scale is not None:
+        scale = min(scale, max_scale)
+    scale = max(scale, 0)
+    for _ in range(FONT_SCALE_CORRECTION_STEPS):
+        (width, height), baseline = cv2.getTextSize(text, font_face, scale, thickness)
+        overshoot = width / max_width
+        if max_height is not None:
+            overshoot = max(overshoot, (height + baseline) / max_height)
+        if overshoot <= 1:
+            break
+        scale = scale / overshoot * 0.99
+    return scale
+
+
+def get_caption_thickness(height: int) -> int:
+    """
+    :return: stroke thickness of the text in a caption band of the given height
+    """
+    return max(1, round(height / 25))
+
+
+@functools.lru_cache(maxsize=CAPTION_RASTER_CACHE_SIZE)
+def get_caption_raster(text: str, width: int, height: int, color: tuple, background_color: tuple,
+                       font_face: int = DEFAULT_FONT_FACE):
+    """
+    Renders text centered on a band of background_color, scaled to fit the band. Rasters are cached by everything
+    that affects their pixels, so a caption that repeats across a batch is drawn once and copied from then on.
+    The returned array is shared and must not be written to.
+
+    :param color: RGB color of the text
+    :param background_color: RGB color of the band
+    :return: BGR pixels of height x width, or None if the band is too small for legible text
+    """
+    if height < CAPTION_MINIMUM_HEIGHT or width <= 0 or len(text) == 0:
+        return None
+    thickness = get_caption_thickness(height)
+    font_scale = fit_font_scale(text, width * CAPTION_TEXT_WIDTH_RATIO, height * CAPTION_TEXT_HEIGHT_RATIO,
+                                font_face, thickness)
+    (text_width, text_height), baseline = cv2.getTextSize(text, font_face, font_scale, thickness)
+    raster = ns.full((height, width, 3), background_color[::-1], dtype=ns.uint8)
+    # putText places the baseline, center the box from the top of the text to the bottom of the descenders
+    origin = ((width - text_width) // 2, (height + text_height - baseline) // 2)
+    cv2.putText(raster, text, origin, font_face, font_scale, color[::-1], thickness, cv2.LINE_AA)
+    raster.flags.writeable = False
+    return raster
@@ -1,4 +1,6 @@
 import abc
+import copy
+import hashlib
 from abc import ABC, abstractmethod
 import numpy as ns
 
@@ -15,6 +17,11 @@ class ContainerItem(ABC):
     DEFAULT_MINIMUM_CONTENT_WIDTH = 50
     DEFAULT_MINIMUM_CONTENT_HEIGHT = 50
 
+    # items use __slots__ instead of a per instance __dict__, which keeps large trees (e.g. mosaics with tens of
+    # thousands of frames) compact and attribute lookups fast. Subclasses must declare __slots__ too, listing
+    # only the attributes they add
+    __slots__ = ("_image", "_parent")
+
     def __init__(self):
         """
         IMPORTANT: Call super().__init__() in the constructor of any class that inherits from this class
@@ -23,12 +30,28 @@ class ContainerItem(ABC):
         # numpy array of the image. Note that many Containers do not have an image and it
         # will only generate an image when get_drawable_image() is called in order to save memory
         self._image: ns.ndarray = None
+        # the container this item was added to, set by the container. Used to tell ancestors which region of their
+        # cached composite needs to be redrawn after a change
+        self._parent = None
 
     @abstractmethod
     def get_drawable_image(self) -> ns.ndarray:
         """Used for final output to screen / file where the image is created and/or merged with parent layout"""
         pass
 
+    def draw_onto(self, canvas: ns.ndarray):
+        """Draws the item into canvas, which has the size of the item and is usually a view into the canvas of
+        the parent container. Containers override this to draw their children straight into the view instead of
+        allocating a canvas of their own. Must only read the item tree, so that sibling items can draw concurrently."""
+        canvas[:] = self.get_drawable_image()
+
+    @abstractmethod
+    def get_preview_image(self, width: int, height: int, deadline: float = None) -> ns.ndarray:
+        """Quick, approximate version of get_drawable_image() drawn at width x height (usually much smaller than the
+        item) from the smallest image proxies available. Images without a proxy ready by deadline (a
+        time.perf_counter() value) are drawn as placeholders. Does not change what get_drawable_image() draws."""
+        pass
+
     @abstractmethod
     def get_width(self):
         """Gets the width of the image. For objects with no image, need to keep track of its virtual width/height"""
@@ -49,6 +72,40 @@ class ContainerItem(ABC):
         """Resize pictures by imposing a height limit. Width will be adjusted to maintain aspect ratio."""
         pass
 
+    @abstractmethod
+    def get_render_signature(self) -> tuple:
+        """Nested tuple of everything that affects how this item is drawn (geometry, paddings, colors, children and
+        source image identities). Two items with the same signature draw the same pixels."""
+        pass
+
+    def get_parent(self):
+        return self._parent
+
+    def set_parent(self, parent):
+        """Called by containers when the item is added to or removed from them"""
+        self._parent = parent
+
+    def copy_layout(self):
+        """
+        Copies the layout of the item (sizes, settings and the items below it) without any drawn pixels, so the copy
+        can be drawn while the original keeps changing. Source pixels are shared, they are never written to. The copy
+        has no parent, unlike copy.deepcopy() which would follow the parent up and copy the whole tree with every
+        drawn image and retained composite in it.
+        :return: the copy
+        """
+        item_copy = copy.copy(self)
+        item_copy._image = None
+        item_copy._parent = None
+        return item_copy
+
+    def get_fingerprint(self) -> str:
+        """
+        Content address of the item, computed from get_render_signature(). Can be used as a file name to detect
+        that an identical collage was already rendered.
+        :return: hex digest
+        """
+        return hashlib.sha256(repr(self.get_render_signature()).encode("utf-8")).hexdigest()[:32]
+
     def resize_to_limit(self, width_limit: int, height_limit: int):
         """Resizes the image to fit within the given width and height limits while maintaining aspect ratio.
         Args:
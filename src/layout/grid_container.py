@@ -7,6 +7,8 @@ from src.layout_exception import LayoutException
 
 
 class GridContainer(LayoutContainer):
+    __slots__ = ("_rows", "_columns")
+
     def __init__(self, width: int, height: int, rows: int, columns: int,
                  padding: tuple,
                  background_color: tuple,
@@ -34,6 +36,8 @@ class GridContainer(LayoutContainer):
 
 
 class GridLayoutLogic(LayoutLogic):
+    __slots__ = ("_cell_width", "_cell_height")
+
     def __init__(self, container: GridContainer):
         self._con = container
         self._cell_width = 0
@@ -59,6 +63,10 @@ class GridLayoutLogic(LayoutLogic):
         for item in self._con.get_items_copy():
             item.resize_to_limit(self.get_max_width_for_each_item(), self.get_max_height_for_each_item())
 
+    def resize_items_after_adding(self, item):
+        # cells only depend on the size of the grid, not on the number of items, so the others keep their size
+        item.resize_to_limit(self.get_max_width_for_each_item(), self.get_max_height_for_each_item())
+
     def get_max_width_for_each_item(self) -> int:
         return self._cell_width
 
@@ -108,7 +116,7 @@ class GridLayoutLogic(LayoutLogic):
         return self._con.get_width() - self._con.get_minimum_content_width() * self._con.get_num_of_columns()
 
     def check_dimensions_when_adding_item(self):
-        last_item_added: ContainerItem = self._con.get_items_copy()[-1]
+        last_item_added: ContainerItem = self._con.get_item(-1)
 
         item_to_add_width = last_item_added.get_width()
         item_to_add_height = last_item_added.get_height()
@@ -6,6 +6,8 @@ from src.layout_exception import LayoutException
 
 
 class HorizontalContainer (LayoutContainer):
+    __slots__ = ()
+
     def __init__(self, width: int, height: int, capacity: int, padding: tuple, background_color: tuple, item_gutters: tuple,
                 min_content_width: int, min_content_height: int):
         """DO NOT DIRECTLY USE THIS CONSTRUCTOR. USE THE FACTORY METHOD INSTEAD in layout_containers_factory.py"""
@@ -15,6 +17,8 @@ class HorizontalContainer (LayoutContainer):
 
 
 class HorizontalLayoutLogic(LayoutLogic):
+    __slots__ = ()
+
     def __init__(self, container: HorizontalContainer):
         self._con = container
 
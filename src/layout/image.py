@@ -1,21 +1,171 @@
+import hashlib
+import math
+import os
+import time
+
 import numpy as ns
 import cv2
 
+from src import center_of_interest, image_cache, image_decoder, image_header, instrumentation, memory_governor
 from src.layout.container_item import ContainerItem
+from src.layout_exception import LayoutException
+
+# color of images drawn in a preview before any proxy of them is available
+PREVIEW_PLACEHOLDER_COLOR = (200, 200, 200)
+
 
-#TODO don't even do resize until an image is required
 class Image (ContainerItem):
-    # init function to take in an ndarray with type in signature
-    def __init__(self, image: ns.ndarray):
+    """
+    An image that can be put in a container.
+
+    Resizing only changes the width / height the image will be drawn at. The pixels are produced once
+    get_drawable_image() is called, which keeps the layout phase free of any image processing.
+    When created from a file path, decoding is also deferred until then and done at the smallest decode scale
+    that still covers the final size. Images drawn no larger than the thumbnail embedded in their EXIF data are
+    drawn from the thumbnail, without decoding the image itself.
+
+    A filter set with set_filter() is applied after resizing, so it only ever touches the pixels that are drawn.
+
+    resize_to_cover() fills a size exactly by cropping instead of letterboxing. The crop window is kept in source
+    coordinates, so only the part of the source inside it is resampled, straight to the final size. With
+    set_center_of_interest_estimated() the window is moved onto the subject of the image when it is drawn.
+    """
+
+    __slots__ = ("_source_path", "_source_modified_time", "_source_image", "_source_width", "_source_height",
+                 "_source_orientation", "_source_thumbnail", "_width", "_height", "_filter", "_crop",
+                 "_center_of_interest", "_center_of_interest_estimated")
+
+    def __init__(self, image: ns.ndarray = None, source_path: str = None, source_size: tuple = None,
+                 source_orientation: int = None):
+        """
+        :param image: BGR pixels already in memory. Can be omitted when source_path is given
+        :param source_path: the file the image comes from. Used to identify the image in collage fingerprints and
+        to decode the file lazily when image is None
+        :param source_size: upright (width, height) of the file if already known, otherwise it is read from the
+        file header
+        :param source_orientation: EXIF orientation of the file if already known together with source_size
+        """
         super().__init__()
-        self._image = image
+        self._source_path = source_path
+        self._source_modified_time = os.path.getmtime(source_path) if source_path is not None else None
+        # the full size pixels when the image was created from memory, None when it is decoded from source_path
+        self._source_image = self._track(image)
+        # image_header.ExifThumbnail of the file, when the header was read here and has one
+        source_thumbnail = None
+
+        if image is not None:
+            source_size = (image.shape[1], image.shape[0])
+        elif source_path is None:
+            raise LayoutException("An Image needs either pixels or a source path")
+        elif source_size is None:
+            header = image_header.read_image_header(source_path)
+            if header is not None:
+                source_size = (header.width, header.height)
+                source_orientation = header.orientation
+                source_thumbnail = header.thumbnail
+            else:
+                # header format not recognized, decode once just to learn the size
+                decoded_image = image_decoder.decode_image(source_path)
+                if decoded_image is None:
+                    raise LayoutException(f"Could not read image {source_path}")
+                source_size = (decoded_image.shape[1], decoded_image.shape[0])
 
+        self._source_width = int(source_size[0])
+        self._source_height = int(source_size[1])
+        # applied after decoding at a reduced scale, None lets cv2 read it from the file
+        self._source_orientation = source_orientation
+        self._source_thumbnail = source_thumbnail
+        # size the image will be drawn at
+        self._width = self._source_width
+        self._height = self._source_height
+        # pixels at the current width and height, created by get_drawable_image()
+        self._image = None
+        # image_filter.ImageFilter applied to the resized pixels, None to draw them as they are
+        self._filter = None
+        # (x, y, width, height) of the part of the upright source that is drawn, None for all of it
+        self._crop = None
+        # (x, y) fractions of the source that crops are centered on when possible, None for the middle
+        self._center_of_interest = None
+        # the center of interest is estimated from the image when it is drawn, see set_center_of_interest_estimated()
+        self._center_of_interest_estimated = False
 
     def get_width(self):
-        return int(self._image.shape[1])
+        return int(self._width)
 
     def get_height(self):
-        return int(self._image.shape[0])
+        return int(self._height)
+
+    def get_source_path(self) -> str:
+        return self._source_path
+
+    def get_filter(self):
+        return self._filter
+
+    def set_filter(self, image_filter):
+        """
+        :param image_filter: an image_filter.ImageFilter, or None to remove the filter
+        """
+        self._filter = image_filter
+        self._image = None
+        if self._parent is not None:
+            self._parent._invalidate_child_region(self, (0, 0, self.get_width(), self.get_height()))
+
+    def get_crop(self):
+        return self._crop
+
+    def clear_crop(self):
+        """
+        Draws the whole source again, at the current width and the height that matches it
+        """
+        if self._crop is None:
+            return
+        self._crop = None
+        self._height = max(int(self._width * self._source_height / self._source_width), 1)
+        self._image = None
+
+    def get_center_of_interest(self):
+        return self._center_of_interest
+
+    def set_center_of_interest(self, center: tuple):
+        """
+        :param center: (x, y) as fractions of the source width and height that crops keep in view, None for the
+        middle of the image
+        """
+        self._center_of_interest = center
+        self._center_of_interest_estimated = False
+        self._move_crop_to_center_of_interest()
+
+    def set_center_of_interest_estimated(self):
+        """
+        Centers crops on the center of interest estimated from the image, see estimate_center_of_interest(). The
+        estimate is only made when the image is drawn, so laying it out stays free of decoding and images that are
+        laid out but never drawn are never estimated
+        """
+        self._center_of_interest = None
+        self._center_of_interest_estimated = True
+        self._move_crop_to_center_of_interest()
+
+    def estimate_center_of_interest(self) -> tuple:
+        """
+        Sets the center of interest from the detail in the image, see center_of_interest.estimate_center_of_interest().
+        Images from files are estimated from their smallest proxy
+        :return: the center of interest
+        """
+        center = self._estimate_center_of_interest()
+        self._center_of_interest = center
+        self._center_of_interest_estimated = False
+        self._move_crop_to_center_of_interest()
+        return center
+
+    def resize_to_cover(self, width: int, height: int):
+        """
+        Resizes the image to exactly width x height without distorting it. The source is cropped to the aspect ratio
+        of the new size, around the center of interest, instead of leaving bars like resize_to_limit() does.
+        """
+        self._width = max(int(width), 1)
+        self._height = max(int(height), 1)
+        self._set_crop(get_cover_crop(self._source_width, self._source_height, self._width, self._height,
+                                      self._center_of_interest))
 
     def resize_by_width(self, width: int):
         int_width = int(width)
@@ -27,10 +177,8 @@ class Image (ContainerItem):
         # calculate ratio of max_width to width
         ratio = int_width / self.get_width()
         # calculate new height by multiplying ratio by height
-        new_height = int(int_height * ratio)
-        # resize image using cv2.resize
-        self._image = cv2.resize(self._image, (int_width, new_height))
-
+        self._height = int(int_height * ratio)
+        self._width = int_width
 
     def resize_by_height(self, height):
         int_height = int(height)
@@ -41,17 +189,207 @@ class Image (ContainerItem):
         # calculate ratio of max_height to height
         ratio = int_height / self.get_height()
         # calculate new width by multiplying ratio by width
-        new_width = int(int_width * ratio)
-        # resize image using cv2.resize
-        self._image = cv2.resize(self._image, (new_width, int_height))
+        self._width = int(int_width * ratio)
+        self._height = int_height
 
     # get the color of the underlying pixel at the given coordinates
     def get_pixel_color(self, x_coordinate: int, y_coordinate: int):
-        return self._image[y_coordinate][x_coordinate]
+        return self.get_drawable_image()[y_coordinate][x_coordinate]
 
     # get the canvas
     def get_drawable_image(self) -> ns.ndarray:
+        if self._image is None or self._image.shape[1] != self._width or self._image.shape[0] != self._height:
+            self._image = self._track(self._create_pixels())
         return self._image
 
+    def draw_onto(self, canvas: ns.ndarray):
+        if self._filter is None or (self._image is not None and self._image.shape[:2] == canvas.shape[:2]):
+            canvas[:] = self.get_drawable_image()
+            return
+        # resize straight into the canvas of the parent and filter it there, so a filtered image is composited
+        # without any array of its own
+        source_image = self._crop_source(self._get_source_pixels())
+        if source_image.shape[:2] == canvas.shape[:2]:
+            canvas[:] = source_image
+        else:
+            with instrumentation.stage(instrumentation.STAGE_RESIZE):
+                cv2.resize(source_image, (self._width, self._height), dst=canvas)
+        with instrumentation.stage(instrumentation.STAGE_FILTER):
+            self._filter.apply(canvas, canvas)
+
+    def get_preview_image(self, width: int, height: int, deadline: float = None) -> ns.ndarray:
+        preview_source = self._get_preview_source(width, height, deadline)
+        if preview_source is None:
+            # nothing to draw from within the latency budget, the full render will have the real pixels
+            return ns.full((height, width, 3), PREVIEW_PLACEHOLDER_COLOR[::-1], dtype=ns.uint8)
+        if preview_source is self._image:
+            # the drawn pixels, cropped and filtered already
+            return cv2.resize(preview_source, (width, height), interpolation=cv2.INTER_AREA)
+        self._place_crop_on_estimated_center()
+        preview_image = cv2.resize(self._crop_source(preview_source), (width, height), interpolation=cv2.INTER_AREA)
+        if self._filter is not None:
+            self._filter.apply(preview_image, preview_image)
+        return preview_image
+
+    def get_render_signature(self) -> tuple:
+        if self._source_path is not None:
+            source_identity = (self._source_path, self._source_modified_time)
+        else:
+            # images that only exist in memory are identified by their pixels
+            source_identity = (hashlib.sha1(ns.ascontiguousarray(self._source_image).data).hexdigest(),)
+        signature = (type(self).__name__, self.get_width(), self.get_height(), source_identity)
+        if self._crop is not None and self._center_of_interest_estimated:
+            # where the crop ends up depends only on the source, which is identified already
+            signature += ((self._crop[2], self._crop[3]), "estimated center of interest")
+        elif self._crop is not None:
+            signature += (self._crop,)
+        if self._filter is not None:
+            signature += (self._filter.get_signature(),)
+        return signature
+
+    # decode (if needed), resize the source to the current width and height and apply the filter
+    def _create_pixels(self) -> ns.ndarray:
+        source_image = self._crop_source(self._get_source_pixels())
+        if source_image.shape[1] == self._width and source_image.shape[0] == self._height:
+            if self._filter is None:
+                # a crop is a view into the source, copy it so the rest of the source can be released
+                return source_image if self._crop is None else ns.ascontiguousarray(source_image)
+            # the source may be shared with the image cache, filter into a new array
+            with instrumentation.stage(instrumentation.STAGE_FILTER):
+                return self._filter.apply(source_image)
+        # resize image using cv2.resize
+        with instrumentation.stage(instrumentation.STAGE_RESIZE):
+            pixels = cv2.resize(source_image, (self._width, self._height))
+        if self._filter is not None:
+            # the resized array is new, filter it in place
+            with instrumentation.stage(instrumentation.STAGE_FILTER):
+                self._filter.apply(pixels, pixels)
+        return pixels
+
+    # the source pixels at the smallest decode scale at which the crop still covers the current width and height
+    def _get_source_pixels(self) -> ns.ndarray:
+        self._place_crop_on_estimated_center()
+        source_image = self._source_image
+        required_width, required_height = self._get_required_source_size(self._width, self._height)
+        if source_image is None and self._is_covered_by_thumbnail(required_width, required_height):
+            source_image = self._decode_thumbnail()
+        if source_image is None:
+            decode_scale = image_decoder.get_decode_scale_for_target(self._source_width, self._source_height,
+                                                                     required_width, required_height)
+            source_image = image_decoder.decode_image(self._source_path, decode_scale,
+                                                      (self._source_width, self._source_height),
+                                                      self._source_orientation)
+            if source_image is None:
+                raise LayoutException(f"Could not read image {self._source_path}")
+        return source_image
+
+    # estimates the center of interest if it was left to drawing and moves the crop onto it. The size of the crop
+    # does not depend on its center, so the decode size worked out before stays valid. Runs as the image is drawn,
+    # before any pixels of the crop exist, so there is nothing to invalidate
+    def _place_crop_on_estimated_center(self):
+        if not self._center_of_interest_estimated or self._center_of_interest is not None:
+            return
+        center = self._estimate_center_of_interest()
+        self._center_of_interest = center if center is not None else center_of_interest.DEFAULT_CENTER
+        if self._crop is not None:
+            self._crop = get_cover_crop(self._source_width, self._source_height, self._width, self._height,
+                                        self._center_of_interest)
+
+    # moves the crop of a cover resize onto the current center of interest, keeping its size
+    def _move_crop_to_center_of_interest(self):
+        if self._crop is not None:
+            self._set_crop(get_cover_crop(self._source_width, self._source_height, self._width, self._height,
+                                          self._center_of_interest))
+
+    # drawn pixels of another crop are stale even at the same size, so they are dropped and the area is redrawn in
+    # retained composites, like set_filter() does
+    def _set_crop(self, crop: tuple):
+        if crop == (0, 0, self._source_width, self._source_height):
+            crop = None
+        if crop == self._crop:
+            return
+        self._crop = crop
+        self._image = None
+        if self._parent is not None:
+            self._parent._invalidate_child_region(self, (0, 0, self.get_width(), self.get_height()))
+
+    def _estimate_center_of_interest(self):
+        if self._source_image is not None:
+            return center_of_interest.estimate_center_of_interest(self._source_image)
+        return center_of_interest.estimate_image_file_center_of_interest(self._source_path, self._source_modified_time)
+
+    # size the whole source has to be decoded at for the crop to cover width x height
+    def _get_required_source_size(self, width: int, height: int) -> tuple:
+        if self._crop is None:
+            return width, height
+        return (math.ceil(width * self._source_width / self._crop[2]),
+                math.ceil(height * self._source_height / self._crop[3]))
+
+    # the part of source pixels (of the whole source, at any decode scale) inside the crop, as a view
+    def _crop_source(self, source_image: ns.ndarray) -> ns.ndarray:
+        if self._crop is None:
+            return source_image
+        scale_x = source_image.shape[1] / self._source_width
+        scale_y = source_image.shape[0] / self._source_height
+        x, y, width, height = self._crop
+        x_origin, y_origin = int(x * scale_x), int(y * scale_y)
+        x_end = max(round((x + width) * scale_x), x_origin + 1)
+        y_end = max(round((y + height) * scale_y), y_origin + 1)
+        return source_image[y_origin:y_end, x_origin:x_end]
+
+    # smallest pixels already at hand to draw a preview from, in order: pixels in memory, the smallest proxy in the
+    # image cache, the EXIF thumbnail, and a reduced decode if the deadline has not passed yet. Past the deadline a
+    # thumbnail smaller than the preview is still better than a placeholder
+    def _get_preview_source(self, width: int, height: int, deadline: float):
+        if self._source_image is not None:
+            return self._source_image
+        if self._image is not None:
+            return self._image
+        cache = image_cache.get_active_cache()
+        if cache is not None:
+            cached_image = cache.get_smallest(self._source_path, self._source_modified_time)
+            if cached_image is not None:
+                return cached_image[1]
+        width, height = self._get_required_source_size(width, height)
+        if self._is_covered_by_thumbnail(width, height):
+            thumbnail = self._decode_thumbnail()
+            if thumbnail is not None:
+                return thumbnail
+        if deadline is not None and time.perf_counter() >= deadline:
+            return self._decode_thumbnail() if self._source_thumbnail is not None else None
+        decode_scale = image_decoder.get_decode_scale_for_target(self._source_width, self._source_height,
+                                                                 width, height)
+        return image_decoder.decode_image(self._source_path, decode_scale, (self._source_width, self._source_height),
+                                          self._source_orientation)
+
+    def _is_covered_by_thumbnail(self, width: int, height: int) -> bool:
+        thumbnail = self._source_thumbnail
+        return thumbnail is not None and thumbnail.width >= width and thumbnail.height >= height
+
+    def _decode_thumbnail(self):
+        return image_decoder.decode_exif_thumbnail(self._source_path, self._source_thumbnail, self._source_orientation)
+
+    # register the pixel data with the memory governor so decoded images count towards the memory ceiling.
+    # the bytes are released automatically once the array is no longer referenced
+    def _track(self, image: ns.ndarray) -> ns.ndarray:
+        return memory_governor.get_default_governor().track(image, memory_governor.CATEGORY_IMAGE)
 
 
+def get_cover_crop(source_width: int, source_height: int, width: int, height: int, center: tuple = None) -> tuple:
+    """
+    Finds the largest part of a source with the aspect ratio of width x height, placed as close to being centered
+    on center as the edges of the source allow
+    :param center: (x, y) as fractions of the source width and height, None for the middle
+    :return: (x, y, width, height) in source coordinates
+    """
+    center_x, center_y = center if center is not None else (0.5, 0.5)
+    if source_width * height > width * source_height:
+        # the source is wider than the target, crop the sides
+        crop_width = min(max(round(source_height * width / height), 1), source_width)
+        crop_height = source_height
+    else:
+        crop_width = source_width
+        crop_height = min(max(round(source_width * height / width), 1), source_height)
+    x = min(max(round(center_x * source_width - crop_width / 2), 0), source_width - crop_width)
+    y = min(max(round(center_y * source_height - crop_height / 2), 0), source_height - crop_height)
+    return x, y, crop_width, crop_height
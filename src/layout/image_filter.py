@@ -0,0 +1,354 @@
+import functools
+import hashlib
+
+import numpy as ns
+import cv2
+
+from src.layout_exception import LayoutException
+
+# rows of pixels a 3D LUT interpolates at once, bounds its float temporaries for large cells
+LUT_3D_CHUNK_ROWS = 64
+# vignette masks kept for reuse. Cells of the same size share one mask
+VIGNETTE_MASK_CACHE_SIZE = 32
+# ITU-R BT.601 luma weights, the ones cv2 uses for BGR to gray
+GRAYSCALE_WEIGHTS_RGB = (0.299, 0.587, 0.114)
+# the usual sepia tone matrix, rows give the output red, green and blue from the input red, green and blue
+SEPIA_MATRIX_RGB = ((0.393, 0.769, 0.189),
+                    (0.349, 0.686, 0.168),
+                    (0.272, 0.534, 0.131))
+
+
+class _CurveStage:
+    """
+    One 256 entry lookup table per channel, applied with cv2.LUT. Tone curves, 1D LUTs and any other per channel
+    mapping of values end up as one of these.
+    """
+
+    __slots__ = ("_table",)
+
+    def __init__(self, table: ns.ndarray):
+        # 256 x 3 uint8, channels in BGR order
+        self._table = ns.ascontiguousarray(table, dtype=ns.uint8).reshape(256, 3)
+
+    def then(self, stage: "_CurveStage") -> "_CurveStage":
+        """
+        :return: one stage with the result of this stage followed by stage, looking up a value once instead of twice
+        """
+        return _CurveStage(ns.take_along_axis(stage._table, self._table.astype(ns.intp), axis=0))
+
+    def apply(self, image: ns.ndarray, destination: ns.ndarray):
+        cv2.LUT(image, self._table.reshape(1, 256, 3), dst=destination)
+
+    def get_signature(self) -> tuple:
+        return "curve", hashlib.sha1(self._table.data).hexdigest()
+
+
+class _MatrixStage:
+    """
+    Mixes the channels of every pixel with a 3 x 3 matrix, e.g. for grayscale and sepia. Results are rounded and
+    clipped to 0..255.
+    """
+
+    __slots__ = ("_matrix",)
+
+    def __init__(self, matrix_rgb):
+        # the matrix is given for RGB, reverse rows and columns to work on the BGR pixels directly
+        self._matrix = ns.ascontiguousarray(ns.asarray(matrix_rgb, dtype=ns.float32).reshape(3, 3)[::-1, ::-1])
+
+    def apply(self, image: ns.ndarray, destination: ns.ndarray):
+        cv2.transform(image, self._matrix, dst=destination)
+
+    def get_signature(self) -> tuple:
+        return "matrix", tuple(self._matrix.ravel().tolist())
+
+
+class _Lut3dStage:
+    """
+    A 3D color lookup table with trilinear interpolation between its entries.
+
+    Where each of the 256 values of a channel falls between the entries of the table is worked out once, when the
+    stage is created, so interpolating a pixel only takes lookups and multiply-adds over whole arrays.
+    """
+
+    __slots__ = ("_table", "_size", "_lower_indices", "_fractions", "_signature")
+
+    def __init__(self, table_rgb: ns.ndarray):
+        table_rgb = ns.asarray(table_rgb, dtype=ns.float32)
+        size = table_rgb.shape[0]
+        if size < 2 or table_rgb.shape != (size, size, size, 3):
+            raise LayoutException(f"A 3D LUT needs a size x size x size x 3 table, got {table_rgb.shape}")
+        self._size = size
+        # indexed [blue][green][red] with BGR values in 0..255, flattened so the corners of a cell are plain offsets
+        table = table_rgb.transpose(2, 1, 0, 3)[..., ::-1] * 255
+        self._table = ns.ascontiguousarray(table).reshape(-1, 3)
+        positions = ns.arange(256, dtype=ns.float32) * (size - 1) / 255
+        self._lower_indices = ns.minimum(positions.astype(ns.intp), size - 2)
+        self._fractions = positions - self._lower_indices
+        self._signature = ("lut_3d", hashlib.sha1(self._table.data).hexdigest())
+
+    def apply(self, image: ns.ndarray, destination: ns.ndarray):
+        for start in range(0, image.shape[0], LUT_3D_CHUNK_ROWS):
+            end = start + LUT_3D_CHUNK_ROWS
+            destination[start:end] = self._interpolate(image[start:end])
+
+    def _interpolate(self, image: ns.ndarray) -> ns.ndarray:
+        size = self._size
+        blue, green, red = image[..., 0], image[..., 1], image[..., 2]
+        # ns.take is much faster than fancy indexing for these gathers
+        base_index = (ns.take(self._lower_indices, blue) * size + ns.take(self._lower_indices, green)) * size \
+            + ns.take(self._lower_indices, red)
+        blue_fraction = ns.take(self._fractions, blue)[..., None]
+        green_fraction = ns.take(self._fractions, green)[..., None]
+        red_fraction = ns.take(self._fractions, red)[..., None]
+
+        def get_corner(offset: int) -> ns.ndarray:
+            return ns.take(self._table, base_index + offset, axis=0)
+
+        # interpolate along red between the 8 corners of the cell around every pixel, then along green, then blue
+        green_stride = size
+        blue_stride = size * size
+        corners = [_lerp(get_corner(offset), get_corner(offset + 1), red_fraction)
+                   for offset in (0, green_stride, blue_stride, blue_stride + green_stride)]
+        lower_blue = _lerp(corners[0], corners[1], green_fraction)
+        upper_blue = _lerp(corners[2], corners[3], green_fraction)
+        result = _lerp(lower_blue, upper_blue, blue_fraction)
+        result += 0.5
+        return ns.clip(result, 0, 255, out=result).astype(ns.uint8)
+
+    def get_signature(self) -> tuple:
+        return self._signature
+
+
+class _VignetteStage:
+    """
+    Darkens the image towards its corners by multiplying it with a radial mask the size of the image.
+    """
+
+    __slots__ = ("_strength", "_radius")
+
+    def __init__(self, strength: float, radius: float):
+        self._strength = float(strength)
+        self._radius = float(radius)
+
+    def apply(self, image: ns.ndarray, destination: ns.ndarray):
+        mask = _get_vignette_mask(image.shape[1], image.shape[0], self._strength, self._radius)
+        cv2.multiply(image, mask, dst=destination, scale=1 / 255)
+
+    def get_signature(self) -> tuple:
+        return "vignette", self._strength, self._radius
+
+
+# linear interpolation from start to end, computed in place in end
+def _lerp(start: ns.ndarray, end: ns.ndarray, fraction: ns.ndarray) -> ns.ndarray:
+    end -= start
+    end *= fraction
+    end += start
+    return end
+
+
+@functools.lru_cache(maxsize=VIGNETTE_MASK_CACHE_SIZE)
+def _get_vignette_mask(width: int, height: int, strength: float, radius: float) -> ns.ndarray:
+    # distance from the center, 0 in the middle and 1 in the corners, whatever the aspect ratio
+    x_distances = ns.linspace(-1, 1, width, dtype=ns.float32)[None, :]
+    y_distances = ns.linspace(-1, 1, height, dtype=ns.float32)[:, None]
+    distances = ns.sqrt((x_distances ** 2 + y_distances ** 2) / 2)
+    # full brightness within radius, then falling off smoothly to 1 - strength in the corners
+    falloff = ns.clip((distances - radius) / max(1 - radius, 1e-6), 0, 1)
+    mask = ns.rint(255 * (1 - strength * falloff * falloff * (3 - 2 * falloff))).astype(ns.uint8)
+    mask = ns.repeat(mask[..., None], 3, axis=2)
+    # shared by every image of this size, must never be written to
+    mask.flags.writeable = False
+    return mask
+
+
+class ImageFilter:
+    """
+    A sequence of filter stages applied to the pixels of an image once they are at their final size, so the cost
+    of a filter depends on the size of the collage cell rather than on the size of the source image.
+
+    Stages are compiled into lookup tables and masks when the filter is created. Consecutive per channel curves are
+    merged into a single table, so e.g. a tone curve followed by a 1D LUT costs one cv2.LUT call. Filters are
+    immutable and can be shared by any number of images and threads.
+
+    Use the create_*_filter() functions to create filters and combine_filters() to chain them.
+    """
+
+    __slots__ = ("_stages",)
+
+    def __init__(self, stages: list):
+        merged_stages = []
+        for stage in stages:
+            if len(merged_stages) > 0 and isinstance(stage, _CurveStage) and isinstance(merged_stages[-1], _CurveStage):
+                merged_stages[-1] = merged_stages[-1].then(stage)
+            else:
+                merged_stages.append(stage)
+        self._stages = tuple(merged_stages)
+
+    def apply(self, image: ns.ndarray, destination: ns.ndarray = None) -> ns.ndarray:
+        """
+        Filters image into destination. image is only read, so it can be a cached or read-only array.
+
+        :param image: BGR uint8 pixels
+        :param destination: array of the same shape to write into, e.g. a view of a collage canvas or image itself
+        to filter in place. None allocates a new array
+        :return: destination
+        """
+        if destination is None:
+            destination = ns.empty_like(image)
+        if len(self._stages) == 0:
+            destination[:] = image
+            return destination
+        # the first stage reads the image, every later stage works in place on the destination
+        source = image
+        for stage in self._stages:
+            stage.apply(source, destination)
+            source = destination
+        return destination
+
+    def get_signature(self) -> tuple:
+        """
+        :return: identifies what the filter does, for collage fingerprints
+        """
+        return tuple(stage.get_signature() for stage in self._stages)
+
+    def get_stage_count(self) -> int:
+        return len(self._stages)
+
+
+def combine_filters(*image_filters: ImageFilter) -> ImageFilter:
+    """
+    :return: a filter that applies image_filters one after another
+    """
+    return ImageFilter([stage for image_filter in image_filters for stage in image_filter._stages])
+
+
+def create_lut_1d_filter(table) -> ImageFilter:
+    """
+    :param table: 256 output values for every input value, either one column for all channels or 256 x 3 in
+    RGB order
+    """
+    table = ns.asarray(table)
+    if table.ndim == 1:
+        table = ns.repeat(table[:, None], 3, axis=1)
+    if table.shape != (256, 3):
+        raise LayoutException(f"A 1D LUT needs 256 entries for one or three channels, got {table.shape}")
+    return ImageFilter([_CurveStage(ns.clip(ns.rint(table[:, ::-1]), 0, 255))])
+
+
+def create_tone_curve_filter(points: list, channels: str = "rgb") -> ImageFilter:
+    """
+    Maps values along a curve through control points, interpolated linearly between them.
+
+    Usage:
+        # lift the shadows and soften the highlights
+        create_tone_curve_filter([(0, 20), (128, 135), (255, 240)])
+
+    :param points: (input, output) pairs with values in 0..255
+    :param channels: the channels the curve applies to, any of "r", "g" and "b". The others are left as they are
+    """
+    points = sorted(points)
+    if len(points) < 2:
+        raise LayoutException("A tone curve needs at least two points")
+    curve = ns.interp(ns.arange(256), [point[0] for point in points], [point[1] for point in points])
+    table = ns.repeat(ns.arange(256, dtype=ns.float64)[:, None], 3, axis=1)
+    for channel_index, channel in enumerate("rgb"):
+        if channel in channels.lower():
+            table[:, channel_index] = curve
+    return create_lut_1d_filter(table)
+
+
+def create_gamma_filter(gamma: float) -> ImageFilter:
+    """
+    :param gamma: above 1 brightens the mid tones, below 1 darkens them
+    """
+    return create_lut_1d_filter(255 * (ns.arange(256) / 255) ** (1 / gamma))
+
+
+def create_grayscale_filter() -> ImageFilter:
+    return ImageFilter([_MatrixStage([GRAYSCALE_WEIGHTS_RGB] * 3)])
+
+
+def create_sepia_filter(strength: float = 1.0) -> ImageFilter:
+    """
+    :param strength: 0 leaves the colors as they are, 1 is full sepia
+    """
+    matrix = (1 - strength) * ns.eye(3) + strength * ns.asarray(SEPIA_MATRIX_RGB)
+    return ImageFilter([_MatrixStage(matrix)])
+
+
+def create_vignette_filter(strength: float = 0.5, radius: float = 0.5) -> ImageFilter:
+    """
+    :param strength: how much darker the corners get, 0..1
+    :param radius: part of the distance from the center to the corners that is left untouched, 0..1
+    """
+    return ImageFilter([_VignetteStage(strength, radius)])
+
+
+def create_lut_3d_filter(table) -> ImageFilter:
+    """
+    :param table: size x size x size x 3 RGB output values in 0..1, indexed [red][green][blue]
+    """
+    return ImageFilter([_Lut3dStage(table)])
+
+
+def load_cube_file(path: str) -> ImageFilter:
+    """
+    Loads a 1D or 3D LUT in the .cube format used by most photo and video editors
+    """
+    lut_size = None
+    lut_dimensions = None
+    values = []
+    with open(path, "r") as cube_file:
+        for line in cube_file:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith("#") or fields[0] == "TITLE":
+                continue
+            if fields[0] in ("LUT_1D_SIZE", "LUT_3D_SIZE"):
+                lut_size = int(fields[1])
+                lut_dimensions = 1 if fields[0] == "LUT_1D_SIZE" else 3
+            elif fields[0] in ("DOMAIN_MIN", "DOMAIN_MAX"):
+                if [float(field) for field in fields[1:4]] != ([0.0] * 3 if fields[0] == "DOMAIN_MIN" else [1.0] * 3):
+                    raise LayoutException(f"{path}: only LUTs with the default 0..1 domain are supported")
+            else:
+                values.append([float(field) for field in fields[:3]])
+
+    if lut_size is None or len(values) != lut_size ** lut_dimensions:
+        raise LayoutException(f"{path} is not a valid .cube file")
+    values = ns.asarray(values, dtype=ns.float64)
+    if lut_dimensions == 1:
+        positions = ns.linspace(0, 255, lut_size)
+        table = ns.stack([ns.interp(ns.arange(256), positions, values[:, channel]) for channel in range(3)], axis=1)
+        return create_lut_1d_filter(255 * table)
+    # red changes fastest in the file, so the values reshape to [blue][green][red]
+    return create_lut_3d_filter(values.reshape(lut_size, lut_size, lut_size, 3).transpose(2, 1, 0, 3))
+
+
+# filters available by name, e.g. from the command line
+FILTER_PRESETS = {
+    "grayscale": create_grayscale_filter,
+    "sepia": create_sepia_filter,
+    "vignette": create_vignette_filter,
+    # raised blacks and lowered whites of an old print
+    "fade": lambda: create_tone_curve_filter([(0, 40), (255, 225)]),
+    "warm": lambda: combine_filters(create_tone_curve_filter([(0, 0), (128, 140), (255, 255)], "r"),
+                                    create_tone_curve_filter([(0, 0), (128, 116), (255, 255)], "b")),
+    "cool": lambda: combine_filters(create_tone_curve_filter([(0, 0), (128, 116), (255, 255)], "r"),
+                                    create_tone_curve_filter([(0, 0), (128, 140), (255, 255)], "b")),
+}
+
+
+def create_filter_from_description(description: str) -> ImageFilter:
+    """
+    :param description: comma separated names of FILTER_PRESETS and paths of .cube files, applied in that order,
+    e.g. "sepia,vignette" or "film.cube,vignette"
+    """
+    image_filters = []
+    for name in description.split(","):
+        name = name.strip()
+        if name.lower().endswith(".cube"):
+            image_filters.append(load_cube_file(name))
+        elif name in FILTER_PRESETS:
+            image_filters.append(FILTER_PRESETS[name]())
+        else:
+            raise LayoutException(f"Unknown filter {name}, expected one of {', '.join(FILTER_PRESETS)} or a .cube file")
+    return combine_filters(*image_filters)
@@ -1,10 +1,16 @@
 import math
 from typing import List
 
-import numpy as ns
+from src.layout import caption
 from src.layout.container_item import ContainerItem
 from src.layout.image import Image
-from src.layout.layout_container import LayoutContainer, LayoutLogic
+from src.layout.layout_container import LayoutContainer, LayoutLogic, get_scaled_coordinates
+from src.layout_exception import LayoutException
+
+# fit keeps the whole image and leaves the rest of the frame to the background, cover fills the frame and crops
+# whatever does not fit
+FILL_MODE_FIT = "fit"
+FILL_MODE_COVER = "cover"
 
 
 class ImageFrameContainer(LayoutContainer):
@@ -13,13 +19,20 @@ class ImageFrameContainer(LayoutContainer):
         container can add effects to the image such as padding / background color / text on the frame, etc
         """
 
+    __slots__ = ("_caption", "_caption_color", "_fill_mode")
+
     def __init__(self, image: Image, padding: tuple, background_color: tuple, min_content_width: int, min_content_height: int):
         """DO NOT DIRECTLY USE THIS CONSTRUCTOR. USE THE FACTORY METHOD INSTEAD in layout_containers_factory.py"""
         super().__init__(1, 1, 1, padding, background_color, (0, 0), min_content_width, min_content_height)
         self._items.append(image)
+        image.set_parent(self)
         self._width = image.get_width() + self._padding_left + self._padding_right
         self._height = image.get_height() + self._padding_top + self._padding_bottom
         self._layout_logic = ImageFrameLayoutLogic(self)
+        # text drawn centered in the bottom padding, None for no caption
+        self._caption = None
+        self._caption_color = (0, 0, 0)
+        self._fill_mode = FILL_MODE_FIT
 
     def get_width(self):
         return int(self._width)
@@ -32,6 +45,7 @@ class ImageFrameContainer(LayoutContainer):
 
         if width == self.get_width():
             return
+        self._invalidate()
 
         # calculate ratio of max_width to width
         ratio = width / self.get_width()
@@ -49,11 +63,12 @@ class ImageFrameContainer(LayoutContainer):
         child_height = int(self.get_max_drawable_height())
 
         # tell image to resize itself
-        self._items[0].resize_to_limit(child_width, child_height)
+        self._layout_logic.resize_items()
 
     def resize_by_height(self, height: int):
         if height == self.get_height():
             return
+        self._invalidate()
 
         # calculate ratio of max_height to height
         ratio = height / self.get_height()
@@ -71,7 +86,61 @@ class ImageFrameContainer(LayoutContainer):
         child_width = int(self.get_max_drawable_width())
 
         # tell image to resize itself
-        self._items[0].resize_to_limit(child_width, child_height)
+        self._layout_logic.resize_items()
+
+    def get_filter(self):
+        return self._items[0].get_filter()
+
+    def set_filter(self, image_filter):
+        """
+        Filters the image of the frame, the padding keeps the background color. The filter is applied once the
+        image is at its final size, see image_filter.ImageFilter
+        :param image_filter: an image_filter.ImageFilter, or None to remove the filter
+        """
+        self._items[0].set_filter(image_filter)
+
+    def resize_to_limit(self, width_limit: int, height_limit: int):
+        if self._fill_mode != FILL_MODE_COVER:
+            super().resize_to_limit(width_limit, height_limit)
+            return
+        # a covering frame takes whatever shape it is given, the image is cropped to match
+        if (int(width_limit), int(height_limit)) == (self.get_width(), self.get_height()):
+            return
+        self._invalidate()
+        self._width = int(width_limit)
+        self._height = int(height_limit)
+        self._layout_logic.resize_items()
+
+    def get_fill_mode(self) -> str:
+        return self._fill_mode
+
+    def set_fill_mode(self, fill_mode: str):
+        """
+        :param fill_mode: FILL_MODE_FIT to show the whole image, FILL_MODE_COVER to fill the frame inside the padding
+        and crop the image to it. Covering frames also take the exact size containers give them, so cells are
+        filled without bars
+        """
+        if fill_mode not in (FILL_MODE_FIT, FILL_MODE_COVER):
+            raise LayoutException(f"Unknown fill mode {fill_mode}")
+        self._fill_mode = fill_mode
+        if fill_mode == FILL_MODE_FIT:
+            self._items[0].clear_crop()
+        self._invalidate()
+        self._layout_logic.resize_items()
+
+    def get_caption(self) -> str:
+        return self._caption
+
+    def set_caption(self, text: str, color: tuple = (0, 0, 0)):
+        """
+        Shows text in the bottom padding of the frame, scaled to fit it. Frames without enough bottom padding
+        (see caption.CAPTION_MINIMUM_HEIGHT) leave it out.
+        :param text: the caption, None to remove it
+        :param color: RGB color of the text
+        """
+        self._caption = text
+        self._caption_color = tuple(color)
+        self._invalidate_region(self._get_caption_rectangle())
 
     def add_item(self, item: ContainerItem):
         # will not do anything here because a frame should be initialized with an image already. Consider throwing an
@@ -85,30 +154,38 @@ class ImageFrameContainer(LayoutContainer):
     # def get_child_origin_coordinates
 
 
-    def get_drawable_image(self) -> ns.ndarray:
-        # create a new array of the same size as self._image and fill it with the background color
-        image = ns.ones((self.get_height(), self.get_width(), 3), dtype="float32")
-        image = image * self._background_color[::-1]
-        # draw the image in self._item[0] onto the new array, do this in multiple steps
-        # get the image coordinate
-        top_left_coordinate = self._layout_logic.get_layout_coordinates()[0]
+    def get_render_signature(self) -> tuple:
+        signature = super().get_render_signature()
+        if self._caption is not None:
+            signature += (self._caption, self._caption_color)
+        return signature
 
-        # get the image
-        image_to_draw = self._items[0].get_drawable_image()
-
-        # get the height and width of the image
-        image_to_draw_width = image_to_draw.shape[1]
-        image_to_draw_height = image_to_draw.shape[0]
-
-        bottom_right_coordinate = (
-            top_left_coordinate[0] + image_to_draw_width, top_left_coordinate[1] + image_to_draw_height)
-        # draw the image onto the new array
-        image[top_left_coordinate[1]:bottom_right_coordinate[1],
-        top_left_coordinate[0]:bottom_right_coordinate[0]] = image_to_draw
-        return image
+    def _draw_decorations_onto(self, canvas):
+        if self._caption is None:
+            return
+        x_origin, y_origin, x_end, y_end = get_scaled_coordinates(self._get_caption_rectangle(),
+                                                                  canvas.shape[1] / self.get_width(),
+                                                                  canvas.shape[0] / self.get_height())
+        # rasters are cached, so the same caption in frames of the same width is only copied
+        raster = caption.get_caption_raster(self._caption, x_end - x_origin, y_end - y_origin, self._caption_color,
+                                            tuple(self._background_color))
+        if raster is not None:
+            canvas[y_origin:y_end, x_origin:x_end] = raster
+
+    def _get_caption_rectangle(self) -> tuple:
+        return (self._padding_left, self.get_height() - self._padding_bottom, self.get_width() - self._padding_right,
+                self.get_height())
+
+    def _get_item_rectangles(self) -> List:
+        # the layout logic only gives the top left corner of the image, the image decides its own size
+        x_origin, y_origin = self._layout_logic.get_layout_coordinates()[0]
+        item = self._items[0]
+        return [(x_origin, y_origin, x_origin + item.get_width(), y_origin + item.get_height())]
 
 
 class ImageFrameLayoutLogic(LayoutLogic):
+    __slots__ = ()
+
     def __init__(self, container: ImageFrameContainer):
         self._con = container
 
@@ -116,7 +193,10 @@ class ImageFrameLayoutLogic(LayoutLogic):
         if len(self._con.get_items_copy()) == 0:
             return
         item = self._con.get_items_copy()[0]
-        item.resize_to_limit(self.get_max_width_for_each_item(), self.get_max_height_for_each_item())
+        if self._con.get_fill_mode() == FILL_MODE_COVER:
+            item.resize_to_cover(self.get_max_width_for_each_item(), self.get_max_height_for_each_item())
+        else:
+            item.resize_to_limit(self.get_max_width_for_each_item(), self.get_max_height_for_each_item())
 
     def get_max_width_for_each_item(self) -> int:
         return int(self._con.get_max_drawable_width())
@@ -1,5 +1,8 @@
+import copy
 from typing import List
 import numpy as ns
+from src import instrumentation, memory_governor
+from src.layout import render_profiler
 from src.layout.container_item import ContainerItem
 from abc import ABC, abstractmethod
 from src.layout_exception import LayoutException
@@ -17,6 +20,10 @@ class LayoutContainer(ContainerItem):
     (e.g. horizontal, vertical, grid, etc).
     """
 
+    __slots__ = ("_gutter_horizontal", "_gutter_vertical", "_padding_top", "_padding_right", "_padding_bottom",
+                 "_padding_left", "_background_color", "_capacity", "_width", "_height", "_min_content_width",
+                 "_min_content_height", "_layout_logic", "_items", "_retain_composite", "_dirty_rectangles")
+
     def __init__(self, width: int, height: int, capacity,
                  padding: tuple, background_color: tuple,
                  item_gutters: tuple, min_content_width: int, min_content_height: int):
@@ -43,6 +50,10 @@ class LayoutContainer(ContainerItem):
         self._image = None
         self._layout_logic: LayoutLogic = None
         self._items = []
+        # retained mode keeps the composite in self._image after drawing. Changes below this container then only
+        # mark rectangles in _dirty_rectangles, and the next draw repaints just those instead of the whole canvas
+        self._retain_composite = False
+        self._dirty_rectangles = []
 
         # set the parameter values if they are supplied. Child classes are encouraged to override in their own
         # constructors.  Some bounds / sanity checking and defaults are set here too.
@@ -68,8 +79,10 @@ class LayoutContainer(ContainerItem):
         If all is well, proceed to have all children resize themselves to fit the new item in there
         """
         if self.can_next_item_fit(item):
+            self._invalidate()
             self._items.append(item)
-            self._layout_logic.resize_items()
+            self._adopt_item(item)
+            self._layout_logic.resize_items_after_adding(item)
         else:
             raise LayoutException("Cannot fit item, try calling can_next_item_fit() first")
 
@@ -81,9 +94,48 @@ class LayoutContainer(ContainerItem):
         :param item: the ContainerItem to remove
         :return:
         """
+        self._invalidate()
         self._items.remove(item)
+        item.set_parent(None)
         self._layout_logic.resize_items()
 
+    def replace_item(self, old_item: ContainerItem, new_item: ContainerItem):
+        """
+        Swaps an item for another one in the same cell. The new item is resized to fit the cell and the other items
+        keep their size and position, so only the union of the old and new item rectangles has to be redrawn here
+        and in every ancestor when composites are retained (see set_retain_composite()).
+
+        :param old_item: an item of this container
+        :param new_item: the item to put in its place
+        """
+        if old_item not in self._items:
+            raise LayoutException("Cannot replace an item that is not in the container")
+        index = self._items.index(old_item)
+        old_rectangle = self._get_item_rectangles()[index]
+        self._items[index] = new_item
+        old_item.set_parent(None)
+        self._adopt_item(new_item)
+        new_item.resize_to_limit(self._layout_logic.get_max_width_for_each_item(),
+                                 self._layout_logic.get_max_height_for_each_item())
+        new_rectangle = self._get_item_rectangles()[index]
+        self._invalidate_region(get_bounding_rectangle(old_rectangle, new_rectangle))
+
+    def set_retain_composite(self, retain_composite: bool):
+        """
+        Enables retained mode for this container and every container below it. In retained mode the composites are
+        kept after get_drawable_image(), and replace_item() only causes the changed rectangles to be redrawn along
+        the path from the changed item to the root. This costs one canvas per container of memory.
+
+        Note that get_drawable_image() then returns the retained canvas itself, copy it to keep a version of it.
+        """
+        self._retain_composite = retain_composite
+        if not retain_composite:
+            self._image = None
+            self._dirty_rectangles = []
+        for item in self._items:
+            if isinstance(item, LayoutContainer):
+                item.set_retain_composite(retain_composite)
+
     def can_next_item_fit(self, item: ContainerItem) -> bool:
         """
         tests if the next item will fit by adding it into the container.
@@ -110,7 +162,8 @@ class LayoutContainer(ContainerItem):
             except LayoutException as e:
                 return False
             finally:
-                self._items.remove(item)
+                # the item was appended last, pop() avoids searching the whole list in large containers
+                self._items.pop()
             return True
 
     def get_width(self):
@@ -122,6 +175,7 @@ class LayoutContainer(ContainerItem):
     def resize_by_width(self, width: int):
         if width == self.get_width():
             return
+        self._invalidate()
         # update height by proportion to the difference of old width and new width
         ratio = width / self.get_width()
         self._height = int(self.get_height() * ratio)
@@ -134,6 +188,7 @@ class LayoutContainer(ContainerItem):
     def resize_by_height(self, height: int):
         if height == self.get_height():
             return
+        self._invalidate()
 
         # update width by proportion to the difference of old height and new height
         ratio = height / self.get_height()
@@ -144,17 +199,191 @@ class LayoutContainer(ContainerItem):
         self._layout_logic.resize_items()
 
     def get_drawable_image(self) -> ns.ndarray:
-        # create a new array of the same size as self._image and fill it with the background color
-        image = ns.ones((self.get_height(), self.get_width(), 3), dtype="float32")
-        image = image * self._background_color[::-1]
-        # draw the image in self._item[0] onto the new array, do this in multiple steps
-        # get the image coordinate
-        coordinates = self._layout_logic.get_layout_coordinates()
-        for item in self._items:
-            x_origin, y_origin, x_end, y_end = coordinates.pop(0)
-            image[y_origin:y_end, x_origin:x_end] = item.get_drawable_image()
+        with instrumentation.stage(instrumentation.STAGE_COMPOSITE), render_profiler.profile_node(self) as profile:
+            if self._image is not None:
+                # retained composite, only repaint what changed since the last draw
+                image = self._image
+                for dirty_rectangle in self._dirty_rectangles:
+                    self._redraw_rectangle(image, dirty_rectangle, profile)
+                self._dirty_rectangles = []
+                return image
+
+            # create a new array the size of this container and fill it with the background color
+            image = self._create_canvas()
+            profile.add_bytes_allocated(image.nbytes)
+            self._draw_decorations_onto(image)
+            if not self._retain_composite:
+                # children draw straight into their part of the canvas, no canvas is allocated below this one
+                self._draw_items_onto(image, profile)
+                return image
+
+            # in retained mode every child keeps its own composite, which is then copied onto this one
+            for item, (x_origin, y_origin, x_end, y_end) in zip(self._items, self._get_item_rectangles()):
+                image[y_origin:y_end, x_origin:x_end] = item.get_drawable_image()
+                profile.add_pixels_copied((y_end - y_origin) * (x_end - x_origin))
+            self._image = image
+            self._dirty_rectangles = []
+            return image
+
+    def draw_onto(self, canvas: ns.ndarray):
+        if self._retain_composite:
+            canvas[:] = self.get_drawable_image()
+            return
+        with instrumentation.stage(instrumentation.STAGE_COMPOSITE), render_profiler.profile_node(self) as profile:
+            canvas[:] = self._background_color[::-1]
+            self._draw_decorations_onto(canvas)
+            self._draw_items_onto(canvas, profile)
+
+    def get_drawable_image_parallel(self, executor, parallel_depth: int = 2) -> ns.ndarray:
+        """
+        Same result as get_drawable_image(), with independent subtrees drawn concurrently on executor.
+
+        The containers of the top parallel_depth levels are laid out on the calling thread, then every subtree below
+        them is drawn by a task straight into its own view of the shared canvas. The views never overlap, and numpy
+        and cv2 release the GIL while copying and resizing, so subtrees render in parallel. Tasks never wait on other
+        tasks, so any executor size works. The tree must not be changed while it is drawn.
+
+        When a profiler is active, the subtrees drawn by tasks show up directly below this container. With
+        instrumentation, stage times of the tasks are added up, so they can exceed the wall time.
+
+        :param executor: a concurrent.futures executor with threads, e.g. ThreadPoolExecutor
+        :param parallel_depth: number of levels below this container that are split into tasks
+        :return: ndarray of shape (height, width, 3)
+        """
+        if self._retain_composite:
+            return self.get_drawable_image()
+        with instrumentation.stage(instrumentation.STAGE_COMPOSITE), render_profiler.profile_node(self) as profile:
+            image = self._create_canvas()
+            profile.add_bytes_allocated(image.nbytes)
+            self._draw_decorations_onto(image)
+            futures = []
+            self._submit_item_draws(image, executor, parallel_depth, futures, profile)
+            for future in futures:
+                future.result()
+            return image
+
+    def _draw_items_onto(self, canvas: ns.ndarray, profile):
+        for item, (x_origin, y_origin, x_end, y_end) in zip(self._items, self._get_item_rectangles()):
+            item.draw_onto(canvas[y_origin:y_end, x_origin:x_end])
+            profile.add_pixels_copied((y_end - y_origin) * (x_end - x_origin))
+
+    def _submit_item_draws(self, canvas: ns.ndarray, executor, parallel_depth: int, futures: list, profile):
+        # canvas already has the background of this container, lay out the items and hand out views of the canvas
+        for item, (x_origin, y_origin, x_end, y_end) in zip(self._items, self._get_item_rectangles()):
+            item_canvas = canvas[y_origin:y_end, x_origin:x_end]
+            if parallel_depth > 1 and isinstance(item, LayoutContainer) and not item._retain_composite:
+                item_canvas[:] = item.get_background_color()[::-1]
+                item._draw_decorations_onto(item_canvas)
+                item._submit_item_draws(item_canvas, executor, parallel_depth - 1, futures, profile)
+            else:
+                futures.append(executor.submit(render_profiler.run_below(profile, item.draw_onto), item_canvas))
+            profile.add_pixels_copied((y_end - y_origin) * (x_end - x_origin))
+
+    def _redraw_rectangle(self, image: ns.ndarray, rectangle: tuple, profile):
+        # clear the rectangle to the background and copy back the parts of the items that overlap it
+        x_origin, y_origin, x_end, y_end = rectangle
+        image[y_origin:y_end, x_origin:x_end] = self._background_color[::-1]
+        # decorations are cheap to draw and never overlap the items, draw them whole
+        self._draw_decorations_onto(image)
+        for item, item_rectangle in zip(self._items, self._get_item_rectangles()):
+            overlap = get_overlapping_rectangle(rectangle, item_rectangle)
+            if overlap is None:
+                continue
+            x_origin, y_origin, x_end, y_end = overlap
+            item_x_origin, item_y_origin = item_rectangle[0], item_rectangle[1]
+            image[y_origin:y_end, x_origin:x_end] = item.get_drawable_image()[
+                y_origin - item_y_origin:y_end - item_y_origin, x_origin - item_x_origin:x_end - item_x_origin]
+            profile.add_pixels_copied((y_end - y_origin) * (x_end - x_origin))
+
+    def _draw_decorations_onto(self, canvas: ns.ndarray):
+        """
+        Draws what the container shows besides its items, e.g. captions, onto canvas after it was filled with the
+        background color. canvas has the size of the container, or is a scaled down preview of it
+        """
+        pass
+
+    def _get_item_rectangles(self) -> List:
+        """
+        Where each item is drawn on this container
+        :return: a list with (x_origin, y_origin, x_end, y_end) for every item, in the order of the items
+        """
+        return self._layout_logic.get_layout_coordinates()
+
+    def _adopt_item(self, item: ContainerItem):
+        item.set_parent(self)
+        if isinstance(item, LayoutContainer):
+            item.set_retain_composite(self._retain_composite)
+
+    def _invalidate(self):
+        """
+        Drops the retained composite of this container because its layout changed, and marks its area as dirty in
+        the ancestors.
+        """
+        if self._image is None:
+            # nothing retained, and the ancestors already have this container marked as dirty
+            return
+        self._image = None
+        self._dirty_rectangles = []
+        if self._parent is not None:
+            self._parent._invalidate_child_region(self, (0, 0, self.get_width(), self.get_height()))
+
+    def _invalidate_region(self, rectangle: tuple):
+        """
+        Marks a rectangle of the retained composite for redrawing, along with the same area in every ancestor
+        :param rectangle: (x_origin, y_origin, x_end, y_end) in the coordinates of this container
+        """
+        if self._image is None:
+            return
+        rectangle = get_overlapping_rectangle(rectangle, (0, 0, self.get_width(), self.get_height()))
+        if rectangle is None:
+            return
+        if not any(contains_rectangle(dirty_rectangle, rectangle) for dirty_rectangle in self._dirty_rectangles):
+            self._dirty_rectangles.append(rectangle)
+        if self._parent is not None:
+            self._parent._invalidate_child_region(self, rectangle)
+
+    def _invalidate_child_region(self, item: ContainerItem, rectangle: tuple):
+        # translate the rectangle from the coordinates of the item to the coordinates of this container
+        if self._image is None:
+            return
+        item_x_origin, item_y_origin = self._get_item_rectangles()[self._items.index(item)][:2]
+        x_origin, y_origin, x_end, y_end = rectangle
+        self._invalidate_region((x_origin + item_x_origin, y_origin + item_y_origin,
+                                 x_end + item_x_origin, y_end + item_y_origin))
+
+    def get_preview_image(self, width: int, height: int, deadline: float = None) -> ns.ndarray:
+        image = self._create_canvas(width, height)
+        self._draw_decorations_onto(image)
+        # the layout is computed at full size, scale the slot of every child down to the preview
+        scale_x = width / self.get_width()
+        scale_y = height / self.get_height()
+        for item, coordinates in zip(self._items, self._get_item_rectangles()):
+            x_origin, y_origin, x_end, y_end = get_scaled_coordinates(coordinates, scale_x, scale_y)
+            if x_end > x_origin and y_end > y_origin:
+                image[y_origin:y_end, x_origin:x_end] = item.get_preview_image(x_end - x_origin, y_end - y_origin,
+                                                                               deadline)
         return image
 
+    def _create_canvas(self, width: int = None, height: int = None) -> ns.ndarray:
+        """
+        Allocates a canvas filled with the background color.
+        Canvases are 8 bit BGR like the decoded images drawn onto them, a float canvas would take 4 times the memory
+        without adding any precision. The canvas is registered with the memory governor.
+        :param width: width of the canvas, defaults to the width of this container
+        :param height: height of the canvas, defaults to the height of this container
+        :return: ndarray of shape (height, width, 3)
+        """
+        width = self.get_width() if width is None else width
+        height = self.get_height() if height is None else height
+        canvas = ns.empty((height, width, 3), dtype=ns.uint8)
+        canvas[:] = self._background_color[::-1]
+        return memory_governor.get_default_governor().track(canvas, memory_governor.CATEGORY_CANVAS)
+
+    def get_render_signature(self) -> tuple:
+        return (type(self).__name__, self.get_width(), self.get_height(), self.get_padding(), self.get_item_gutters(),
+                tuple(self.get_background_color()), tuple(self._layout_logic.get_layout_coordinates()),
+                tuple(item.get_render_signature() for item in self._items))
+
     def get_num_of_items(self) -> int:
         return len(self._items)
 
@@ -212,6 +441,7 @@ class LayoutContainer(ContainerItem):
             raise LayoutException(f"Invalid background_color")
 
         self._background_color = background_color
+        self._invalidate()
 
     def get_background_color(self) -> tuple:
         """
@@ -220,6 +450,20 @@ class LayoutContainer(ContainerItem):
         """
         return self._background_color
 
+    def copy_layout(self):
+        container_copy = super().copy_layout()
+        # the copy is drawn once, keeping its composites would only hold on to memory
+        container_copy._retain_composite = False
+        container_copy._dirty_rectangles = []
+        container_copy._layout_logic = copy.copy(self._layout_logic)
+        container_copy._layout_logic._con = container_copy
+        container_copy._items = []
+        for item in self._items:
+            item_copy = item.copy_layout()
+            item_copy.set_parent(container_copy)
+            container_copy._items.append(item_copy)
+        return container_copy
+
     def get_items_copy(self) -> [ContainerItem]:
         """
         Returns a copy of the items in the container. This is a shallow copy.
@@ -229,6 +473,19 @@ class LayoutContainer(ContainerItem):
         """
         return self._items.copy()
 
+    def get_item(self, index: int) -> ContainerItem:
+        """
+        Gets one item without copying the list of items, e.g. get_item(-1) for the last item added
+        """
+        return self._items[index]
+
+    def get_item_rectangle(self, item: ContainerItem) -> tuple:
+        """
+        Where an item is drawn on this container
+        :return: (x_origin, y_origin, x_end, y_end) in the coordinates of this container
+        """
+        return self._get_item_rectangles()[self._items.index(item)]
+
     def get_current_num_of_items(self) -> int:
         """
         Returns the number of items in the container
@@ -349,6 +606,38 @@ class LayoutContainer(ContainerItem):
         return True
 
 
+def get_overlapping_rectangle(rectangle: tuple, other_rectangle: tuple):
+    """
+    :return: the intersection of two (x_origin, y_origin, x_end, y_end) rectangles, or None if they do not overlap
+    """
+    x_origin = max(rectangle[0], other_rectangle[0])
+    y_origin = max(rectangle[1], other_rectangle[1])
+    x_end = min(rectangle[2], other_rectangle[2])
+    y_end = min(rectangle[3], other_rectangle[3])
+    if x_end <= x_origin or y_end <= y_origin:
+        return None
+    return x_origin, y_origin, x_end, y_end
+
+
+def get_bounding_rectangle(rectangle: tuple, other_rectangle: tuple) -> tuple:
+    return (min(rectangle[0], other_rectangle[0]), min(rectangle[1], other_rectangle[1]),
+            max(rectangle[2], other_rectangle[2]), max(rectangle[3], other_rectangle[3]))
+
+
+def contains_rectangle(rectangle: tuple, other_rectangle: tuple) -> bool:
+    return (rectangle[0] <= other_rectangle[0] and rectangle[1] <= other_rectangle[1] and
+            rectangle[2] >= other_rectangle[2] and rectangle[3] >= other_rectangle[3])
+
+
+def get_scaled_coordinates(coordinates: tuple, scale_x: float, scale_y: float) -> tuple:
+    """
+    Scales (x_origin, y_origin, x_end, y_end) for drawing a preview. Both ends are rounded down so neighbouring
+    slots keep sharing their edges.
+    """
+    x_origin, y_origin, x_end, y_end = coordinates
+    return int(x_origin * scale_x), int(y_origin * scale_y), int(x_end * scale_x), int(y_end * scale_y)
+
+
 class LayoutLogic(ABC):
     """Abstract class for common functions for each layout logic (e.g. vertical, horizontal, grid, etc)
     Calculations and resizing for this layout will in this class. Methods needed to be callable from
@@ -356,6 +645,9 @@ class LayoutLogic(ABC):
     LayoutLogic.  LayoutLogic should not be used outside its respective LayoutContainer.
     """
 
+    # the container this logic lays out. Subclasses declare their own __slots__ for anything they add
+    __slots__ = ("_con",)
+
     @abstractmethod
     def resize_items(self):
         """
@@ -364,6 +656,14 @@ class LayoutLogic(ABC):
         """
         pass
 
+    def resize_items_after_adding(self, item):
+        """
+        Called after an item was added to the container. Layouts where adding an item changes the space of the
+        other items resize them all, which is the default. Layouts with fixed cells only need to resize the new item.
+        :param item: the item that was added
+        """
+        self.resize_items()
+
     @abstractmethod
     def get_max_width_for_each_item(self) -> int:
         """
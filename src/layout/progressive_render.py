@@ -0,0 +1,91 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as ns
+
+from src.layout.container_item import ContainerItem
+
+# fraction of the full size the preview is drawn at
+DEFAULT_PREVIEW_SCALE = 0.25
+# time the preview may spend decoding proxies that are not cached yet, images over budget are placeholders
+DEFAULT_PREVIEW_BUDGET_SECONDS = 0.05
+
+# thread that draws full resolution renders in the background. Created on first use
+_full_render_executor = None
+_full_render_executor_lock = threading.Lock()
+
+
+class ProgressiveRender:
+    """
+    Result of render_progressive(): a preview that is available right away and a future of the full
+    resolution image, which is exactly what get_drawable_image() draws.
+    """
+
+    def __init__(self, preview: ns.ndarray, preview_seconds: float, full_resolution: Future):
+        self.preview = preview
+        self.preview_seconds = preview_seconds
+        self.full_resolution = full_resolution
+
+    def get_preview(self) -> ns.ndarray:
+        return self.preview
+
+    def get_full_resolution(self, timeout: float = None) -> ns.ndarray:
+        """
+        Waits for the full resolution render
+        :param timeout: seconds to wait, None to wait as long as it takes
+        """
+        return self.full_resolution.result(timeout)
+
+    def cancel(self) -> bool:
+        """
+        Cancels the full resolution render if it has not started yet, e.g. because the layout changed again
+        :return: True if it was cancelled
+        """
+        return self.full_resolution.cancel()
+
+
+def render_progressive(item: ContainerItem, preview_scale: float = DEFAULT_PREVIEW_SCALE,
+                       preview_budget_seconds: float = DEFAULT_PREVIEW_BUDGET_SECONDS,
+                       on_full_resolution=None, executor=None) -> ProgressiveRender:
+    """
+    Draws a low resolution preview of item now and the full resolution image in the background.
+
+    The preview is built from the smallest proxies available: pixels already in memory, the image cache, then
+    reduced decodes until preview_budget_seconds runs out. The full resolution render runs on a copy of the
+    layout of the item (see ContainerItem.copy_layout()), so the caller can keep editing the layout while it is drawn.
+
+    :param item: usually the main container of a collage
+    :param preview_scale: size of the preview relative to the item
+    :param preview_budget_seconds: latency budget for decoding proxies, None for no budget
+    :param on_full_resolution: called with the full resolution image once it is done, on the render thread
+    :param executor: where to run the full resolution render, defaults to a shared background thread
+    :return: the preview and a future of the full resolution image
+    """
+    start_time = time.perf_counter()
+    deadline = start_time + preview_budget_seconds if preview_budget_seconds is not None else None
+    preview_width = max(int(item.get_width() * preview_scale), 1)
+    preview_height = max(int(item.get_height() * preview_scale), 1)
+    preview = item.get_preview_image(preview_width, preview_height, deadline)
+    preview_seconds = time.perf_counter() - start_time
+
+    item_to_render = item.copy_layout()
+    if executor is None:
+        executor = _get_full_render_executor()
+    full_resolution = executor.submit(item_to_render.get_drawable_image)
+    if on_full_resolution is not None:
+        full_resolution.add_done_callback(lambda future: _call_if_done(future, on_full_resolution))
+    return ProgressiveRender(preview, preview_seconds, full_resolution)
+
+
+def _call_if_done(future: Future, callback):
+    if not future.cancelled() and future.exception() is None:
+        callback(future.result())
+
+
+def _get_full_render_executor() -> ThreadPoolExecutor:
+    global _full_render_executor
+    with _full_render_executor_lock:
+        if _full_render_executor is None:
+            _full_render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="full-render")
+        return _full_render_executor
@@ -0,0 +1,202 @@
+import threading
+import time
+
+
+class RenderProfileNode:
+    """
+    Render cost of one container in the tree: wall time, bytes allocated and pixels copied while drawing it.
+    Times are inclusive of the children, use get_self_seconds() for the time spent in this node only.
+    """
+
+    def __init__(self, name: str, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.inclusive_seconds = 0.0
+        self.bytes_allocated = 0
+        self.pixels_copied = 0
+        self._start = 0.0
+
+    def add_bytes_allocated(self, nbytes: int):
+        self.bytes_allocated += int(nbytes)
+
+    def add_pixels_copied(self, pixels: int):
+        self.pixels_copied += int(pixels)
+
+    def get_self_seconds(self) -> float:
+        return max(self.inclusive_seconds - sum(child.inclusive_seconds for child in self.children), 0.0)
+
+    def get_path(self) -> list:
+        path = []
+        node = self
+        while node is not None:
+            path.append(node.name)
+            node = node.parent
+        return path[::-1]
+
+
+class _NullProfileNode:
+    """Returned by profile_node() while no profiler is active, all methods do nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_bytes_allocated(self, nbytes: int):
+        pass
+
+    def add_pixels_copied(self, pixels: int):
+        pass
+
+
+_NULL_PROFILE_NODE = _NullProfileNode()
+
+
+class _ProfiledNode:
+    def __init__(self, profiler, container):
+        self._profiler = profiler
+        self._container = container
+        self._node = None
+
+    def __enter__(self) -> RenderProfileNode:
+        self._node = self._profiler._enter(self._container)
+        return self._node
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler._exit(self._node)
+        return False
+
+
+class RenderProfiler:
+    """
+    Records the render cost of every container drawn by get_drawable_image() while it is the active profiler.
+    The result can be written as an indented tree or as folded stacks (one line per stack with the self time in
+    microseconds) for flame graph tools such as flamegraph.pl or speedscope.
+
+    Usage:
+        profiler = RenderProfiler()
+        set_active_profiler(profiler)
+        main_container.get_drawable_image()
+        set_active_profiler(None)
+        profiler.write_folded_stacks("collage.folded")
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread_state = threading.local()
+        self._roots = []
+
+    def get_roots(self) -> list:
+        return list(self._roots)
+
+    def get_nodes(self) -> list:
+        """
+        :return: all nodes, depth first
+        """
+        nodes = []
+        stack = list(reversed(self._roots))
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def format_tree(self) -> str:
+        lines = []
+        for node in self.get_nodes():
+            depth = len(node.get_path()) - 1
+            lines.append(f"{'  ' * depth}{node.name}  total {node.inclusive_seconds * 1000:.2f} ms  "
+                         f"self {node.get_self_seconds() * 1000:.2f} ms  "
+                         f"alloc {node.bytes_allocated / (1024 * 1024):.2f} MB  "
+                         f"copied {node.pixels_copied / 1000000:.2f} Mpx")
+        return "\n".join(lines)
+
+    def format_folded_stacks(self) -> str:
+        lines = []
+        for node in self.get_nodes():
+            self_microseconds = int(node.get_self_seconds() * 1000000)
+            if self_microseconds > 0:
+                lines.append(f"{';'.join(node.get_path())} {self_microseconds}")
+        return "\n".join(lines)
+
+    def write_tree(self, path: str):
+        with open(path, "w") as file:
+            file.write(self.format_tree() + "\n")
+
+    def write_folded_stacks(self, path: str):
+        with open(path, "w") as file:
+            file.write(self.format_folded_stacks() + "\n")
+
+    def _enter(self, container) -> RenderProfileNode:
+        stack = self._get_thread_stack()
+        parent = stack[-1] if len(stack) > 0 else None
+        siblings = parent.children if parent is not None else self._roots
+        with self._lock:
+            # folded stack frames cannot contain spaces or semicolons. Siblings can be drawn by several threads
+            # at once, so the index is taken under the lock
+            name = f"{type(container).__name__}#{len(siblings)}[{container.get_width()}x{container.get_height()}]"
+            node = RenderProfileNode(name, parent)
+            siblings.append(node)
+        stack.append(node)
+        node._start = time.perf_counter()
+        return node
+
+    def _exit(self, node: RenderProfileNode):
+        node.inclusive_seconds += time.perf_counter() - node._start
+        self._get_thread_stack().pop()
+
+    def _get_thread_stack(self) -> list:
+        stack = getattr(self._thread_state, "stack", None)
+        if stack is None:
+            stack = []
+            self._thread_state.stack = stack
+        return stack
+
+
+# no profiler is active by default, profile_node() then returns a node that ignores everything
+_active_profiler = None
+
+
+def get_active_profiler():
+    return _active_profiler
+
+
+def set_active_profiler(profiler):
+    """
+    :param profiler: a RenderProfiler to start recording, or None to stop
+    """
+    global _active_profiler
+    _active_profiler = profiler
+
+
+def profile_node(container):
+    """
+    Records the render cost of a container. Usage inside get_drawable_image():
+        with render_profiler.profile_node(self) as profile:
+            ...
+            profile.add_pixels_copied(height * width)
+    """
+    if _active_profiler is None:
+        return _NULL_PROFILE_NODE
+    return _ProfiledNode(_active_profiler, container)
+
+
+def run_below(node, function):
+    """
+    Wraps function so that, when called on another thread, the containers it profiles are recorded as children of
+    node instead of as new roots. Used to profile subtrees that are drawn by worker threads.
+    """
+    if _active_profiler is None or not isinstance(node, RenderProfileNode):
+        return function
+    profiler = _active_profiler
+
+    def run_with_parent(*args, **kwargs):
+        stack = profiler._get_thread_stack()
+        stack.append(node)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+    return run_with_parent
@@ -5,6 +5,8 @@ from src.layout_exception import LayoutException
 
 
 class VerticalContainer(LayoutContainer):
+    __slots__ = ()
+
     def __init__(self, width: int, height: int, capacity: int, padding: tuple, background_color: tuple, item_gutters: tuple,min_content_width: int, min_content_height: int):
         """DO NOT DIRECTLY USE THIS CONSTRUCTOR. USE THE FACTORY METHOD INSTEAD in layout_containers_factory.py"""
         super().__init__(width, height, capacity, padding, background_color,
@@ -13,6 +15,8 @@ class VerticalContainer(LayoutContainer):
 
 
 class VerticalLayoutLogic(LayoutLogic):
+    __slots__ = ()
+
     def __init__(self, container: VerticalContainer):
         self._con = container
 
@@ -1,14 +1,26 @@
 import copy
+import functools
+import hashlib
 import os
 import random
+import socket
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import cv2
 
 import layout_containers_factory
-from src.layout import horizontal_container, vertical_container, grid_container
+from src import batch_journal, image_cache, image_decoder, image_header, image_index, image_ingestor, instrumentation, \
+    job_queue, memory_governor, perceptual_hash, photo_mosaic
+from src.layout import horizontal_container, vertical_container, grid_container, image_filter, \
+    image_frame_container, render_profiler
+from src.aspect_ratios import ASPECT_RATIO_RANGES
 from src.layout.image import Image
 from src.layout.layout_container import LayoutContainer
+from src.layout_exception import LayoutException
 
 COLORS = {
     "white": (255, 255, 255),
@@ -61,14 +73,6 @@ SUPPORTED_IMAGE_EXTENSIONS = {
     "png"
 }
 
-ASPECT_RATIO_RANGES = {
-    "square-ish": (0.751, 1.250),
-    "portrait-ish": (1.251, 1.800),
-    "landscape-ish": (0.561, 0.750),
-    "ultra-wide": (1.801, 3.000),  # anything beyond is too wide to handle, anything beyond will be disregarded
-    "ultra-narrow": (0.333, 0.560),  # anything beyond is too narrow to handle, anything beyond will be disregarded
-}
-
 HORIZONTAL_LAYOUT_HEURISTICS = {
     # common fields
     "name": "horizontal",
@@ -135,27 +139,604 @@ LAYOUT_HEURISTICS = {
 }
 
 GENERAL_SETTINGS = {
-    "max_levels_to_nest": 2
+    "max_levels_to_nest": 2,
+    # seed for the random layouts and image picks. With a seed, re-runs produce the same collages and skip
+    # rendering the ones that already exist in the output directory. None for a different batch every run
+    "seed": None,
+    # ceiling for decoded images, canvases and caches held at once. 0 means no ceiling
+    "memory_ceiling_mb": 0,
+    # how long to wait for memory to be released once even the smallest decode scale does not fit
+    "memory_block_timeout_seconds": 5.0,
+    # stage timing is only collected when at least one of these paths is set
+    "instrumentation_json_lines_path": None,
+    "instrumentation_prometheus_path": None,
+    # when set, a render cost tree and a folded stack file for flame graphs are written here for every collage
+    "render_profile_directory": None,
+    # number of finished collages between journal checkpoints that are synced to disk
+    "journal_checkpoint_interval": 10,
+    # directories listed at once and image headers read at once while scanning the image directory
+    "scan_walker_threads": 4,
+    "scan_probe_threads": 8,
+    # watch mode: seconds between checks of the image directory, and collages generated after every change
+    "watch_poll_seconds": 10.0,
+    "watch_collages_per_change": 5,
+    # threads drawing independent subtrees of a collage at once. 1 draws the whole tree on the calling thread
+    "render_threads": 1,
+    # keep near duplicates (e.g. burst shots) out of a collage: images whose perceptual hashes are at most this many
+    # bits apart are not placed together. Hashing reads a small proxy of every image while scanning. None disables it
+    "near_duplicate_max_distance": None,
+    # photo mosaics: cells across, pixel size of a cell (at least 50), how often one image may appear, and the
+    # decoded images kept while drawing so an image used in several cells is decoded once
+    "mosaic_columns": 100,
+    "mosaic_cell_size": 50,
+    "mosaic_max_uses_per_image": 2,
+    "mosaic_image_cache_mb": 256,
+    # filter applied to every image of a collage at its final size: comma separated names of
+    # image_filter.FILTER_PRESETS and paths of .cube LUT files, e.g. "sepia,vignette". None draws images unfiltered
+    "image_filter": None,
+    # caption under every image of a collage, formatted with the fields {date} and {time} (when the photo was taken),
+    # {camera} and {file_name}, e.g. "{date}  {camera}". Fields missing from an image are left empty. None for no
+    # captions. The caption takes caption_height pixels below the image
+    "caption_format": None,
+    "caption_height": 28,
+    "caption_color": (80, 80, 80),
+    # image_frame_container.FILL_MODE_FIT shows whole images, FILL_MODE_COVER fills every cell and crops the images
+    # to it (collages and mosaics). With fill_center_of_interest, crops are centered on the detail in each image,
+    # estimated from its smallest proxy, instead of on the middle
+    "fill_mode": image_frame_container.FILL_MODE_FIT,
+    "fill_center_of_interest": False
 }
 
 
+# fields caption formats can use, see get_caption_text()
+CAPTION_FIELDS = ("date", "time", "camera", "file_name")
+
+# suffix of outputs that are still being written. They are moved to their final name once complete. The host name
+# and process id go in front of it, so processes sharing an output directory (e.g. shards on one or several machines)
+# never touch each other's partial outputs
+PARTIAL_OUTPUT_SUFFIX = ".partial"
+# partial outputs of other processes untouched for this long were left behind by a run that died
+PARTIAL_OUTPUT_STALE_SECONDS = 600
+
+# thread pool of render_collage() and its size, see get_render_executor()
+_render_executor = None
+_render_executor_threads = 0
+_render_executor_lock = threading.Lock()
+# held while seeding and planning a collage, see plan_seeded_collage()
+_planning_lock = threading.Lock()
+# source of the seeds of batches started without one. Planning reseeds the global random module, so drawing seeds
+# from it would take values out of a collage being planned on another thread and tie new seeds to the last plan
+_seed_random = random.SystemRandom()
+
+
 # generates randoom layouts and returns a list of
 
-def run ():
-    image_directory = "test_images_3/"
-    dict_of_images = create_aspect_ratio_sorted_list_of_images_from_directory(image_directory)
-    num_to_generate = 500
-    for i in range(num_to_generate):
-        file_name_int = random.randint(10000,999999)
-        copy_of_dict_of_images = copy.deepcopy(dict_of_images)
-        main_container, bottom_level_containers = generate_random_layouts()
+def run (image_directory: str = "test_images_3/", output_directory: str = "output/", num_to_generate: int = 500,
+         journal_path: str = None, resume: bool = False, shard_index: int = 0, shard_count: int = 1,
+         partition_images: bool = False):
+    """
+    Generates a batch of collages from the images in image_directory.
+
+    :param journal_path: when set, progress is recorded in this file so the batch can be resumed
+    :param resume: continue the batch recorded in journal_path instead of starting a new one. Collages that
+    were completed are skipped and everything else, including partially written outputs, is redone with the
+    same seeds so the outputs are the same as if the batch had never stopped
+    :param shard_index: which shard of the batch to generate, from 0 to shard_count - 1
+    :param shard_count: number of machines / processes splitting the batch. Each shard generates the collage ids
+    where collage_id % shard_count == shard_index, so shards never duplicate work. Needs a seed so that all
+    shards plan the same batch
+    :param partition_images: also split the image pool between shards so no image is used by two shards.
+    Without it, the union of all shards is identical to running the whole batch on one machine
+    """
+    governor = memory_governor.MemoryGovernor(GENERAL_SETTINGS["memory_ceiling_mb"] * 1024 * 1024,
+                                              GENERAL_SETTINGS["memory_block_timeout_seconds"])
+    memory_governor.set_default_governor(governor)
+    stage_timing = None
+    if (GENERAL_SETTINGS["instrumentation_json_lines_path"] is not None or
+            GENERAL_SETTINGS["instrumentation_prometheus_path"] is not None):
+        stage_timing = instrumentation.Instrumentation(GENERAL_SETTINGS["instrumentation_json_lines_path"])
+    instrumentation.set_active_instrumentation(stage_timing)
+
+    with instrumentation.stage(instrumentation.STAGE_SCAN):
+        dict_of_images = create_aspect_ratio_sorted_list_of_images_from_directory(image_directory)
+        if partition_images:
+            dict_of_images = get_shard_image_pool(dict_of_images, image_directory, shard_index, shard_count)
+        # after partitioning, so every shard only hashes its own part of the library
+        activate_near_duplicate_filter(dict_of_images)
+    image_pool_digest = get_image_pool_digest(dict_of_images)
+
+    # every collage is seeded from the batch seed and its id, so any collage can be regenerated on its own
+    batch_seed = GENERAL_SETTINGS["seed"]
+    if batch_seed is None:
+        if shard_count > 1:
+            raise Exception("Sharding needs a seed so that every shard plans the same batch")
+        batch_seed = new_batch_seed()
+
+    journal = None
+    if journal_path is not None:
+        journal = batch_journal.BatchJournal(journal_path, GENERAL_SETTINGS["journal_checkpoint_interval"])
+        if resume and journal.exists():
+            journal.load()
+            if journal.get_batch() is None:
+                # the run died before the batch record was written, nothing of it can be resumed
+                print(f"warning: {journal_path} has no batch record, starting a new batch")
+        if journal.get_batch() is not None:
+            batch_seed = journal.get_batch()["seed"]
+            num_to_generate = journal.get_batch()["num_to_generate"]
+            if journal.get_batch()["image_pool_digest"] != image_pool_digest:
+                print("warning: the images changed since the batch started, resumed collages will differ")
+            journal.reopen()
+            print(f"resuming batch, {len(journal.get_completed_ids())} of {num_to_generate} collages already done")
+        else:
+            journal.start(batch_seed, num_to_generate, image_directory, image_pool_digest, shard_index=shard_index,
+                          shard_count=shard_count, partition_images=partition_images)
+
+    os.makedirs(output_directory, exist_ok=True)
+    remove_partial_outputs(output_directory)
+    for collage_id in get_shard_collage_ids(num_to_generate, shard_index, shard_count):
+        if journal is not None and journal.is_completed(collage_id):
+            continue
+        output_path = generate_collage(collage_id, batch_seed, dict_of_images, output_directory)
+        if journal is not None:
+            journal.mark_done(collage_id, output_path)
+        print(f"generated image #{collage_id} of {num_to_generate}"  )
+
+    if journal is not None:
+        journal.checkpoint(num_to_generate)
+        journal.close()
+    print(f"peak memory usage: {governor.get_peak_usage() / (1024 * 1024):.1f} MB, {governor.get_report()}")
+    if GENERAL_SETTINGS["instrumentation_prometheus_path"] is not None:
+        stage_timing.write_prometheus_summary(GENERAL_SETTINGS["instrumentation_prometheus_path"])
+
+
+def enqueue_batch(queue_path: str, image_directory: str = "test_images_3/", output_directory: str = "output/",
+                  num_to_generate: int = 500, resolution: str = "1080p"):
+    """
+    Creates a work queue for a batch. Start any number of run_worker() processes on the same queue file to
+    generate it, workers pull jobs as they go so fast and slow collages balance out on their own.
+    """
+    batch_seed = GENERAL_SETTINGS["seed"]
+    if batch_seed is None:
+        batch_seed = new_batch_seed()
+    queue = job_queue.JobQueue(queue_path)
+    queue.create_batch(num_to_generate, seed=batch_seed, image_directory=image_directory,
+                       output_directory=output_directory, resolution=resolution)
+    queue.close()
+
+
+def run_worker(queue_path: str, worker_id: str = None, poll_seconds: float = 1.0):
+    """
+    Generates collages leased from the queue until every job is done or failed. The lease is kept alive by a
+    heartbeat thread while a collage is generated, and a job that raises is given back to the queue.
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    queue = job_queue.JobQueue(queue_path)
+    batch = queue.get_batch()
+    with instrumentation.stage(instrumentation.STAGE_SCAN):
+        dict_of_images = create_aspect_ratio_sorted_list_of_images_from_directory(batch["image_directory"])
+        activate_near_duplicate_filter(dict_of_images)
+    os.makedirs(batch["output_directory"], exist_ok=True)
+
+    while True:
+        collage_id = queue.lease(worker_id)
+        if collage_id is None:
+            if not queue.has_unfinished_jobs():
+                break
+            # other workers still hold leases, wait in case one expires and comes back to the queue
+            time.sleep(poll_seconds)
+            continue
+
+        heartbeat = _LeaseHeartbeat(queue_path, collage_id, worker_id, queue.get_lease_seconds() / 3)
+        heartbeat.start()
+        try:
+            output_path = generate_collage(collage_id, batch["seed"], dict_of_images, batch["output_directory"],
+                                           batch["resolution"])
+        except Exception as e:
+            heartbeat.stop()
+            queue.fail(collage_id, worker_id, repr(e))
+            print(f"{worker_id} failed collage #{collage_id}: {e!r}")
+            continue
+        heartbeat.stop()
+        queue.complete(collage_id, worker_id, output_path)
+        print(f"{worker_id} generated collage #{collage_id}, queue: {queue.get_stats()['counts']}")
+    queue.close()
+
+
+def watch(image_directory: str = "test_images_3/", output_directory: str = "output/", max_refreshes: int = None):
+    """
+    Keeps running and generates new collages whenever images are added to, removed from or modified in
+    image_directory. The aspect ratio index stays in memory and each check only applies what changed, so the
+    cost of a check grows with the size of the change rather than the size of the library.
+
+    :param max_refreshes: stop after this many checks of the directory, None to run until interrupted
+    """
+    governor = memory_governor.MemoryGovernor(GENERAL_SETTINGS["memory_ceiling_mb"] * 1024 * 1024,
+                                              GENERAL_SETTINGS["memory_block_timeout_seconds"])
+    memory_governor.set_default_governor(governor)
+    index = create_aspect_ratio_index(image_directory)
+    # hashes of added and modified images are computed by each refresh
+    perceptual_hash.set_active_hash_index(index.get_hash_index())
+    batch_seed = GENERAL_SETTINGS["seed"]
+    if batch_seed is None:
+        batch_seed = new_batch_seed()
+    os.makedirs(output_directory, exist_ok=True)
+    remove_partial_outputs(output_directory)
+
+    # collage ids keep counting across changes so every collage gets its own seed
+    next_collage_id = 0
+    refreshes = 0
+    while max_refreshes is None or refreshes < max_refreshes:
+        if refreshes > 0:
+            time.sleep(GENERAL_SETTINGS["watch_poll_seconds"])
+        with instrumentation.stage(instrumentation.STAGE_SCAN):
+            changes = index.refresh()
+        refreshes += 1
+        if len(changes.added) + len(changes.removed) + len(changes.modified) == 0:
+            continue
+        print(f"images changed: {len(changes.added)} added, {len(changes.removed)} removed, "
+              f"{len(changes.modified)} modified, {index.get_image_count()} in the library")
+        dict_of_images = index.get_image_paths_by_aspect_ratio()
+        for i in range(GENERAL_SETTINGS["watch_collages_per_change"]):
+            output_path = generate_collage(next_collage_id, batch_seed, dict_of_images, output_directory)
+            print(f"generated collage #{next_collage_id}: {output_path}")
+            next_collage_id += 1
+
+
+def generate_mosaic(target_image_path: str, image_directory: str = "test_images_3/", output_directory: str = "output/",
+                    columns: int = None) -> str:
+    """
+    Builds a photo mosaic of target_image_path out of the images in image_directory and saves it. Every image of
+    the library is described by its colors from its smallest proxy first, then each cell of the target gets the
+    closest image in bulk.
+    :param columns: number of cells across, GENERAL_SETTINGS["mosaic_columns"] when None
+    :return: the output path
+    """
+    governor = memory_governor.MemoryGovernor(GENERAL_SETTINGS["memory_ceiling_mb"] * 1024 * 1024,
+                                              GENERAL_SETTINGS["memory_block_timeout_seconds"])
+    memory_governor.set_default_governor(governor)
+    with instrumentation.stage(instrumentation.STAGE_SCAN):
+        feature_index = photo_mosaic.create_color_feature_index(get_list_of_images_from_directory(image_directory),
+                                                                GENERAL_SETTINGS["scan_probe_threads"])
+    with instrumentation.stage(instrumentation.STAGE_LAYOUT):
+        mosaic = photo_mosaic.create_photo_mosaic(target_image_path, feature_index,
+                                                  columns if columns is not None else GENERAL_SETTINGS["mosaic_columns"],
+                                                  cell_size=GENERAL_SETTINGS["mosaic_cell_size"],
+                                                  max_uses_per_image=GENERAL_SETTINGS["mosaic_max_uses_per_image"],
+                                                  seed=GENERAL_SETTINGS["seed"],
+                                                  fill_mode=GENERAL_SETTINGS["fill_mode"])
+
+    os.makedirs(output_directory, exist_ok=True)
+    output_path = os.path.join(output_directory, f"mosaic_{mosaic.get_fingerprint()}.jpg")
+    previous_cache = image_cache.get_active_cache()
+    if previous_cache is None:
+        image_cache.set_active_cache(image_cache.ImageCache(GENERAL_SETTINGS["mosaic_image_cache_mb"] * 1024 * 1024))
+    try:
+        image = render_collage(mosaic)
+    finally:
+        image_cache.set_active_cache(previous_cache)
+    with instrumentation.stage(instrumentation.STAGE_ENCODE):
+        write_image_file(output_path, image)
+    return output_path
+
+
+def create_aspect_ratio_index(image_directory: str) -> image_index.AspectRatioIndex:
+    # same grouping as create_aspect_ratio_sorted_list_of_images_from_directory(), but kept up to date incrementally.
+    # perceptual hashes are kept up to date with it when near duplicates are filtered
+    hash_index = None
+    if GENERAL_SETTINGS["near_duplicate_max_distance"] is not None:
+        hash_index = perceptual_hash.PerceptualHashIndex()
+    return image_index.AspectRatioIndex(image_directory, SUPPORTED_IMAGE_EXTENSIONS, ASPECT_RATIO_RANGES.keys(),
+                                        lambda width, height: get_aspect_ratio_dict_key(get_aspect_ratio(width, height)),
+                                        GENERAL_SETTINGS["scan_probe_threads"], hash_index)
+
+
+def activate_near_duplicate_filter(dict_of_images: dict):
+    """
+    Hashes the images of the pool and makes populate_bottom_level_containers() keep near duplicates apart, when
+    GENERAL_SETTINGS["near_duplicate_max_distance"] is set
+    """
+    hash_index = None
+    if GENERAL_SETTINGS["near_duplicate_max_distance"] is not None:
+        hash_index = create_perceptual_hash_index(dict_of_images)
+    perceptual_hash.set_active_hash_index(hash_index)
+
+
+def create_perceptual_hash_index(dict_of_images: dict) -> perceptual_hash.PerceptualHashIndex:
+    # hashing decodes a small proxy of every image. cv2 releases the GIL so the probe threads run it in parallel
+    hash_index = perceptual_hash.PerceptualHashIndex()
+    image_paths = [image_path for image_paths in dict_of_images.values() for image_path in image_paths]
+    with ThreadPoolExecutor(max_workers=GENERAL_SETTINGS["scan_probe_threads"]) as executor:
+        for image_path, image_hash in zip(image_paths, executor.map(perceptual_hash.hash_image_file, image_paths)):
+            if image_hash is not None:
+                hash_index.add(image_path, image_hash)
+    return hash_index
+
+
+class _LeaseHeartbeat(threading.Thread):
+    """Extends the lease of a job at a fixed interval until stopped. Uses its own queue connection."""
+
+    def __init__(self, queue_path: str, collage_id: int, worker_id: str, interval_seconds: float):
+        super().__init__(daemon=True)
+        self._queue_path = queue_path
+        self._collage_id = collage_id
+        self._worker_id = worker_id
+        self._interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+
+    def run(self):
+        queue = job_queue.JobQueue(self._queue_path)
+        while not self._stopped.wait(self._interval_seconds):
+            queue.heartbeat(self._collage_id, self._worker_id)
+        queue.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def generate_collage(collage_id: int, batch_seed, dict_of_images: dict, output_directory: str,
+                     resolution: str = "1080p") -> str:
+    """
+    Plans, renders and saves one collage of a batch. The same collage_id and batch_seed always give the same collage.
+    :return: the output path
+    """
+    stage_timing = instrumentation.get_active_instrumentation()
+    if stage_timing is not None:
+        stage_timing.begin_collage(collage_id)
+    main_container = plan_seeded_collage(batch_seed, collage_id, dict_of_images, resolution)
+
+    # the output is named after the content so identical collages map to the same file and are only rendered once
+    fingerprint = main_container.get_fingerprint()
+    output_path = os.path.join(output_directory, f"collage_{fingerprint}.jpg")
+    if os.path.exists(output_path):
+        if stage_timing is not None:
+            stage_timing.end_collage(output_path=output_path, skipped=True)
+        return output_path
+
+    profiler = None
+    if GENERAL_SETTINGS["render_profile_directory"] is not None:
+        profiler = render_profiler.RenderProfiler()
+    render_profiler.set_active_profiler(profiler)
+    collage = render_collage(main_container)
+    render_profiler.set_active_profiler(None)
+    if profiler is not None:
+        profile_path = os.path.join(GENERAL_SETTINGS["render_profile_directory"], f"collage_{fingerprint}")
+        profiler.write_tree(profile_path + ".txt")
+        profiler.write_folded_stacks(profile_path + ".folded")
+
+    with instrumentation.stage(instrumentation.STAGE_ENCODE):
+        write_image_file(output_path, collage)
+    if stage_timing is not None:
+        stage_timing.add_counter(instrumentation.COUNTER_BYTES_WRITTEN, os.path.getsize(output_path))
+        stage_timing.end_collage(output_path=output_path)
+    return output_path
+
+
+def render_collage(main_container: LayoutContainer):
+    """
+    Draws a planned collage, splitting the tree between GENERAL_SETTINGS["render_threads"] threads
+    """
+    if GENERAL_SETTINGS["render_threads"] <= 1:
+        return main_container.get_drawable_image()
+    return main_container.get_drawable_image_parallel(get_render_executor())
+
+
+def get_render_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool of GENERAL_SETTINGS["render_threads"] threads, created on first use and reused across collages.
+    Safe to call from several threads. A new pool is made when the setting changes. The previous pool is not shut
+    down, renders still drawing on it finish and its threads exit once it is no longer referenced
+    """
+    global _render_executor, _render_executor_threads
+    render_threads = max(int(GENERAL_SETTINGS["render_threads"]), 1)
+    with _render_executor_lock:
+        if _render_executor is None or _render_executor_threads != render_threads:
+            _render_executor = ThreadPoolExecutor(max_workers=render_threads, thread_name_prefix="render")
+            _render_executor_threads = render_threads
+        return _render_executor
+
+
+def plan_collage(dict_of_images: dict, resolution: str = "1080p") -> LayoutContainer:
+    """
+    Generates a random layout and fills it with images picked from dict_of_images. Nothing is decoded yet.
+    dict_of_images is not modified.
+    :return: the main container
+    """
+    copy_of_dict_of_images = copy.deepcopy(dict_of_images)
+    with instrumentation.stage(instrumentation.STAGE_LAYOUT):
+        main_container, bottom_level_containers = generate_random_layouts(resolution)
+    with instrumentation.stage(instrumentation.STAGE_POPULATE):
         populate_bottom_level_containers(bottom_level_containers, copy_of_dict_of_images)
-        cv2.imwrite(f"output/collage_{file_name_int}.jpg", main_container.get_drawable_image())
-        print(f"generated image #{i} of {num_to_generate}"  )
-
-def populate_bottom_level_containers(bottom_level_containers : List, dict_of_images: dict):
+    return main_container
+
+
+def plan_seeded_collage(batch_seed, collage_id: int, dict_of_images: dict, resolution: str = "1080p") -> LayoutContainer:
+    """
+    Plans collage collage_id of a batch. Safe to call from several threads: planning draws from the global random
+    module, so collages are planned one at a time to keep every collage reproducible from its seed.
+    """
+    with _planning_lock:
+        seed_collage(batch_seed, collage_id)
+        return plan_collage(dict_of_images, resolution)
+
+
+def new_batch_seed() -> int:
+    """
+    :return: a seed for a batch started without one. Safe to call while other threads plan collages
+    """
+    return _seed_random.randrange(2 ** 32)
+
+
+def seed_collage(batch_seed, collage_id: int):
+    # string seeds are hashed with sha512 by random.seed, so this is stable across processes and python runs
+    random.seed(f"{batch_seed}-{collage_id}")
+
+
+def write_image_file(output_path: str, image):
+    """
+    Encodes the image by the file extension and writes it under a temporary name first, so an output that exists
+    under its final name is always complete.
+    """
+    success, encoded_image = cv2.imencode(os.path.splitext(output_path)[1], image)
+    if not success:
+        raise Exception(f"Could not encode {output_path}")
+    partial_path = get_partial_output_path(output_path)
+    with open(partial_path, "wb") as file:
+        file.write(encoded_image.tobytes())
+    os.replace(partial_path, output_path)
+
+
+def get_partial_output_path(output_path: str) -> str:
+    return output_path + get_partial_output_suffix()
+
+
+def get_partial_output_suffix() -> str:
+    return f".{socket.gethostname()}-{os.getpid()}{PARTIAL_OUTPUT_SUFFIX}"
+
+
+def remove_partial_outputs(output_directory: str):
+    """
+    Removes the partial outputs of this process and those of other processes that are stale, i.e. left behind by
+    a run that died. Partial outputs another running process is writing are kept.
+    """
+    own_suffix = get_partial_output_suffix()
+    stale_time = time.time() - PARTIAL_OUTPUT_STALE_SECONDS
+    for file in os.listdir(output_directory):
+        if not file.endswith(PARTIAL_OUTPUT_SUFFIX):
+            continue
+        path = os.path.join(output_directory, file)
+        try:
+            if file.endswith(own_suffix) or os.path.getmtime(path) < stale_time:
+                os.remove(path)
+        except FileNotFoundError:
+            # the process writing it finished in the meantime
+            pass
+
+
+def get_shard_collage_ids(num_to_generate: int, shard_index: int, shard_count: int) -> range:
+    """
+    Collage ids generated by one shard. Interleaving (rather than contiguous blocks) spreads slow collages evenly.
+    """
+    if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+        raise Exception(f"Invalid shard {shard_index} of {shard_count}")
+    return range(shard_index, num_to_generate, shard_count)
+
+
+def get_shard_image_pool(dict_of_images: dict, image_directory: str, shard_index: int, shard_count: int) -> dict:
+    """
+    Keeps the images that belong to a shard. Images are assigned by a hash of their path relative to
+    image_directory, so every machine agrees on the assignment even when the library is mounted elsewhere.
+    :return: a new dictionary with the same keys as dict_of_images
+    """
+    shard_pool = {}
+    for aspect_ratio_type, image_paths in dict_of_images.items():
+        shard_pool[aspect_ratio_type] = [image_path for image_path in image_paths
+                                         if get_image_shard(image_path, image_directory, shard_count) == shard_index]
+    return shard_pool
+
+
+def get_image_shard(image_path: str, image_directory: str, shard_count: int) -> int:
+    relative_path = os.path.relpath(image_path, image_directory).replace(os.sep, "/")
+    return int(hashlib.sha1(relative_path.encode("utf-8")).hexdigest()[:8], 16) % shard_count
+
+
+def get_image_pool_digest(dict_of_images: dict) -> str:
+    # identifies the image pool a batch was planned with, to detect a changed corpus when resuming
+    digest = hashlib.sha256()
+    for aspect_ratio_type in sorted(dict_of_images.keys()):
+        digest.update(aspect_ratio_type.encode("utf-8"))
+        for image_path in dict_of_images[aspect_ratio_type]:
+            digest.update(image_path.encode("utf-8"))
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=4)
+def get_image_filter(description: str):
+    """
+    :return: the image_filter.ImageFilter described, compiled once and shared by every collage. None for None
+    """
+    if description is None:
+        return None
+    return image_filter.create_filter_from_description(description)
+
+
+@functools.lru_cache(maxsize=16)
+def validate_caption_format(caption_format: str):
+    """
+    Checks a caption format before any collage is planned, so a typo does not stop a batch partway through.
+    Formats that pass are remembered, so checking before every collage costs nothing
+    :raise ValueError: if the format is malformed or uses a field that is not in CAPTION_FIELDS
+    """
+    try:
+        fields = [field_name for _, field_name, _, _ in string.Formatter().parse(caption_format)
+                  if field_name is not None]
+    except ValueError as e:
+        raise ValueError(f"Invalid caption format {caption_format!r}: {e}")
+    for field_name in fields:
+        if field_name not in CAPTION_FIELDS:
+            raise ValueError(f"Unknown caption field {{{field_name}}}, the fields are "
+                             f"{', '.join(CAPTION_FIELDS)}")
+
+
+def get_caption_text(image_path: str, caption_format: str) -> str:
+    """
+    :param caption_format: see GENERAL_SETTINGS["caption_format"]
+    :return: the caption of an image, None when it would be blank
+    """
+    header = image_header.read_image_header(image_path)
+    capture_date, capture_time = "", ""
+    camera = ""
+    if header is not None:
+        if header.capture_time is not None:
+            # EXIF writes "YYYY:MM:DD HH:MM:SS"
+            capture_date, _, capture_time = header.capture_time.partition(" ")
+            capture_date = capture_date.replace(":", "-")
+        camera = " ".join(name for name in (header.camera_make, header.camera_model) if name)
+    text = caption_format.format(date=capture_date, time=capture_time, camera=camera,
+                                 file_name=os.path.basename(image_path)).strip()
+    return text if len(text) > 0 else None
+
+
+def create_image_frame(image_path: str):
+    """
+    Creates the frame of one collage image with the filter, caption and fill mode of GENERAL_SETTINGS. The image is
+    only decoded when the collage is drawn, at the size it ends up in the layout
+    :return: the image_frame_container.ImageFrameContainer, or None if the image could not be read
+    """
+    try:
+        image = Image(source_path=image_path)
+    except LayoutException:
+        return None
+    caption_format = GENERAL_SETTINGS["caption_format"]
+    fill_mode = GENERAL_SETTINGS["fill_mode"]
+    if fill_mode == image_frame_container.FILL_MODE_COVER and GENERAL_SETTINGS["fill_center_of_interest"]:
+        image.set_center_of_interest_estimated()
+    frame_padding = (0, 0, GENERAL_SETTINGS["caption_height"], 0) if caption_format is not None else (0, 0, 0, 0)
+    image_frame = layout_containers_factory.create_image_frame_container(image, frame_padding, (235, 235, 235))
+    frame_filter = get_image_filter(GENERAL_SETTINGS["image_filter"])
+    if frame_filter is not None:
+        image_frame.set_filter(frame_filter)
+    if fill_mode != image_frame_container.FILL_MODE_FIT:
+        image_frame.set_fill_mode(fill_mode)
+    if caption_format is not None:
+        image_frame.set_caption(get_caption_text(image_path, caption_format), GENERAL_SETTINGS["caption_color"])
+    return image_frame
 
 
+def populate_bottom_level_containers(bottom_level_containers : List, dict_of_images: dict):
+    # the caption format can be set by any caller of the pipeline, not only main.py, so it is checked before the
+    # first image is placed rather than failing on the first image with a caption
+    if GENERAL_SETTINGS["caption_format"] is not None:
+        validate_caption_format(GENERAL_SETTINGS["caption_format"])
+
+    # images of one collage are kept apart from each other's near duplicates when a hash index is active
+    near_duplicate_filter = None
+    hash_index = perceptual_hash.get_active_hash_index()
+    if hash_index is not None:
+        max_distance = GENERAL_SETTINGS["near_duplicate_max_distance"]
+        near_duplicate_filter = perceptual_hash.NearDuplicateFilter(
+            hash_index, max_distance if max_distance is not None else perceptual_hash.DEFAULT_MAX_DISTANCE)
 
     for container in bottom_level_containers:
         heuristic_name = None
@@ -171,11 +752,16 @@ def populate_bottom_level_containers(bottom_level_containers : List, dict_of_ima
 
             for aspect_ratio_type in heuristic["aspect_ratio_preference_order"]:
                 if (len(dict_of_images[aspect_ratio_type]) > 0):
-                    image_path = get_random_item_from_list_then_remove(dict_of_images[aspect_ratio_type])
-                    image = Image(open_image_file(image_path))
-                    image_frame = layout_containers_factory.create_image_frame_container(image, (0, 0, 0, 0), (235, 235, 235))
+                    image_path = pick_image_path(dict_of_images[aspect_ratio_type], near_duplicate_filter)
+                    if image_path is None:
+                        continue
+                    image_frame = create_image_frame(image_path)
+                    if image_frame is None:
+                        continue
                     if container.can_next_item_fit(image_frame):
                         container.add_item(image_frame)
+                        if near_duplicate_filter is not None:
+                            near_duplicate_filter.add_placed_image(image_path)
                         break
                 else:
                     continue
@@ -186,9 +772,9 @@ def populate_bottom_level_containers(bottom_level_containers : List, dict_of_ima
 
 
 
-def generate_random_layouts():
+def generate_random_layouts(random_resolution: str = "1080p"):
     # generate main layout first, choose biggest canvas first
-    random_resolution = "1080p" # random.choice(list(SCREEN_RESOLUTIONS.keys()))
+    # random_resolution = random.choice(list(SCREEN_RESOLUTIONS.keys()))
     resolution_width = SCREEN_RESOLUTIONS[random_resolution][0]
     resolution_height = SCREEN_RESOLUTIONS[random_resolution][1]
 
@@ -362,28 +948,42 @@ def get_unused_space_for_eligible_layouts(eligible_layouts_for_dimensions: List,
     return unused_width + unused_height
 
 
-# open every image in the directory to analyze all of them for aspect ratio
+# read the header of every image in the directory to find its aspect ratio
 # put them into a dictionary for each aspect ratio.
-# to prevent using too much memory at once, open files one by one and only
-# save the image path instead of the image.
+# to prevent using too much memory at once, files are streamed from the directory walk and only
+# the image path is saved instead of the image.
 def create_aspect_ratio_sorted_list_of_images_from_directory(directory: str):
-    image_paths = get_list_of_images_from_directory(directory)
     # create aspect_ratio dict with the same keys as ASPECT_RATIO_RANGES
     image_paths_by_aspect_ratio_dict = {}
     for key in ASPECT_RATIO_RANGES.keys():
         image_paths_by_aspect_ratio_dict[key] = []
-    # loop through all images and sort them into the aspect_ratio_dict
-    for image_path in image_paths:
-        image = open_image_file(image_path)
-        if image is not None:
-            width, height = get_image_width_and_height(image)
-            aspect_ratio = get_aspect_ratio(width, height)
-            aspect_ratio_key = get_aspect_ratio_dict_key(aspect_ratio)
-            if aspect_ratio_key is not None:
-                image_paths_by_aspect_ratio_dict[aspect_ratio_key].append(image_path)
+    # sort images into the aspect_ratio_dict as the walk finds them, only headers are read
+    for image_path, dimensions in image_ingestor.iter_probed_images(directory, SUPPORTED_IMAGE_EXTENSIONS,
+                                                                    GENERAL_SETTINGS["scan_walker_threads"],
+                                                                    GENERAL_SETTINGS["scan_probe_threads"]):
+        add_image_to_aspect_ratio_dict(image_paths_by_aspect_ratio_dict, image_path, dimensions)
+    # the walk is concurrent so the order is not defined, sort so the same directory always gives the same image pool
+    for image_paths in image_paths_by_aspect_ratio_dict.values():
+        image_paths.sort()
     return image_paths_by_aspect_ratio_dict
 
 
+def add_image_to_aspect_ratio_dict(image_paths_by_aspect_ratio_dict: dict, image_path: str, dimensions: tuple):
+    """
+    Files an image under its aspect ratio range. Images that could not be read or whose aspect ratio is outside
+    every range are left out.
+    :return: the aspect ratio key the image was added to, or None
+    """
+    if dimensions is None:
+        return None
+    width, height = dimensions
+    aspect_ratio = get_aspect_ratio(width, height)
+    aspect_ratio_key = get_aspect_ratio_dict_key(aspect_ratio)
+    if aspect_ratio_key is not None:
+        image_paths_by_aspect_ratio_dict[aspect_ratio_key].append(image_path)
+    return aspect_ratio_key
+
+
 def get_image_width_and_height(image):
     return image.shape[1], image.shape[0]
 
@@ -400,29 +1000,19 @@ def get_aspect_ratio(width, height):
 
 
 def get_list_of_images_from_directory(directory: str):
-    # create a list of images
-    image_paths = []
     # get a list of all image files from folder first. Supported image extensions are in SUPPORTED_IMAGE_EXTENSIONS, file extensions should be case insensitive
-    #recurse into subdirectories and do the same
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.split(".")[-1].lower() in SUPPORTED_IMAGE_EXTENSIONS:
-                image_paths.append(os.path.join(root, file))
-
-
-    # for f in os.listdir(directory):
-    #     full_path = os.path.join(directory, f)
-    #     if os.path.isfile(full_path) and f.split(".")[-1].lower() in SUPPORTED_IMAGE_EXTENSIONS:
-    #         image_paths.append(full_path)
-
+    # recurses into subdirectories. For large libraries use image_ingestor.iter_image_files() directly to avoid
+    # holding the whole list
+    image_paths = list(image_ingestor.iter_image_files(directory, SUPPORTED_IMAGE_EXTENSIONS,
+                                                       GENERAL_SETTINGS["scan_walker_threads"]))
+    # the walk does not guarantee an order, sort so the same directory always gives the same image pool
+    image_paths.sort()
     return image_paths
-    # loop through all image files
 
 
 def open_image_file(imagepath: str):
     # not performing checks here since input will be from get_list_ofImages_from_directory()
-    img = cv2.imread(imagepath)
-    return img
+    return image_decoder.decode_image(imagepath)
 
 
 def random_open_x_images(x: int, image_paths: list) -> List:
@@ -434,6 +1024,19 @@ def random_open_x_images(x: int, image_paths: list) -> List:
     return images
 
 
+def pick_image_path(image_paths: List, near_duplicate_filter: perceptual_hash.NearDuplicateFilter = None):
+    """
+    Picks a random image and removes it from image_paths. Near duplicates of the images already placed are removed
+    and skipped, they would be rejected again by every later pick of the collage.
+    :return: the image path, or None when image_paths ran out
+    """
+    while len(image_paths) > 0:
+        image_path = get_random_item_from_list_then_remove(image_paths)
+        if near_duplicate_filter is None or not near_duplicate_filter.is_near_duplicate(image_path):
+            return image_path
+    return None
+
+
 def get_random_item_from_list_then_remove(items: List):
     item = random.choice(items)
     items.remove(item)
@@ -1,10 +1,96 @@
+import argparse
+import sys
 
 import layouts_generator
+import render_service
+import slideshow
+from src import job_queue
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    layouts_generator.run()
-
-
+    parser = argparse.ArgumentParser(description="Generate a batch of collages")
+    parser.add_argument("--images", default="test_images_3/", help="directory of source images")
+    parser.add_argument("--output", default="output/", help="directory to save the collages in")
+    parser.add_argument("--count", type=int, default=500, help="number of collages to generate")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the batch, re-runs with a seed repeat the batch")
+    parser.add_argument("--journal", default=None, help="record progress in this file so the batch can be resumed")
+    parser.add_argument("--resume", action="store_true", help="continue the batch recorded in --journal")
+    parser.add_argument("--shard", default="0/1", help="generate only shard k of n of the batch, written as k/n")
+    parser.add_argument("--partition-images", action="store_true",
+                        help="also split the images between shards so no two shards use the same image")
+    parser.add_argument("--queue", default=None, help="SQLite work queue file shared by worker processes")
+    parser.add_argument("--enqueue", action="store_true", help="create the batch in --queue and exit")
+    parser.add_argument("--worker", action="store_true", help="generate collages leased from --queue")
+    parser.add_argument("--queue-stats", action="store_true", help="print the depth and throughput of --queue")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and generate new collages whenever the images change")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP render service on --host and --port")
+    parser.add_argument("--host", default=None, help="address the render service listens on")
+    parser.add_argument("--port", type=int, default=None, help="port the render service listens on")
+    parser.add_argument("--render-threads", type=int, default=None,
+                        help="threads drawing independent parts of each collage at once")
+    parser.add_argument("--mosaic", default=None, metavar="TARGET",
+                        help="build a photo mosaic of this image out of the images in --images")
+    parser.add_argument("--mosaic-columns", type=int, default=None, help="number of mosaic cells across")
+    parser.add_argument("--near-duplicate-distance", type=int, default=None,
+                        help="keep images whose perceptual hashes differ in at most this many bits out of the same "
+                             "collage")
+    parser.add_argument("--filter", default=None,
+                        help="filter every image, e.g. sepia,vignette or a .cube LUT file. Presets: "
+                             "grayscale, sepia, vignette, fade, warm, cool")
+    parser.add_argument("--caption", default=None, metavar="FORMAT",
+                        help="caption every image, e.g. \"{date}  {camera}\". Fields: date, time, camera, file_name")
+    parser.add_argument("--fill", choices=["fit", "cover"], default=None,
+                        help="fit shows whole images, cover fills every cell and crops the images to it")
+    parser.add_argument("--center-of-interest", action="store_true",
+                        help="with --fill cover, center crops on the detail in each image instead of its middle")
+    parser.add_argument("--slideshow", default=None, metavar="VIDEO",
+                        help="write a video slideshow of collages of the images in --images to this file")
+    parser.add_argument("--slideshow-seconds", type=float, default=60, help="length of the slideshow")
+    parser.add_argument("--transition", choices=[slideshow.TRANSITION_CROSSFADE, slideshow.TRANSITION_SWAP],
+                        default=None, help="crossfade between collages, or swap one image of a collage at a time")
+    args = parser.parse_args()
+    if args.seed is not None:
+        layouts_generator.GENERAL_SETTINGS["seed"] = args.seed
+    if args.render_threads is not None:
+        layouts_generator.GENERAL_SETTINGS["render_threads"] = args.render_threads
+    if args.near_duplicate_distance is not None:
+        layouts_generator.GENERAL_SETTINGS["near_duplicate_max_distance"] = args.near_duplicate_distance
+    if args.filter is not None:
+        layouts_generator.GENERAL_SETTINGS["image_filter"] = args.filter
+    if args.caption is not None:
+        try:
+            layouts_generator.validate_caption_format(args.caption)
+        except ValueError as e:
+            parser.error(str(e))
+        layouts_generator.GENERAL_SETTINGS["caption_format"] = args.caption
+    if args.fill is not None:
+        layouts_generator.GENERAL_SETTINGS["fill_mode"] = args.fill
+    if args.center_of_interest:
+        layouts_generator.GENERAL_SETTINGS["fill_center_of_interest"] = True
+    if args.queue is not None:
+        if args.enqueue:
+            layouts_generator.enqueue_batch(args.queue, args.images, args.output, args.count)
+        if args.worker:
+            layouts_generator.run_worker(args.queue)
+        if args.queue_stats:
+            print(job_queue.JobQueue(args.queue).get_stats())
+        sys.exit(0)
 
+    if args.serve:
+        render_service.serve(args.images, args.host, args.port)
+        sys.exit(0)
+    if args.slideshow is not None:
+        print(slideshow.generate_slideshow(args.images, args.slideshow, args.slideshow_seconds, args.transition,
+                                           layouts_generator.GENERAL_SETTINGS["seed"]))
+        sys.exit(0)
+    if args.mosaic is not None:
+        print(layouts_generator.generate_mosaic(args.mosaic, args.images, args.output, args.mosaic_columns))
+        sys.exit(0)
+    if args.watch:
+        layouts_generator.watch(args.images, args.output)
+        sys.exit(0)
 
+    shard_index, shard_count = (int(number) for number in args.shard.split("/"))
+    layouts_generator.run(args.images, args.output, args.count, args.journal, args.resume, shard_index, shard_count,
+                          args.partition_images)
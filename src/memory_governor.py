@@ -0,0 +1,225 @@
+import math
+import threading
+import weakref
+
+import numpy as np
+
+# categories of memory that are tracked by the governor
+CATEGORY_IMAGE = "image"
+CATEGORY_CANVAS = "canvas"
+CATEGORY_CACHE = "cache"
+CATEGORIES = (CATEGORY_IMAGE, CATEGORY_CANVAS, CATEGORY_CACHE)
+
+# decode scales supported by cv2.imread through the IMREAD_REDUCED_* flags, from full size to smallest
+DECODE_SCALES = (1, 2, 4, 8)
+
+
+class MemoryGovernor:
+    """
+    Keeps count of the bytes held by decoded images, container canvases and caches across the render pipeline.
+
+    Arrays are registered with track() and are released automatically when numpy frees them, so the
+    governor never has to be told when an image or canvas goes out of scope.
+
+    When a ceiling is configured, decoding asks the governor for a decode scale via choose_decode_scale().
+    If a full size decode would go over the ceiling, the governor first spills to a lower decode scale, then blocks
+    (up to block_timeout seconds) waiting for other threads to release memory. A ceiling of 0 disables the limit
+    but usage and peak usage are still recorded.
+
+    The bytes of the chosen decode are reserved until the decoded array is tracked (or the reservation released),
+    so threads decoding at the same time cannot all see the same room and go over the ceiling together.
+    """
+
+    def __init__(self, ceiling_bytes: int = 0, block_timeout: float = 0.0):
+        self._ceiling_bytes = max(int(ceiling_bytes), 0)
+        self._block_timeout = max(float(block_timeout), 0.0)
+        self._condition = threading.Condition()
+        self._usage_by_category = {category: 0 for category in CATEGORIES}
+        self._peak_usage_by_category = {category: 0 for category in CATEGORIES}
+        self._usage = 0
+        self._peak_usage = 0
+        # bytes of decodes chosen by choose_decode_scale() that are not tracked yet
+        self._reserved = 0
+        # ids of the arrays currently tracked, so an array handed from one stage to the next is only counted once
+        self._tracked_array_ids = set()
+        # number of decodes that were done at a lower scale than requested to stay under the ceiling
+        self._spill_count = 0
+        # number of decodes that went over the ceiling because even the smallest scale did not fit
+        self._overcommit_count = 0
+
+    def get_ceiling(self) -> int:
+        return self._ceiling_bytes
+
+    def get_usage(self, category: str = None) -> int:
+        """
+        Gets the number of bytes currently held
+        :param category: one of CATEGORIES, or None for the total of all categories
+        :return: number of bytes
+        """
+        with self._condition:
+            if category is None:
+                return self._usage
+            return self._usage_by_category[category]
+
+    def get_peak_usage(self) -> int:
+        return self._peak_usage
+
+    def has_room(self, nbytes: int) -> bool:
+        """
+        Checks whether nbytes can be allocated without going over the ceiling
+        :param nbytes: number of bytes to be allocated
+        :return: True if there is no ceiling or if the allocation fits under the ceiling
+        """
+        if self._ceiling_bytes == 0:
+            return True
+        with self._condition:
+            return self._fits(nbytes)
+
+    def wait_for_room(self, nbytes: int, timeout: float) -> bool:
+        """
+        Blocks until nbytes fits under the ceiling or until the timeout expires
+        :param nbytes: number of bytes to be allocated
+        :param timeout: maximum number of seconds to wait
+        :return: True if there is room, False if the timeout expired first
+        """
+        if self._ceiling_bytes == 0:
+            return True
+        with self._condition:
+            return self._condition.wait_for(lambda: self._fits(nbytes), timeout)
+
+    def track(self, array: np.ndarray, category: str, reserved_bytes: int = 0) -> np.ndarray:
+        """
+        Registers an array with the governor. The bytes are released once the array is garbage collected.
+        Registering the same array again does nothing.
+        Only register arrays that own their memory, views share the memory of their base array.
+
+        :param array: the numpy array to track
+        :param category: one of CATEGORIES
+        :param reserved_bytes: reservation made for the array by choose_decode_scale(), replaced by the array
+        :return: the same array, for convenience
+        """
+        if array is None:
+            self.release_reservation(reserved_bytes)
+            return array
+        array_id = id(array)
+        nbytes = int(array.nbytes)
+        with self._condition:
+            self._release_reservation(reserved_bytes)
+            if array_id in self._tracked_array_ids:
+                return array
+            self._tracked_array_ids.add(array_id)
+            self._add(nbytes, category)
+        weakref.finalize(array, self._release, nbytes, category, array_id)
+        return array
+
+    def choose_decode_scale(self, width: int, height: int, channels: int = 3, minimum_scale: int = 1) -> int:
+        """
+        Chooses the largest decode scale that keeps the decoded image under the ceiling.
+        Falls back to lower decode scales first and then blocks for up to block_timeout seconds before
+        overcommitting with the smallest scale.
+
+        The size of the decode at the returned scale, get_decoded_size(width, height, scale, channels), is reserved.
+        Pass it to track() along with the decoded array, or to release_reservation() if the decode failed.
+
+        :param width: width of the image at full size
+        :param height: height of the image at full size
+        :param channels: number of channels of the decoded image
+        :param minimum_scale: smallest reduction factor to consider, for when the caller already knows a reduced
+        decode is good enough
+        :return: one of DECODE_SCALES. 1 means full size, 2 means half the width and height, etc.
+        """
+        eligible_scales = [scale for scale in DECODE_SCALES if scale >= minimum_scale] or [DECODE_SCALES[-1]]
+        with self._condition:
+            # checked and reserved under one lock, so concurrent decodes see each other's reservations
+            for scale in eligible_scales:
+                nbytes = get_decoded_size(width, height, scale, channels)
+                if self._ceiling_bytes == 0 or self._fits(nbytes):
+                    if scale > eligible_scales[0]:
+                        self._spill_count += 1
+                    self._reserved += nbytes
+                    return scale
+
+            smallest_scale = eligible_scales[-1]
+            nbytes = get_decoded_size(width, height, smallest_scale, channels)
+            has_room = self._condition.wait_for(lambda: self._fits(nbytes), self._block_timeout)
+            self._spill_count += 1
+            if not has_room:
+                self._overcommit_count += 1
+            self._reserved += nbytes
+            return smallest_scale
+
+    def release_reservation(self, nbytes: int):
+        """
+        Gives back bytes reserved by choose_decode_scale() for a decode that did not produce an array
+        """
+        if nbytes == 0:
+            return
+        with self._condition:
+            self._release_reservation(nbytes)
+
+    def get_report(self) -> dict:
+        """
+        Summary of memory usage, suitable for logging
+        :return: a dictionary with current / peak usage in bytes and the number of spills and overcommits
+        """
+        with self._condition:
+            return {
+                "ceiling_bytes": self._ceiling_bytes,
+                "usage_bytes": self._usage,
+                "peak_usage_bytes": self._peak_usage,
+                "reserved_bytes": self._reserved,
+                "usage_bytes_by_category": dict(self._usage_by_category),
+                "peak_usage_bytes_by_category": dict(self._peak_usage_by_category),
+                "spill_count": self._spill_count,
+                "overcommit_count": self._overcommit_count,
+            }
+
+    # whether nbytes more fit under the ceiling next to what is held and reserved. Call with the condition held
+    def _fits(self, nbytes: int) -> bool:
+        return self._usage + self._reserved + nbytes <= self._ceiling_bytes
+
+    # call with the condition held
+    def _release_reservation(self, nbytes: int):
+        if nbytes == 0:
+            return
+        self._reserved = max(self._reserved - nbytes, 0)
+        self._condition.notify_all()
+
+    def _add(self, nbytes: int, category: str):
+        with self._condition:
+            self._usage += nbytes
+            self._usage_by_category[category] += nbytes
+            self._peak_usage = max(self._peak_usage, self._usage)
+            self._peak_usage_by_category[category] = max(self._peak_usage_by_category[category],
+                                                         self._usage_by_category[category])
+
+    def _release(self, nbytes: int, category: str, array_id: int):
+        with self._condition:
+            self._tracked_array_ids.discard(array_id)
+            self._usage -= nbytes
+            self._usage_by_category[category] -= nbytes
+            self._condition.notify_all()
+
+
+def get_decoded_size(width: int, height: int, scale: int = 1, channels: int = 3) -> int:
+    """
+    Number of bytes an 8 bit image takes once decoded at the given scale
+    """
+    return math.ceil(width / scale) * math.ceil(height / scale) * channels
+
+
+# governor shared by the whole render pipeline. It has no ceiling by default so it only records usage.
+_default_governor = MemoryGovernor()
+
+
+def get_default_governor() -> MemoryGovernor:
+    return _default_governor
+
+
+def set_default_governor(governor: MemoryGovernor):
+    """
+    Replaces the governor used by the render pipeline. Call this before any images are opened since
+    arrays that are already tracked stay with the previous governor.
+    """
+    global _default_governor
+    _default_governor = governor
@@ -0,0 +1,147 @@
+import threading
+
+import cv2
+import numpy as np
+
+from src import image_decoder
+
+# side of the grayscale proxy the DCT is taken of, and of the block of lowest frequencies that makes up the hash.
+# the hash only looks at a 32x32 version of the image, so it is computed from the smallest proxy available
+HASH_IMAGE_SIZE = 32
+HASH_BLOCK_SIZE = 8
+# images whose hashes differ in at most this many of the 64 bits count as near duplicates. Burst shots and
+# re-encodes of the same photo are usually within a few bits, unrelated photos around 32 apart
+DEFAULT_MAX_DISTANCE = 10
+
+
+def compute_perceptual_hash(image: np.ndarray) -> int:
+    """
+    Computes the 64 bit DCT perceptual hash of BGR pixels. Each bit tells whether one of the 8x8 lowest frequencies
+    of the image is above their median, which survives resizing, re-encoding and small edits.
+    """
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    gray_image = cv2.resize(gray_image, (HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+    frequencies = cv2.dct(gray_image.astype(np.float32))[:HASH_BLOCK_SIZE, :HASH_BLOCK_SIZE].flatten()
+    # the DC term is left out of the median, it only carries the overall brightness
+    bits = frequencies > np.median(frequencies[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hash_image_file(image_path: str):
+    """
+    Computes the perceptual hash of an image file from its smallest proxy: the EXIF thumbnail when there is one,
+    otherwise a 1/8 scale decode
+    :return: the hash, or None if the image could not be read
+    """
+    image = image_decoder.decode_smallest_proxy(image_path)
+    if image is None:
+        return None
+    return compute_perceptual_hash(image)
+
+
+def get_hamming_distances(hashes: np.ndarray, perceptual_hash: int) -> np.ndarray:
+    """
+    :param hashes: uint64 array of hashes
+    :return: number of differing bits between every hash in hashes and perceptual_hash
+    """
+    return np.bitwise_count(hashes ^ np.uint64(perceptual_hash))
+
+
+class PerceptualHashIndex:
+    """
+    Perceptual hashes of a library, kept in one uint64 array so a hash can be compared against every image at once
+    with a vectorized XOR and popcount.
+
+    Removed images leave a free row behind that is reused by the next image added, so the array never needs
+    compacting.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(max(int(initial_capacity), 1), dtype=np.uint64)
+        # image path -> row in _hashes, and the reverse for rows in use
+        self._rows_by_path = {}
+        self._paths_by_row = {}
+        self._free_rows = []
+        self._row_count = 0
+
+    def __len__(self) -> int:
+        return len(self._rows_by_path)
+
+    def add(self, image_path: str, perceptual_hash: int):
+        with self._lock:
+            row = self._rows_by_path.get(image_path)
+            if row is None:
+                row = self._free_rows.pop() if len(self._free_rows) > 0 else self._add_row()
+                self._rows_by_path[image_path] = row
+                self._paths_by_row[row] = image_path
+            self._hashes[row] = perceptual_hash
+
+    def remove(self, image_path: str):
+        with self._lock:
+            row = self._rows_by_path.pop(image_path, None)
+            if row is not None:
+                del self._paths_by_row[row]
+                self._free_rows.append(row)
+
+    def get_hash(self, image_path: str):
+        """
+        :return: the hash of an image, or None if it is not in the index
+        """
+        row = self._rows_by_path.get(image_path)
+        return int(self._hashes[row]) if row is not None else None
+
+    def find_near_duplicates(self, perceptual_hash: int, max_distance: int = DEFAULT_MAX_DISTANCE) -> list:
+        """
+        Compares a hash against the whole library in one pass
+        :return: paths of the images within max_distance bits of perceptual_hash, closest first
+        """
+        with self._lock:
+            distances = get_hamming_distances(self._hashes[:self._row_count], perceptual_hash)
+            rows = np.flatnonzero(distances <= max_distance)
+            rows = rows[np.argsort(distances[rows], kind="stable")]
+            return [self._paths_by_row[row] for row in rows.tolist() if row in self._paths_by_row]
+
+    def _add_row(self) -> int:
+        if self._row_count == len(self._hashes):
+            hashes = np.zeros(len(self._hashes) * 2, dtype=np.uint64)
+            hashes[:self._row_count] = self._hashes
+            self._hashes = hashes
+        self._row_count += 1
+        return self._row_count - 1
+
+
+class NearDuplicateFilter:
+    """
+    Keeps the hashes of the images placed in one collage and rejects candidates that are near duplicates of any of
+    them, e.g. the other shots of a burst. Images without a hash are never rejected.
+    """
+
+    def __init__(self, hash_index: PerceptualHashIndex, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self._hash_index = hash_index
+        self._max_distance = max_distance
+        self._placed_hashes = np.zeros(0, dtype=np.uint64)
+
+    def is_near_duplicate(self, image_path: str) -> bool:
+        perceptual_hash = self._hash_index.get_hash(image_path)
+        if perceptual_hash is None or len(self._placed_hashes) == 0:
+            return False
+        return bool(get_hamming_distances(self._placed_hashes, perceptual_hash).min() <= self._max_distance)
+
+    def add_placed_image(self, image_path: str):
+        perceptual_hash = self._hash_index.get_hash(image_path)
+        if perceptual_hash is not None:
+            self._placed_hashes = np.append(self._placed_hashes, np.uint64(perceptual_hash))
+
+
+# hash index used while populating collages. None (the default) places images without looking for near duplicates
+_active_hash_index = None
+
+
+def get_active_hash_index():
+    return _active_hash_index
+
+
+def set_active_hash_index(hash_index: PerceptualHashIndex):
+    global _active_hash_index
+    _active_hash_index = hash_index
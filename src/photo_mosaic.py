@@ -0,0 +1,222 @@
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import layout_containers_factory
+from src import image_decoder, image_header
+from src.layout.container_item import ContainerItem
+from src.layout.grid_container import GridContainer
+from src.layout.image import Image
+from src.layout.image_frame_container import FILL_MODE_COVER, FILL_MODE_FIT
+from src.layout_exception import LayoutException
+
+# an image is described by the mean Lab color of each cell of a FEATURE_GRID_SIZE x FEATURE_GRID_SIZE grid over it,
+# so library images are matched on where the light and the colors are, not only on their average color
+FEATURE_GRID_SIZE = 2
+FEATURE_LENGTH = FEATURE_GRID_SIZE * FEATURE_GRID_SIZE * 3
+# best matches kept per mosaic cell. Cells only search further once all of them are used up
+NEAREST_CANDIDATES = 8
+# mosaic cells compared with the library at once, bounds the distance matrix to SEARCH_CHUNK_CELLS x library size
+SEARCH_CHUNK_CELLS = 256
+DEFAULT_MAX_USES_PER_IMAGE = 2
+# the smallest cell containers accept, see ContainerItem.DEFAULT_MINIMUM_CONTENT_WIDTH. Images are only letterboxed
+# with bars in the color of the target once cells are large enough to leave the image at least that size
+DEFAULT_CELL_SIZE = 50
+
+
+def compute_color_feature(image: np.ndarray) -> np.ndarray:
+    """
+    :param image: BGR pixels, any size
+    :return: float32 vector of FEATURE_LENGTH values
+    """
+    grid_image = cv2.resize(image, (FEATURE_GRID_SIZE, FEATURE_GRID_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(grid_image, cv2.COLOR_BGR2Lab).astype(np.float32).reshape(-1)
+
+
+def compute_image_file_feature(image_path: str):
+    """
+    Computes the color feature of an image file from its smallest proxy
+    :return: the feature, or None if the image could not be read
+    """
+    image = image_decoder.decode_smallest_proxy(image_path)
+    if image is None:
+        return None
+    return compute_color_feature(image)
+
+
+class ColorFeatureIndex:
+    """
+    Color features of a library in one float32 array, one row per image, searched in bulk with matrix products.
+    """
+
+    def __init__(self, image_paths: list, features: np.ndarray):
+        self._image_paths = list(image_paths)
+        self._features = np.asarray(features, dtype=np.float32).reshape(-1, FEATURE_LENGTH)
+        # squared norms of the rows, reused by every search
+        self._squared_norms = np.einsum("ij,ij->i", self._features, self._features)
+
+    def __len__(self) -> int:
+        return len(self._image_paths)
+
+    def get_image_path(self, row: int) -> str:
+        return self._image_paths[row]
+
+    def get_features(self) -> np.ndarray:
+        return self._features
+
+    def find_nearest(self, query_features: np.ndarray, count: int = NEAREST_CANDIDATES) -> np.ndarray:
+        """
+        Finds the count nearest images of every query at once
+        :param query_features: array of queries x FEATURE_LENGTH
+        :return: int array of queries x count rows of the index, nearest first
+        """
+        count = min(count, len(self))
+        nearest_rows = np.empty((len(query_features), count), dtype=np.int64)
+        for start in range(0, len(query_features), SEARCH_CHUNK_CELLS):
+            queries = query_features[start:start + SEARCH_CHUNK_CELLS]
+            # squared distances up to the squared norm of the query, which is the same for every image
+            distances = self._squared_norms[None, :] - 2 * queries @ self._features.T
+            if count < len(self):
+                rows = np.argpartition(distances, count - 1, axis=1)[:, :count]
+            else:
+                rows = np.broadcast_to(np.arange(len(self)), distances.shape)
+            order = np.argsort(np.take_along_axis(distances, rows, axis=1), axis=1, kind="stable")
+            nearest_rows[start:start + len(queries)] = np.take_along_axis(rows, order, axis=1)
+        return nearest_rows
+
+    def find_nearest_among(self, query_feature: np.ndarray, rows: np.ndarray) -> int:
+        """
+        :return: the row among rows nearest to a single query
+        """
+        distances = self._squared_norms[rows] - 2 * self._features[rows] @ query_feature
+        return int(rows[np.argmin(distances)])
+
+
+def create_color_feature_index(image_paths: list, threads: int = 8) -> ColorFeatureIndex:
+    """
+    Computes the color feature of every image. Images that cannot be read are left out
+    """
+    indexed_paths = []
+    features = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for image_path, feature in zip(image_paths, executor.map(compute_image_file_feature, image_paths)):
+            if feature is not None:
+                indexed_paths.append(image_path)
+                features.append(feature)
+    return ColorFeatureIndex(indexed_paths, np.array(features, dtype=np.float32).reshape(-1, FEATURE_LENGTH))
+
+
+def compute_cell_features(target_image: np.ndarray, rows: int, columns: int) -> np.ndarray:
+    """
+    Splits the target image into rows x columns cells and describes each like compute_color_feature() does
+    :return: array of (rows * columns) x FEATURE_LENGTH, row by row
+    """
+    grid_image = cv2.resize(target_image, (columns * FEATURE_GRID_SIZE, rows * FEATURE_GRID_SIZE),
+                            interpolation=cv2.INTER_AREA)
+    lab_image = cv2.cvtColor(grid_image, cv2.COLOR_BGR2Lab).astype(np.float32)
+    cells = lab_image.reshape(rows, FEATURE_GRID_SIZE, columns, FEATURE_GRID_SIZE, 3).transpose(0, 2, 1, 3, 4)
+    return np.ascontiguousarray(cells.reshape(rows * columns, FEATURE_LENGTH))
+
+
+def assign_images(cell_features: np.ndarray, feature_index: ColorFeatureIndex, max_uses_per_image: int,
+                  seed=None) -> list:
+    """
+    Picks a library image for every cell, using no image more than max_uses_per_image times.
+
+    Cells take turns in a random order so no part of the mosaic gets first pick of the best matches. Each cell takes
+    the nearest of its NEAREST_CANDIDATES that still has uses left, and only searches the rest of the library
+    when all of them are used up.
+    :return: row of the index for every cell
+    """
+    if len(feature_index) == 0:
+        raise LayoutException("There are no readable images to build the mosaic from")
+    if max_uses_per_image * len(feature_index) < len(cell_features):
+        raise LayoutException(f"{len(feature_index)} images used at most {max_uses_per_image} times each cannot "
+                              f"fill {len(cell_features)} cells")
+    candidates = feature_index.find_nearest(cell_features, NEAREST_CANDIDATES)
+    uses = np.zeros(len(feature_index), dtype=np.int64)
+    assigned_rows = [0] * len(cell_features)
+    cell_order = list(range(len(cell_features)))
+    random.Random(seed).shuffle(cell_order)
+    for cell in cell_order:
+        for row in candidates[cell].tolist():
+            if uses[row] < max_uses_per_image:
+                break
+        else:
+            row = feature_index.find_nearest_among(cell_features[cell], np.flatnonzero(uses < max_uses_per_image))
+        uses[row] += 1
+        assigned_rows[cell] = row
+    return assigned_rows
+
+
+def create_photo_mosaic(target_image_path: str, feature_index: ColorFeatureIndex, columns: int, rows: int = None,
+                        cell_size: int = DEFAULT_CELL_SIZE, max_uses_per_image: int = DEFAULT_MAX_USES_PER_IMAGE,
+                        seed=None, fill_mode: str = FILL_MODE_FIT) -> GridContainer:
+    """
+    Plans a photo mosaic: a grid where every cell shows the library image closest in color to that part of the
+    target image. Nothing but the target is decoded, draw the grid like any collage.
+
+    :param target_image_path: the image the mosaic reproduces
+    :param feature_index: the library, see create_color_feature_index()
+    :param columns: number of cells across
+    :param rows: number of cells down, None to keep the aspect ratio of the target with square cells
+    :param cell_size: width and height of a cell in pixels, at least DEFAULT_CELL_SIZE
+    :param max_uses_per_image: how often the same image may appear. Raised as far as needed when the library is too
+    small to fill every cell otherwise
+    :param seed: the same seed and library always give the same mosaic
+    :param fill_mode: FILL_MODE_FIT letterboxes images in their cells, FILL_MODE_COVER crops them to fill the cells
+    :return: the grid container
+    """
+    header = image_header.read_image_header(target_image_path)
+    if header is None:
+        raise LayoutException(f"Could not read image {target_image_path}")
+    if rows is None:
+        rows = max(round(columns * header.height / header.width), 1)
+    # the cells only need FEATURE_GRID_SIZE pixels each, decode no larger than that
+    decode_scale = image_decoder.get_decode_scale_for_target(header.width, header.height, columns * FEATURE_GRID_SIZE,
+                                                             rows * FEATURE_GRID_SIZE)
+    target_image = image_decoder.decode_image(target_image_path, decode_scale, (header.width, header.height),
+                                              header.orientation)
+    if target_image is None:
+        raise LayoutException(f"Could not read image {target_image_path}")
+
+    cell_features = compute_cell_features(target_image, rows, columns)
+    max_uses_per_image = max(max_uses_per_image, math.ceil(len(cell_features) / max(len(feature_index), 1)))
+    assigned_rows = assign_images(cell_features, feature_index, max_uses_per_image, seed)
+
+    # images are letterboxed to fill their cell, with bars in the color of that part of the target so they blend in.
+    # where the cell is too small for the bars, the rest of the cell shows the average color of the target
+    cell_colors = cv2.resize(target_image, (columns, rows), interpolation=cv2.INTER_AREA).reshape(-1, 3)
+    mean_color = tuple(int(channel) for channel in cell_colors.mean(axis=0)[::-1])
+    grid = layout_containers_factory.create_grid_container(columns * cell_size, rows * cell_size, rows, columns,
+                                                           background_color=mean_color)
+    for row, cell_color in zip(assigned_rows, cell_colors.tolist()):
+        image = Image(source_path=feature_index.get_image_path(row))
+        if fill_mode == FILL_MODE_COVER:
+            image.resize_to_cover(cell_size, cell_size)
+            image_frame = layout_containers_factory.create_image_frame_container(image, (0, 0, 0, 0))
+            image_frame.set_fill_mode(FILL_MODE_COVER)
+            grid.add_item(image_frame)
+            continue
+        padding = get_letterbox_padding(image.get_width(), image.get_height(), cell_size)
+        # padding is in pixels, so the image is brought to its final size before it is framed
+        image.resize_to_limit(cell_size - padding[1] - padding[3], cell_size - padding[0] - padding[2])
+        grid.add_item(layout_containers_factory.create_image_frame_container(image, padding, tuple(cell_color[::-1])))
+    return grid
+
+
+def get_letterbox_padding(width: int, height: int, cell_size: int) -> tuple:
+    """
+    :return: (top, right, bottom, left) padding that centers an image of the given aspect ratio in a square cell.
+    No padding when the image would end up smaller than containers accept
+    """
+    image_size = round(cell_size * min(width, height) / max(width, height))
+    if image_size < ContainerItem.DEFAULT_MINIMUM_CONTENT_WIDTH:
+        return 0, 0, 0, 0
+    bars = cell_size - image_size
+    if width >= height:
+        return bars // 2, 0, bars - bars // 2, 0
+    return 0, bars - bars // 2, 0, bars // 2
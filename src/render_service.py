@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+
+import layouts_generator
+from src import image_cache, memory_governor, perceptual_hash
+
+SERVICE_SETTINGS = {
+    "host": "127.0.0.1",
+    "port": 8080,
+    # collages rendered at once, further requests wait for a free render thread
+    "render_threads": 4,
+    # decoded images kept between requests. Repeated images are served without touching the disk
+    "image_cache_mb": 512,
+    # seconds between checks of the image directory for added, removed or modified images
+    "index_refresh_seconds": 30.0,
+    "jpeg_quality": 90
+}
+
+
+class RenderService:
+    """
+    Renders collages on request in one long running process, so the interpreter, cv2, the aspect ratio index and
+    the decoded images all stay warm between requests.
+
+    The index is kept up to date by a background thread that applies only what changed in the image directory.
+    Renders run on a fixed pool of threads and are encoded in memory, nothing is written to disk.
+    """
+
+    def __init__(self, image_directory: str, render_threads: int = 4, image_cache_mb: int = 512,
+                 index_refresh_seconds: float = 30.0):
+        self._index = layouts_generator.create_aspect_ratio_index(image_directory)
+        self._index_lock = threading.Lock()
+        # snapshot of the index used for planning, replaced as a whole after every refresh
+        self._dict_of_images = {}
+        self._image_cache = image_cache.ImageCache(image_cache_mb * 1024 * 1024)
+        self._executor = ThreadPoolExecutor(max_workers=render_threads)
+        self._index_refresh_seconds = index_refresh_seconds
+        self._stopped = threading.Event()
+        self._refresh_thread = threading.Thread(target=self._refresh_periodically, daemon=True)
+        # render statistics, updated by every render thread
+        self._stats_lock = threading.Lock()
+        self._render_count = 0
+        self._render_seconds = 0.0
+
+    def start(self):
+        image_cache.set_active_cache(self._image_cache)
+        perceptual_hash.set_active_hash_index(self._index.get_hash_index())
+        self.refresh_index()
+        self._refresh_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._executor.shutdown()
+        image_cache.set_active_cache(None)
+        perceptual_hash.set_active_hash_index(None)
+
+    def refresh_index(self):
+        """
+        Applies the changes in the image directory to the index
+        :return: the changed image paths, see image_index.IndexChanges
+        """
+        with self._index_lock:
+            changes = self._index.refresh()
+            self._dict_of_images = self._index.get_image_paths_by_aspect_ratio()
+        return changes
+
+    def render_collage(self, resolution: str = "1080p", seed=None, collage_id: int = 0, quality: int = 90):
+        """
+        Plans and renders one collage. The same seed, collage_id and image library always give the same collage.
+        :return: (JPEG bytes, collage fingerprint)
+        """
+        if resolution not in layouts_generator.SCREEN_RESOLUTIONS:
+            raise ValueError(f"Unknown resolution {resolution}")
+        if seed is None:
+            seed = layouts_generator.new_batch_seed()
+        start_time = time.perf_counter()
+        # collages are planned one at a time, rendering (where the time goes) runs in parallel
+        main_container = layouts_generator.plan_seeded_collage(seed, collage_id, self._dict_of_images, resolution)
+        collage = main_container.get_drawable_image()
+        success, encoded_image = cv2.imencode(".jpg", collage, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not success:
+            raise Exception("Could not encode the collage")
+        render_seconds = time.perf_counter() - start_time
+        with self._stats_lock:
+            self._render_count += 1
+            self._render_seconds += render_seconds
+        return encoded_image.tobytes(), main_container.get_fingerprint()
+
+    def submit_render(self, resolution: str = "1080p", seed=None, collage_id: int = 0, quality: int = 90):
+        """
+        Queues render_collage() on the render threads
+        :return: a future of (JPEG bytes, collage fingerprint)
+        """
+        return self._executor.submit(self.render_collage, resolution, seed, collage_id, quality)
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            render_count = self._render_count
+            render_seconds = self._render_seconds
+        return {
+            "image_count": self._index.get_image_count(),
+            "render_count": render_count,
+            "mean_render_milliseconds": 1000 * render_seconds / render_count if render_count else 0,
+            "image_cache": self._image_cache.get_stats(),
+            "memory": memory_governor.get_default_governor().get_report(),
+        }
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self._index_refresh_seconds):
+            changes = self.refresh_index()
+            if len(changes.added) + len(changes.removed) + len(changes.modified) > 0:
+                print(f"images changed: {len(changes.added)} added, {len(changes.removed)} removed, "
+                      f"{len(changes.modified)} modified")
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /collage?resolution=1080p&seed=1&id=0&quality=90   renders a collage and returns it as image/jpeg.
+                                                           All parameters are optional, without a seed every
+                                                           request gets a new collage
+    GET /stats                                             index size, render times, cache and memory usage
+    POST /refresh                                          checks the image directory for changes right away
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/collage":
+            self._handle_collage(parse_qs(url.query))
+        elif url.path == "/stats":
+            self._send_json(200, self.server.render_service.get_stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/refresh":
+            changes = self.server.render_service.refresh_index()
+            self._send_json(200, {"added": len(changes.added), "removed": len(changes.removed),
+                                  "modified": len(changes.modified)})
+        else:
+            self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def _handle_collage(self, query: dict):
+        try:
+            resolution = query.get("resolution", ["1080p"])[0]
+            seed = int(query["seed"][0]) if "seed" in query else None
+            collage_id = int(query.get("id", ["0"])[0])
+            quality = int(query.get("quality", [SERVICE_SETTINGS["jpeg_quality"]])[0])
+            if resolution not in layouts_generator.SCREEN_RESOLUTIONS:
+                raise ValueError(f"Unknown resolution {resolution}")
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        start_time = time.perf_counter()
+        try:
+            jpeg_bytes, fingerprint = self.server.render_service.submit_render(resolution, seed, collage_id,
+                                                                               quality).result()
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(jpeg_bytes)))
+        self.send_header("X-Collage-Fingerprint", fingerprint)
+        self.send_header("X-Render-Milliseconds", f"{1000 * (time.perf_counter() - start_time):.1f}")
+        self.end_headers()
+        self.wfile.write(jpeg_bytes)
+
+    def _send_json(self, status: int, body: dict):
+        encoded_body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+
+def serve(image_directory: str, host: str = None, port: int = None):
+    """
+    Runs the render service until interrupted
+    """
+    host = host if host is not None else SERVICE_SETTINGS["host"]
+    port = port if port is not None else SERVICE_SETTINGS["port"]
+    governor = memory_governor.MemoryGovernor(layouts_generator.GENERAL_SETTINGS["memory_ceiling_mb"] * 1024 * 1024,
+                                              layouts_generator.GENERAL_SETTINGS["memory_block_timeout_seconds"])
+    memory_governor.set_default_governor(governor)
+    service = RenderService(image_directory, SERVICE_SETTINGS["render_threads"], SERVICE_SETTINGS["image_cache_mb"],
+                            SERVICE_SETTINGS["index_refresh_seconds"])
+    service.start()
+    server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    server.daemon_threads = True
+    server.render_service = service
+    print(f"serving collages of {image_directory} on http://{host}:{port}/collage")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
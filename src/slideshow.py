@@ -0,0 +1,260 @@
+import itertools
+import random
+
+import cv2
+import numpy as np
+
+import layouts_generator
+from src import image_cache, memory_governor
+from src.layout.container_item import ContainerItem
+from src.layout.image_frame_container import ImageFrameContainer
+from src.layout.layout_container import LayoutContainer, get_bounding_rectangle
+
+# crossfade blends from one whole collage to the next, swap keeps one collage and replaces a single image at a time
+TRANSITION_CROSSFADE = "crossfade"
+TRANSITION_SWAP = "swap"
+
+SLIDESHOW_SETTINGS = {
+    "resolution": "1080p",
+    "fps": 30,
+    # how long every collage (crossfade) or every state of the collage (swap) is shown, not counting the transition
+    "seconds_per_slide": 10.0,
+    "transition_seconds": 1.0,
+    "transition": TRANSITION_CROSSFADE,
+    # four character code of the codec, must be supported by the cv2 build for the output file extension
+    "fourcc": "mp4v",
+    # decoded images kept while the slideshow is made, so a swapped out image that comes back is not decoded again
+    "image_cache_mb": 256
+}
+
+
+class SlideshowWriter:
+    """
+    Streams the frames of a slideshow to a cv2.VideoWriter as they are made. Only the frame on screen is kept,
+    plus one frame to blend crossfades into, so memory does not grow with the length of the video.
+
+    Usage:
+        with SlideshowWriter("loop.mp4", 1920, 1080) as writer:
+            writer.show(first_collage)
+            writer.hold(10)
+            writer.crossfade_to(second_collage, 1)
+    """
+
+    def __init__(self, output_path: str, width: int, height: int, fps: float = 30, fourcc: str = "mp4v"):
+        self._writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if not self._writer.isOpened():
+            raise Exception(f"Could not open {output_path} for writing with codec {fourcc}")
+        self._fps = fps
+        self._width = width
+        self._height = height
+        # the frame on screen, owned by the writer so callers can reuse or change their images afterwards
+        self._frame = np.zeros((height, width, 3), dtype=np.uint8)
+        # scratch frame for whole frame crossfades, allocated on the first one
+        self._blended_frame = None
+        self._frame_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def get_frame_count(self) -> int:
+        return self._frame_count
+
+    def get_seconds(self) -> float:
+        return self._frame_count / self._fps
+
+    def show(self, image: np.ndarray):
+        """
+        Cuts to image and writes it as one frame
+        """
+        self._frame[:] = image
+        self._write(self._frame)
+
+    def hold(self, seconds: float):
+        """
+        Keeps the frame on screen for seconds. The same frame is handed to the encoder again, nothing is copied
+        """
+        for _ in range(self._get_frame_count_for(seconds)):
+            self._write(self._frame)
+
+    def crossfade_to(self, image: np.ndarray, seconds: float):
+        """
+        Blends from the frame on screen to image over seconds, ending on image
+        """
+        if self._blended_frame is None:
+            self._blended_frame = np.empty_like(self._frame)
+        steps = self._get_frame_count_for(seconds)
+        for step in range(1, steps):
+            weight = step / steps
+            cv2.addWeighted(self._frame, 1 - weight, image, weight, 0, dst=self._blended_frame)
+            self._write(self._blended_frame)
+        self.show(image)
+
+    def crossfade_region_to(self, rectangle: tuple, region_image: np.ndarray, seconds: float):
+        """
+        Blends one rectangle of the frame on screen to region_image over seconds, e.g. a single cell of a collage.
+        Only the pixels of the rectangle are touched, the rest of the frame is reused as it is.
+        :param rectangle: (x_origin, y_origin, x_end, y_end) in frame coordinates
+        :param region_image: the new pixels of the rectangle
+        """
+        x_origin, y_origin, x_end, y_end = rectangle
+        region = self._frame[y_origin:y_end, x_origin:x_end]
+        old_region = region.copy()
+        steps = self._get_frame_count_for(seconds)
+        for step in range(1, steps):
+            weight = step / steps
+            cv2.addWeighted(old_region, 1 - weight, region_image, weight, 0, dst=region)
+            self._write(self._frame)
+        region[:] = region_image
+        self._write(self._frame)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+    def _get_frame_count_for(self, seconds: float) -> int:
+        return max(int(round(seconds * self._fps)), 1)
+
+    def _write(self, frame: np.ndarray):
+        self._writer.write(frame)
+        self._frame_count += 1
+
+
+def write_crossfade_slideshow(writer: SlideshowWriter, dict_of_images: dict, duration_seconds: float, seed,
+                              resolution: str, seconds_per_slide: float, transition_seconds: float):
+    """
+    Shows collage after collage of a seeded batch, crossfading between them. Only the collage on screen and the
+    next one exist at a time
+    """
+    for collage_id in itertools.count():
+        main_container = layouts_generator.plan_seeded_collage(seed, collage_id, dict_of_images, resolution)
+        collage = layouts_generator.render_collage(main_container)
+        if collage_id == 0:
+            writer.show(collage)
+        else:
+            writer.crossfade_to(collage, transition_seconds)
+        writer.hold(seconds_per_slide)
+        if writer.get_seconds() >= duration_seconds:
+            return
+
+
+def write_swap_slideshow(writer: SlideshowWriter, dict_of_images: dict, duration_seconds: float, seed,
+                         resolution: str, seconds_per_slide: float, transition_seconds: float):
+    """
+    Shows one collage and keeps replacing a random image of it with an unused image, crossfading only the cell that
+    changed. Images of the same aspect ratio type as the one replaced are preferred, they fill the cell the same way.
+
+    The collage keeps its composites (see LayoutContainer.set_retain_composite()), so after a swap only the
+    rectangle of the changed cell is redrawn, along the path from the cell to the root, instead of the whole collage.
+    """
+    main_container = layouts_generator.plan_seeded_collage(seed, 0, dict_of_images, resolution)
+    main_container.set_retain_composite(True)
+    writer.show(main_container.get_drawable_image())
+    writer.hold(seconds_per_slide)
+
+    image_frames = get_image_frames(main_container)
+    if len(image_frames) == 0:
+        return
+    aspect_ratio_types = {image_path: aspect_ratio_type for aspect_ratio_type, image_paths in dict_of_images.items()
+                          for image_path in image_paths}
+    shown_image_paths = {get_image_path(image_frame) for image_frame in image_frames}
+    random_generator = random.Random(f"{seed}-swap")
+    while writer.get_seconds() < duration_seconds:
+        index = random_generator.randrange(len(image_frames))
+        old_frame = image_frames[index]
+        old_image_path = get_image_path(old_frame)
+        candidates = [image_path for image_path in dict_of_images.get(aspect_ratio_types.get(old_image_path), [])
+                      if image_path not in shown_image_paths]
+        if len(candidates) == 0:
+            candidates = [image_path for image_path in aspect_ratio_types if image_path not in shown_image_paths]
+        new_frame = None
+        while new_frame is None and len(candidates) > 0:
+            new_frame = layouts_generator.create_image_frame(
+                candidates.pop(random_generator.randrange(len(candidates))))
+        if new_frame is None:
+            # every image is on screen already, keep the collage as it is
+            writer.hold(seconds_per_slide)
+            continue
+
+        old_rectangle = get_rectangle_in_root(old_frame)
+        old_frame.get_parent().replace_item(old_frame, new_frame)
+        image_frames[index] = new_frame
+        shown_image_paths.discard(old_image_path)
+        shown_image_paths.add(get_image_path(new_frame))
+        # the cell may be letterboxed differently now, fade everything either frame covered
+        x_origin, y_origin, x_end, y_end = get_bounding_rectangle(old_rectangle, get_rectangle_in_root(new_frame))
+        collage = main_container.get_drawable_image()
+        writer.crossfade_region_to((x_origin, y_origin, x_end, y_end), collage[y_origin:y_end, x_origin:x_end],
+                                   transition_seconds)
+        writer.hold(seconds_per_slide)
+
+
+def generate_slideshow(image_directory: str, output_path: str, duration_seconds: float, transition: str = None,
+                       seed=None) -> int:
+    """
+    Makes a video loop of collages of the images in image_directory with the settings in SLIDESHOW_SETTINGS.
+    Frames are encoded as they are made, so the length of the video does not affect memory use.
+    :param duration_seconds: minimum length of the video, the last slide is always shown for its full time
+    :param transition: TRANSITION_CROSSFADE or TRANSITION_SWAP, SLIDESHOW_SETTINGS["transition"] when None
+    :param seed: the same seed and images always give the same video. None picks one
+    :return: number of frames written
+    """
+    transition = transition if transition is not None else SLIDESHOW_SETTINGS["transition"]
+    if transition not in (TRANSITION_CROSSFADE, TRANSITION_SWAP):
+        raise ValueError(f"Unknown transition {transition}")
+    if seed is None:
+        seed = layouts_generator.new_batch_seed()
+    governor = memory_governor.MemoryGovernor(layouts_generator.GENERAL_SETTINGS["memory_ceiling_mb"] * 1024 * 1024,
+                                              layouts_generator.GENERAL_SETTINGS["memory_block_timeout_seconds"])
+    memory_governor.set_default_governor(governor)
+    dict_of_images = layouts_generator.create_aspect_ratio_sorted_list_of_images_from_directory(image_directory)
+    width, height = layouts_generator.SCREEN_RESOLUTIONS[SLIDESHOW_SETTINGS["resolution"]]
+    write_slideshow = write_crossfade_slideshow if transition == TRANSITION_CROSSFADE else write_swap_slideshow
+
+    previous_cache = image_cache.get_active_cache()
+    image_cache.set_active_cache(image_cache.ImageCache(SLIDESHOW_SETTINGS["image_cache_mb"] * 1024 * 1024))
+    try:
+        with SlideshowWriter(output_path, width, height, SLIDESHOW_SETTINGS["fps"],
+                             SLIDESHOW_SETTINGS["fourcc"]) as writer:
+            write_slideshow(writer, dict_of_images, duration_seconds, seed, SLIDESHOW_SETTINGS["resolution"],
+                            SLIDESHOW_SETTINGS["seconds_per_slide"], SLIDESHOW_SETTINGS["transition_seconds"])
+            return writer.get_frame_count()
+    finally:
+        image_cache.set_active_cache(previous_cache)
+
+
+def get_image_frames(item: ContainerItem) -> list:
+    """
+    :return: the image frames in item, in drawing order
+    """
+    if isinstance(item, ImageFrameContainer):
+        return [item]
+    image_frames = []
+    if isinstance(item, LayoutContainer):
+        for child in item.get_items_copy():
+            image_frames.extend(get_image_frames(child))
+    return image_frames
+
+
+def get_image_path(image_frame: ImageFrameContainer) -> str:
+    return image_frame.get_item(0).get_source_path()
+
+
+def get_rectangle_in_root(item: ContainerItem) -> tuple:
+    """
+    :return: (x_origin, y_origin, x_end, y_end) of item in the coordinates of the top container of its tree
+    """
+    x_origin, y_origin = 0, 0
+    width, height = item.get_width(), item.get_height()
+    while item.get_parent() is not None:
+        parent = item.get_parent()
+        item_x_origin, item_y_origin = parent.get_item_rectangle(item)[:2]
+        x_origin += item_x_origin
+        y_origin += item_y_origin
+        item = parent
+    return x_origin, y_origin, x_origin + width, y_origin + height
+
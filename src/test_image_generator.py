@@ -1,6 +1,11 @@
+import math
 import numpy as np
 import cv2
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+from src.aspect_ratios import ASPECT_RATIO_RANGES
+from src.layout import caption
 
 # declare a dictionary of constants for 20 common colors as RGB tuples with the color name as the key
 COLORS = {
@@ -32,6 +37,15 @@ COLORS = {
 DEFAULT_DIRECTORY = "test_images_generated/"
 DEFAULT_WIDTH_OR_HEIGHT = 300
 DEFAULT_FONT_FACE = cv2.FONT_HERSHEY_SIMPLEX
+# text is drawn at a font scale of at most MAX_FONT_SCALE_STEPS / 10
+MAX_FONT_SCALE_STEPS = 59
+
+# defaults for create_corpus()
+DEFAULT_CORPUS_DIRECTORY = "test_images_corpus/"
+DEFAULT_CORPUS_SHORT_SIDE_RANGE = (480, 3000)
+DEFAULT_CORPUS_FORMATS = {"jpg": 0.9, "png": 0.1}
+# number of images written per worker task and per subdirectory. Keeps directories small for huge corpora
+CORPUS_CHUNK_SIZE = 500
 
 
 # create a function that loops through the COLORS dictionary and creates an image for each color. It can optionally take in a number range for width and height. If one is supllied, randomly generate each image within that width / height range. If an exact number is supplied, use that for the respective width and height. If no number is supplied, call create_and_save_image without width and height because it has a default anyways. This can also optionally take in a parameter for the directory, if none supplied, use the default one. should save the images with filenames that are numbered from 1 to the length of the COLORS dictionary (e.g. 1.jpg, 2.jpg). Also use the name of the color and save that as text on the image.
@@ -46,6 +60,89 @@ def create_images_for_colors(width_range: tuple = None, height_range: tuple = No
         create_and_save_image(width, height, COLORS[color], str(i + 1) + ".jpg", directory, color)
 
 
+# create a seeded corpus of num_of_images solid color images with a mix of resolutions, aspect ratios and formats.
+# specs for every image are drawn up front from the seed so the corpus is identical no matter how many workers write it.
+# images are written in parallel by worker processes, one subdirectory of CORPUS_CHUNK_SIZE images per task
+def create_corpus(num_of_images: int, directory: str = DEFAULT_CORPUS_DIRECTORY, seed: int = 0,
+                  short_side_range: tuple = DEFAULT_CORPUS_SHORT_SIDE_RANGE, aspect_ratio_weights: dict = None,
+                  formats: dict = None, add_labels: bool = False, workers: int = None) -> list:
+    """
+    :param num_of_images: number of images to create
+    :param directory: where to save the images, created if it does not exist
+    :param seed: the same seed always produces the same corpus
+    :param short_side_range: (min, max) length of the shorter side, the longer side follows from the aspect ratio
+    :param aspect_ratio_weights: relative weight of each key of ASPECT_RATIO_RANGES, defaults to equal weights
+    :param formats: relative weight of each file extension (e.g. {"jpg": 0.9, "png": 0.1})
+    :param add_labels: write the image number on each image. Slower but makes the images tell apart in a collage
+    :param workers: number of processes writing images, defaults to the number of cpus
+    :return: the list of file paths created, in image number order
+    """
+    specs = create_corpus_specs(num_of_images, seed, short_side_range, aspect_ratio_weights, formats)
+    chunks = [specs[start:start + CORPUS_CHUNK_SIZE] for start in range(0, len(specs), CORPUS_CHUNK_SIZE)]
+    if not directory.endswith(os.sep):
+        directory = directory + os.sep
+
+    paths = []
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            paths.extend(save_corpus_chunk(chunk, directory, add_labels))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(save_corpus_chunk, chunk, directory, add_labels) for chunk in chunks]
+            for future in futures:
+                paths.extend(future.result())
+    return paths
+
+
+# draw the width, height, color and format of every image of the corpus in one go with vectorized numpy calls
+def create_corpus_specs(num_of_images: int, seed: int, short_side_range: tuple = DEFAULT_CORPUS_SHORT_SIDE_RANGE,
+                        aspect_ratio_weights: dict = None, formats: dict = None) -> list:
+    """
+    :return: list of (image number, width, height, RGB color tuple, file extension)
+    """
+    rng = np.random.default_rng(seed)
+    if aspect_ratio_weights is None:
+        aspect_ratio_weights = {key: 1 for key in ASPECT_RATIO_RANGES.keys()}
+    if formats is None:
+        formats = DEFAULT_CORPUS_FORMATS
+
+    aspect_ratio_keys = list(aspect_ratio_weights.keys())
+    aspect_ratio_probabilities = np.array([aspect_ratio_weights[key] for key in aspect_ratio_keys], dtype=float)
+    aspect_ratio_probabilities = aspect_ratio_probabilities / aspect_ratio_probabilities.sum()
+    format_keys = list(formats.keys())
+    format_probabilities = np.array([formats[key] for key in format_keys], dtype=float)
+    format_probabilities = format_probabilities / format_probabilities.sum()
+
+    chosen_ranges = rng.choice(len(aspect_ratio_keys), size=num_of_images, p=aspect_ratio_probabilities)
+    range_bounds = np.array([ASPECT_RATIO_RANGES[key] for key in aspect_ratio_keys])
+    aspect_ratios = rng.uniform(range_bounds[chosen_ranges, 0], range_bounds[chosen_ranges, 1])
+    short_sides = rng.integers(short_side_range[0], short_side_range[1], size=num_of_images, endpoint=True)
+    colors = rng.integers(0, 256, size=(num_of_images, 3))
+    chosen_formats = rng.choice(len(format_keys), size=num_of_images, p=format_probabilities)
+
+    # aspect ratio in this project is width / height
+    widths = np.where(aspect_ratios >= 1, short_sides * aspect_ratios, short_sides).astype(int)
+    heights = np.where(aspect_ratios >= 1, short_sides, short_sides / aspect_ratios).astype(int)
+
+    specs = []
+    for i in range(num_of_images):
+        specs.append((i + 1, int(widths[i]), int(heights[i]), tuple(int(c) for c in colors[i]),
+                      format_keys[chosen_formats[i]]))
+    return specs
+
+
+# write one chunk of corpus images into its own numbered subdirectory. Runs inside the worker processes
+def save_corpus_chunk(specs: list, directory: str, add_labels: bool) -> list:
+    paths = []
+    for image_number, width, height, color, file_extension in specs:
+        subdirectory = f"{directory}{(image_number - 1) // CORPUS_CHUNK_SIZE:05d}/"
+        filename = f"{image_number:07d}.{file_extension}"
+        create_and_save_image(width, height, color, filename, subdirectory,
+                              str(image_number) if add_labels else "")
+        paths.append(subdirectory + filename)
+    return paths
+
+
 # create a function that takes in a tuple of two numbers and returns a random number between them
 def get_random_number(number_range: tuple):
     # if the number range is none, return none
@@ -85,10 +182,10 @@ def create_and_save_image(width, height, color: tuple, filename: str, directory:
 # create a function that takes in parameters to create an image
 # based on some parameters: width, height, color as a RGB tuple, a filename. No need to save it yet, just return the ndarray
 def create_image(width: int, height: int, color: tuple, filename: str):
-    # create a ndarray of 1's with the given width and height
-    ones = np.ones((height, width, 3), dtype="uint8")
-    # multiply the ndarray by the color tuple, reverse RGB to BGR because opencv takes in BGR instead
-    image = ones * color[::-1]
+    # fill a uint8 ndarray with the color directly, reverse RGB to BGR because opencv takes in BGR instead.
+    # multiplying an array of ones by the color tuple would promote the image to int64 (8 times the memory)
+    # and cv2 drawing functions do not accept int64 images
+    image = np.full((height, width, 3), color[::-1], dtype=np.uint8)
     # return the ndarray
     return image
 
@@ -119,8 +216,8 @@ def add_text_to_image(image: np.ndarray, text: str):
 
 # get the contrast color
 def get_contrast_color(color: tuple):
-    # get the sum of the color tuple
-    color_sum = sum(color)
+    # get the sum of the color tuple, converted to int first since pixels sampled from a uint8 image would overflow
+    color_sum = sum(int(channel) for channel in color)
     # if the sum is less than 382, return white, otherwise return black
     if color_sum < 382:
         return (255, 255, 255)
@@ -146,13 +243,21 @@ def get_font_thickness(width: int, height: int):
 
 # get the text size
 def get_text_size_and_scale(text: str, width: int, fontFace, font_thickness: int) -> (tuple, float):
-    # get the text size
-    for scale in reversed(range(0, 60, 1)):
+    # the largest scale in steps of 0.1 (at most 5.9) at which the text fits the width. The step is worked out in
+    # closed form and then checked against its neighbours, instead of measuring the text at every step
+    scale = math.floor(caption.fit_font_scale(text, width, font_face=fontFace, thickness=font_thickness,
+                                              max_scale=MAX_FONT_SCALE_STEPS / 10) * 10)
+    text_size = cv2.getTextSize(text, fontFace, fontScale=scale / 10, thickness=font_thickness)
+    while text_size[0][0] > width and scale > 0:
+        scale -= 1
         text_size = cv2.getTextSize(text, fontFace, fontScale=scale / 10, thickness=font_thickness)
-        new_width = text_size[0][0]
-        if new_width <= width:
-            return text_size, scale / 10
-    return 1
+    while scale < MAX_FONT_SCALE_STEPS:
+        larger_text_size = cv2.getTextSize(text, fontFace, fontScale=(scale + 1) / 10, thickness=font_thickness)
+        if larger_text_size[0][0] > width:
+            break
+        scale += 1
+        text_size = larger_text_size
+    return text_size, scale / 10
 
 
 # get the text coordinates